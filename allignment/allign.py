@@ -1,62 +1,298 @@
-import subprocess
 import argparse
+import io
 from tqdm import tqdm
 import os
-from concurrent.futures import ProcessPoolExecutor
+import sys
+import math
+import hashlib
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import load_manifest, save_manifest, pending_items, remove_stale_items
+from common.family_archive import has_archive, load_index, read_member
+from common.compression import CompressedWriter, CODECS, SUFFIXES, codec_of, compress_bytes, strip_codec, read_file
+from common.scheduler import run_command, run_scheduled
+from common.ledger import resumable_items, open_ledger, append_record, remove_ledger
+from common.result_cache import cache_key, open_result_cache
+from common.telemetry import track_stage
+from common.work_queue import open_work_queue, run_queued, DEFAULT_ADDRESS
 
-def run_mafft(fasta_file: str, fasta_path: str, output_dir: str):
+
+MAFFT_OPTIONS = ["--quiet", "--auto"]
+REPORT_NAME = "alignment_report.tsv"
+
+
+def run_mafft(fasta_file: str, fasta_path: str, output_dir: str, member: tuple = None, threads: int = 1, cache=None, key: str = None, content: bytes = None,
+              compression: str = "none"):
     """
     Run MAFFT alignment on a single fasta file.
+    If member (offset, length) is given, the family is read from the family archive in fasta_path
+    and piped to MAFFT's stdin; if content is given, it is piped instead of reading any file.
+    Compressed family files are decompressed in memory and piped as well.
+    The alignment is compressed with the given codec as MAFFT writes it.
+    The alignment is written to a temporary file which replaces the final file only when MAFFT succeeds,
+    so a failed or interrupted run never leaves a truncated alignment behind.
+    With a result cache, the alignment is taken from the cache under key if present (MAFFT is not run)
+    and stored there otherwise. Cache entries are uncompressed (see mafft_cache_key).
+
+    Returns:
+    - (fasta_file, status, usage): tuple, usage holds the exit code and resource usage of MAFFT.
     """
     exact_filepath = os.path.join(fasta_path, fasta_file)
-    output_file = os.path.join(output_dir, f"{os.path.splitext(fasta_file)[0]}-aligned.fasta")
+    output_file = os.path.join(output_dir, aligned_name(fasta_file, compression))
+    tmp_file = output_file + ".tmp"
+    usage = {}
+    try:
+        if cache is not None:
+            alignment = cache.get_bytes(key)
+            if alignment is not None:
+                with open(tmp_file, "wb") as f:
+                    f.write(compress_bytes(alignment, compression))
+                os.replace(tmp_file, output_file)
+                return (fasta_file, "Success", usage)
+        command = ["mafft", *MAFFT_OPTIONS, "--thread", str(threads)]
+        if content is not None:
+            command.append("-")
+            family = content
+        elif member is None and codec_of(fasta_file) == "none":
+            command.append(exact_filepath)
+            family = None
+        elif member is None:
+            command.append("-")
+            family = read_file(exact_filepath)
+        else:
+            command.append("-")
+            family = read_member(fasta_path, *member)
+        with (open(tmp_file, "wb") if compression == "none" else CompressedWriter(tmp_file, compression)) as output:
+            returncode, _, usage = run_command(command, stdout=output, input=family)
+        if returncode != 0:
+            return (fasta_file, f"Failed (Code {returncode})", usage)
+        os.replace(tmp_file, output_file)
+        if cache is not None:
+            if compression == "none":
+                cache.put(key, output_file)
+            else:
+                cache.put_bytes(key, read_file(output_file))
+        return (fasta_file, "Success", usage)
+    except FileNotFoundError as e:
+        return (fasta_file, "File Not Found", usage)
+    except Exception as e:
+        return (fasta_file, f"Unexpected Error: {e}", usage)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def align_in_memory(content: bytes, threads: int = 1, cache=None, key: str = None):
+    """
+    Run MAFFT on family content piped to its stdin and keep the alignment in memory (nothing is written
+    next to the results). Used by the fused align-tree tasks of pipeline.py, which hand the alignment
+    straight to IQ-TREE. With a result cache, the alignment is taken from the cache under key if present
+    and stored there otherwise.
+
+    Returns:
+    - (alignment, status, usage): tuple, alignment is the uncompressed aligned FASTA content (None on failure),
+      usage holds the exit code and resource usage of MAFFT.
+    """
+    usage = {}
     try:
-        command = [
-            "mafft",
-            "--quiet",
-            "--auto",
-            exact_filepath,
-        ]
-        with open(output_file, "w") as output:
-            subprocess.run(command, check=True, stdout=output, text=True)
-        return (fasta_file, "Success")
-    except subprocess.CalledProcessError as e:
-        return (fasta_file, f"Failed (Code {e.returncode})")
+        alignment = cache.get_bytes(key) if cache is not None else None
+        if alignment is not None:
+            return (alignment, "Success", usage)
+        output = io.BytesIO()
+        returncode, _, usage = run_command(["mafft", *MAFFT_OPTIONS, "--thread", str(threads), "-"], stdout=output, input=content)
+        alignment = output.getvalue()
+        if returncode != 0:
+            return (None, f"Failed (Code {returncode})", usage)
+        if cache is not None:
+            cache.put_bytes(key, alignment)
+        return (alignment, "Success", usage)
     except FileNotFoundError as e:
-        return (fasta_file, "File Not Found")
+        return (None, "File Not Found", usage)
     except Exception as e:
-        return (fasta_file, f"Unexpected Error: {e}")
+        return (None, f"Unexpected Error: {e}", usage)
+
+
+def mafft_cache_key(family_digest: str) -> str:
+    """
+    Result cache key of the alignment of a family, from the SHA-256 digest of the uncompressed family content.
+    Entries hold the uncompressed alignment, so families share them across family layouts and codecs.
+    """
+    return cache_key("mafft", {"tool": "mafft", "options": MAFFT_OPTIONS}, family_digest)
+
+
+def is_valid_alignment(path: str) -> bool:
+    """
+    Check that an alignment file is complete: non-empty FASTA ending with a newline
+    (compressed alignments must also decompress completely).
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+    if codec_of(path) != "none":
+        try:
+            data = read_file(path)
+        except Exception:
+            return False  # Truncated or corrupt
+        return data[:1] == b">" and data[-1:] == b"\n"
+    with open(path, "rb") as f:
+        first = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        return first == b">" and f.read(1) == b"\n"
+
+
+def aligned_name(fasta_file: str, compression: str = "none") -> str:
+    return f"{os.path.splitext(strip_codec(fasta_file))[0]}-aligned.fasta{SUFFIXES[compression]}"
+
+
+def family_stats(data: bytes):
+    """
+    Count sequences and residues of a FASTA family.
+
+    Returns:
+    - num_sequences: int, Number of sequences.
+    - mean_length: float, Mean sequence length.
+    """
+    num_sequences = 0
+    residues = 0
+    for line in data.splitlines():
+        if line.startswith(b">"):
+            num_sequences += 1
+        else:
+            residues += len(line.strip())
+    return num_sequences, residues / num_sequences if num_sequences else 0.0
+
+
+def mafft_threads(cost: float, free_cores: int, num_pending: int, thread_cost: float, max_threads: int) -> int:
+    """
+    Number of MAFFT threads for a family: one thread per thread_cost units of estimated cost
+    (sequences x mean length), capped by max_threads. When fewer families remain than cores
+    are free, the spare cores are shared among the remaining (largest) families.
+    """
+    threads = max(1, math.ceil(cost / thread_cost))
+    if num_pending < free_cores:
+        threads = max(threads, free_cores // num_pending)
+    return min(threads, max_threads)
 
 
-def mafft_align(fasta_path: str, output_dir: str, num_processes: int = 4):
+def align_job(job: dict, threads: int):
+    """
+    Run one scheduled alignment job. Jobs carry all their arguments, so they also run on queue workers.
+    """
+    return run_mafft(job["family"], job["fasta_path"], job["output_dir"], job["member"], threads, job["cache"], job["key"],
+                     compression=job["compression"])
+
+
+def align_job_threads(job: dict, free_cores: int, num_pending: int) -> int:
+    return mafft_threads(job["cost"], free_cores, num_pending, job["thread_cost"], job["max_threads"])
+
+
+def mafft_align(fasta_path: str, output_dir: str, num_processes: int = 4, thread_cost: float = 200_000, max_threads: int = 8, resume: bool = False, cache=None, work_queue=None,
+                compression: str = "none"):
     """
     Perform MAFFT alignment in parallel.
+    Families whose content is unchanged since the last run (per the manifest in output_dir) are skipped,
+    and alignments of families which disappeared are removed.
+    Families are read either from per-family FASTA files or from a family archive in fasta_path.
+
+    Families are scheduled largest first by estimated cost (sequences x mean length) on a budget of
+    num_processes cores; large families get several MAFFT threads, small ones are packed onto the
+    remaining cores. Per-family wall times and failures are written to alignment_report.tsv.
+
+    Every finished family is recorded in a completion ledger (with its exit status) as soon as it completes.
+    With resume, families recorded as successful by an interrupted run are skipped if their alignment is valid.
+    With a result cache (common.result_cache), families aligned before with the same options (in any run) are
+    taken from the cache.
+    With a work queue (common.work_queue), the families are aligned by queue workers, each with its own core budget,
+    instead of on num_processes local cores.
+    Family files may be compressed (common.compression); alignments are written with the given codec.
+
+    Returns:
+    - failed: list, (family, status) of failed alignments.
     """
     os.makedirs(output_dir, exist_ok=True)
-    fasta_files = os.listdir(fasta_path)
-    
-    # Use ProcessPoolExecutor for parallel processing
-    with ProcessPoolExecutor(max_workers=num_processes) as executor:
-        # Wrap the executor map with tqdm for progress tracking
-        results = list(tqdm(
-            executor.map(
-                run_mafft,
-                fasta_files,
-                [fasta_path] * len(fasta_files),
-                [output_dir] * len(fasta_files),
-            ),
-            total=len(fasta_files),
-            desc="Aligning sequences",
-            unit="file"
-        ))
+    manifest = load_manifest(output_dir)
+    params = {"tool": "mafft", "options": MAFFT_OPTIONS}
+    if compression != "none":
+        params["compression"] = compression
+
+    if has_archive(fasta_path):
+        index = load_index(fasta_path)
+        all_fasta_files = list(index)
+        # Digests are recorded by make_families.py in the family manifest.
+        family_items = load_manifest(fasta_path)["items"]
+        digests = {f: family_items[f]["input"] for f in all_fasta_files}
+    else:
+        index = {}
+        all_fasta_files = sorted(f for f in os.listdir(fasta_path) if strip_codec(f).endswith(".fasta"))
+        # Digests of the uncompressed content, as recorded for archive members.
+        digests = {f: hashlib.sha256(read_file(os.path.join(fasta_path, f))).hexdigest() for f in all_fasta_files}
+    remove_stale_items(manifest, digests, output_dir)
+    if manifest["params"] != params:
+        manifest["items"] = {}
+        manifest["params"] = params
+    if resume:
+        resumed = resumable_items(output_dir, params, digests, is_valid_alignment)
+        manifest["items"].update(resumed)
+        print(f"Resuming: {len(resumed)} alignments completed by the interrupted run.")
+    fasta_files = pending_items(manifest, params, digests, output_dir)
+    print(f"{len(all_fasta_files) - len(fasta_files)} alignments up to date, {len(fasta_files)} to compute.")
+
+    # Estimate the cost of every family and run the largest first.
+    jobs = []
+    for fasta_file in fasta_files:
+        if fasta_file in index:
+            data = read_member(fasta_path, *index[fasta_file])
+        else:
+            data = read_file(os.path.join(fasta_path, fasta_file))
+        num_sequences, mean_length = family_stats(data)
+        jobs.append({"family": fasta_file, "sequences": num_sequences, "mean_length": mean_length, "cost": num_sequences * mean_length,
+                     "fasta_path": fasta_path, "output_dir": output_dir, "member": index.get(fasta_file), "cache": cache,
+                     "key": mafft_cache_key(digests[fasta_file]), "thread_cost": thread_cost, "max_threads": max_threads,
+                     "compression": compression})
+    jobs.sort(key=lambda job: job["cost"], reverse=True)
+
+    if work_queue is None:
+        results = run_scheduled(jobs, num_processes, align_job, align_job_threads, desc="Aligning sequences", unit="file")
+    else:
+        results = run_queued(jobs, work_queue, align_job, align_job_threads, desc="Aligning sequences", unit="file")
+
+    failed = []
+    with open(os.path.join(output_dir, REPORT_NAME), "w") as report, open_ledger(output_dir, resume) as ledger:
+        report.write("family\tsequences\tmean_length\tcost\tthreads\twall_time_s\tstatus\n")
+        for job, threads, (fasta_file, status, usage), wall_time in results:
+            report.write(f"{fasta_file}\t{job['sequences']}\t{job['mean_length']:.1f}\t{job['cost']:.0f}\t{threads}\t{wall_time:.3f}\t{status}\n")
+            report.flush()
+            append_record(ledger, {"item": fasta_file, "input": digests[fasta_file], "params": params, "status": status,
+                                   "exit_code": usage.get("exit_code"), "outputs": [aligned_name(fasta_file, compression)]})
+            if status == "Success":
+                manifest["items"][fasta_file] = {"input": digests[fasta_file], "outputs": [aligned_name(fasta_file, compression)]}
+            else:
+                tqdm.write(f"Alignment of {fasta_file} failed: {status}")
+                manifest["items"].pop(fasta_file, None)
+                failed.append((fasta_file, status))
+
+    print(f"Aligned {len(jobs) - len(failed)} families, {len(failed)} failed. Report saved to {os.path.join(output_dir, REPORT_NAME)}")
+    save_manifest(output_dir, manifest)
+    remove_ledger(output_dir)
+    return failed
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script for performing multiple sequence alignment with MAFFT algorithm.")
     parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
-    parser.add_argument("--num_processes", type=int, default=4, help="Number of processes to use for multiprocessing.")
+    parser.add_argument("--num_processes", type=int, default=4, help="Number of CPU cores shared by the MAFFT jobs.")
+    parser.add_argument("--thread_cost", type=float, default=200_000, help="Estimated family cost (sequences x mean length) per additional MAFFT thread.")
+    parser.add_argument("--max_threads", type=int, default=8, help="Maximum number of MAFFT threads for a single family.")
+    parser.add_argument("--resume", action="store_true", help="Skip families completed by an interrupted run (per the completion ledger).")
+    parser.add_argument("--cache_dir", default=None, help="Directory of the result cache shared between runs (disabled if not given).")
+    parser.add_argument("--cache_size_gb", type=float, default=50.0, help="Size limit of the result cache in GB (least recently used results are evicted).")
+    parser.add_argument("--compression", choices=CODECS, default="none", help="Codec of the alignment files.")
+    parser.add_argument("--executor", choices=["local", "queue"], default="local", help="Run MAFFT on local cores or on workers of a work queue (common/work_queue.py).")
+    parser.add_argument("--queue_address", default=DEFAULT_ADDRESS, help="Address (host:port) the work queue listens on.")
+    parser.add_argument("--queue_authkey", default=os.environ.get("WORK_QUEUE_AUTHKEY"), help="Key shared with the queue workers (default: $WORK_QUEUE_AUTHKEY).")
     args = parser.parse_args()
+    if args.executor == "queue" and not args.queue_authkey:
+        parser.error("the queue executor requires --queue_authkey or $WORK_QUEUE_AUTHKEY")
+    track_stage("alignment")
 
     BASENAME = args.basename
     NUM_PROCESSES = args.num_processes
@@ -67,10 +303,15 @@ if __name__ == "__main__":
     OUTPUT_DIR_ORTOLOGS = os.path.join("allignment/msa_results/ortologs", BASENAME)
     OUTPUT_DIR_PARALOGS = os.path.join("allignment/msa_results/paralogs", BASENAME)
 
+    cache = open_result_cache(args.cache_dir, args.cache_size_gb)
+    work_queue = open_work_queue(args.executor, args.queue_address, args.queue_authkey)
+
     # Perform MAFFT alignment in parallel
     print("Preparing MSA for ortological sequences ...")
-    mafft_align(PROTEIN_FAMILIES_PATH_ORTOLOGS, OUTPUT_DIR_ORTOLOGS, NUM_PROCESSES)
+    mafft_align(PROTEIN_FAMILIES_PATH_ORTOLOGS, OUTPUT_DIR_ORTOLOGS, NUM_PROCESSES, args.thread_cost, args.max_threads, args.resume, cache, work_queue, args.compression)
     print("Done.")
     print("Preparing MSA for paralogical sequences ...")
-    mafft_align(PROTEIN_FAMILIES_PATH_PARALOGS, OUTPUT_DIR_PARALOGS, NUM_PROCESSES)
+    mafft_align(PROTEIN_FAMILIES_PATH_PARALOGS, OUTPUT_DIR_PARALOGS, NUM_PROCESSES, args.thread_cost, args.max_threads, args.resume, cache, work_queue, args.compression)
     print("Done.")
+    if cache is not None and work_queue is None:  # With the queue executor the cache is used by the workers
+        print(cache.summary())
@@ -0,0 +1,191 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+import numpy as np
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import load_manifest, save_manifest, file_digest, pending_items, remove_stale_items
+from common.telemetry import track_stage, timed
+from common.compression import codec_of, compress_bytes, read_file, strip_codec
+
+GAP = ord("-")
+REPORT_NAME = "trimming_report.tsv"
+
+
+def parse_alignment(data: bytes, source: str = "alignment"):
+    """
+    Load aligned FASTA content into a matrix of residue codes (upper case).
+
+    Returns:
+    - names: list, Sequence headers.
+    - matrix: np.ndarray, uint8 (sequences x columns).
+    """
+    names = []
+    sequences = []
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith(b">"):
+            names.append(line[1:].decode())
+            sequences.append([])
+        elif line:
+            sequences[-1].append(line)
+    rows = [b"".join(parts) for parts in sequences]
+    if len({len(row) for row in rows}) > 1:
+        raise ValueError(f"Sequences of {source} have different lengths.")
+    matrix = np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), -1).copy()
+    lower = (matrix >= ord("a")) & (matrix <= ord("z"))
+    matrix[lower] -= 32
+    return names, matrix
+
+
+def read_alignment(path: str):
+    """
+    Load a (possibly compressed) aligned FASTA file, see parse_alignment.
+    """
+    return parse_alignment(read_file(path), path)
+
+
+def column_statistics(matrix: np.ndarray):
+    """
+    Per-column gap fraction and conservation (frequency of the most common residue among non-gap residues),
+    and per-sequence gap fraction.
+    """
+    num_sequences, num_columns = matrix.shape
+    gaps = matrix == GAP
+    column_gaps = gaps.mean(axis=0)
+    sequence_gaps = gaps.mean(axis=1)
+    # Residue counts of every column in one bincount over (column, residue code) pairs.
+    counts = np.bincount((np.arange(num_columns, dtype=np.int64) * 256 + matrix).ravel(), minlength=num_columns * 256)
+    counts = counts.reshape(num_columns, 256)
+    counts[:, GAP] = 0
+    residues = num_sequences - gaps.sum(axis=0)
+    conservation = np.divide(counts.max(axis=1), residues, out=np.ones(num_columns), where=residues > 0)
+    return column_gaps, conservation, sequence_gaps
+
+
+def trim_data(data: bytes, max_gap_fraction: float, max_conservation: float, source: str = "alignment"):
+    """
+    Trim aligned FASTA content in memory (see trim_alignment).
+
+    Returns:
+    - (trimmed, report): tuple, Trimmed aligned FASTA content and the trimming report.
+    """
+    names, matrix = parse_alignment(data, source)
+    column_gaps, conservation, sequence_gaps = column_statistics(matrix)
+    gappy = column_gaps > max_gap_fraction
+    conserved = ~gappy & (conservation >= max_conservation)
+    keep = ~(gappy | conserved)
+    if not keep.any():
+        conserved[:] = False
+        keep = ~gappy
+    if not keep.any():
+        # Every column is gap-heavy: keep the alignment untrimmed rather than write empty sequences.
+        gappy[:] = False
+        keep[:] = True
+    trimmed = matrix[:, keep]
+
+    report = {
+        "sequences": len(names),
+        "columns": matrix.shape[1],
+        "kept_columns": int(keep.sum()),
+        "gap_columns": int(gappy.sum()),
+        "conserved_columns": int(conserved.sum()),
+        "mean_sequence_gaps": float(sequence_gaps.mean()) if len(names) else 0.0,
+        "max_sequence_gaps": float(sequence_gaps.max()) if len(names) else 0.0,
+    }
+    return b"".join(b">" + name.encode() + b"\n" + row.tobytes() + b"\n" for name, row in zip(names, trimmed)), report
+
+
+@timed
+def trim_alignment(msa_file: str, msa_path: str, output_dir: str, max_gap_fraction: float, max_conservation: float):
+    """
+    Remove gap-heavy columns (gap fraction above max_gap_fraction) and conserved columns (conservation at
+    least max_conservation; 1.0 removes constant columns) and write the trimmed alignment to output_dir
+    (with the codec of the input alignment). If no column would be left, only gap-heavy columns are removed,
+    and if that still leaves no column, the alignment is kept untrimmed.
+
+    Returns:
+    - (msa_file, status, report): tuple, report holds the counts of removed columns and sequence gap fractions.
+    """
+    try:
+        input_file = os.path.join(msa_path, msa_file)
+        data, report = trim_data(read_file(input_file), max_gap_fraction, max_conservation, input_file)
+        output_file = os.path.join(output_dir, msa_file)
+        with open(output_file + ".tmp", "wb") as f:
+            f.write(compress_bytes(data, codec_of(msa_file)))
+        os.replace(output_file + ".tmp", output_file)
+        return (msa_file, "Success", report)
+    except FileNotFoundError as e:
+        return (msa_file, "File Not Found", {})
+    except Exception as e:
+        return (msa_file, f"Unexpected Error: {e}", {})
+
+
+def _trim_job(arguments):
+    return trim_alignment(*arguments)
+
+
+def trim_alignments(msa_path: str, output_dir: str, num_processes: int = 4, max_gap_fraction: float = 0.5, max_conservation: float = 1.1):
+    """
+    Trim all alignments in parallel. Alignments unchanged since the last run with the same settings
+    (per the manifest in output_dir) are skipped, and trimmed alignments of removed families are deleted.
+    Per-family column counts are written to trimming_report.tsv.
+
+    Returns:
+    - failed: list, (family, status) of failed alignments.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    params = {"max_gap_fraction": max_gap_fraction, "max_conservation": max_conservation}
+
+    all_msa_files = sorted(f for f in os.listdir(msa_path) if strip_codec(f).endswith("-aligned.fasta"))
+    digests = {f: file_digest(os.path.join(msa_path, f)) for f in all_msa_files}
+    remove_stale_items(manifest, digests, output_dir)
+    if manifest["params"] != params:
+        manifest["items"] = {}
+        manifest["params"] = params
+    msa_files = pending_items(manifest, params, digests, output_dir)
+    print(f"{len(all_msa_files) - len(msa_files)} trimmed alignments up to date, {len(msa_files)} to trim.")
+
+    failed = []
+    removed = total = 0
+    jobs = [(msa_file, msa_path, output_dir, max_gap_fraction, max_conservation) for msa_file in msa_files]
+    with open(os.path.join(output_dir, REPORT_NAME), "w") as report, ProcessPoolExecutor(max_workers=num_processes) as executor:
+        report.write("family\tsequences\tcolumns\tkept_columns\tgap_columns\tconserved_columns\tmean_sequence_gaps\tmax_sequence_gaps\tstatus\n")
+        results = executor.map(_trim_job, jobs, chunksize=max(1, len(jobs) // (4 * num_processes)))
+        for msa_file, status, stats in tqdm(results, total=len(jobs), desc="Trimming alignments", unit="file"):
+            if status == "Success":
+                report.write(f"{msa_file}\t{stats['sequences']}\t{stats['columns']}\t{stats['kept_columns']}\t{stats['gap_columns']}\t"
+                             f"{stats['conserved_columns']}\t{stats['mean_sequence_gaps']:.3f}\t{stats['max_sequence_gaps']:.3f}\t{status}\n")
+                manifest["items"][msa_file] = {"input": digests[msa_file], "outputs": [msa_file]}
+                removed += stats["columns"] - stats["kept_columns"]
+                total += stats["columns"]
+            else:
+                report.write(f"{msa_file}\t\t\t\t\t\t\t\t{status}\n")
+                tqdm.write(f"Trimming of {msa_file} failed: {status}")
+                manifest["items"].pop(msa_file, None)
+                failed.append((msa_file, status))
+
+    print(f"Removed {removed} of {total} columns. Report saved to {os.path.join(output_dir, REPORT_NAME)}")
+    save_manifest(output_dir, manifest)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script for removing gap-heavy and conserved columns from multiple sequence alignments.")
+    parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
+    parser.add_argument("--num_processes", type=int, default=4, help="Number of alignments trimmed in parallel.")
+    parser.add_argument("--max_gap_fraction", type=float, default=0.5, help="Columns with a larger fraction of gaps are removed.")
+    parser.add_argument("--max_conservation", type=float, default=1.1, help="Columns whose most common residue reaches this frequency are removed (1.0 - constant columns, above 1 - none). Do not remove constant columns for models with +I (WAG+I).")
+    args = parser.parse_args()
+    track_stage("trimming")
+
+    BASENAME = args.basename
+
+    for kind in ("ortologs", "paralogs"):
+        print(f"Trimming alignments of {kind} ...")
+        trim_alignments(os.path.join("allignment/msa_results", kind, BASENAME), os.path.join("allignment/trimmed_results", kind, BASENAME),
+                        args.num_processes, args.max_gap_fraction, args.max_conservation)
+        print("Done.")
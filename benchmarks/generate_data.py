@@ -0,0 +1,177 @@
+import os
+import json
+import shutil
+import zipfile
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+ARCHIVES_DIRNAME = "archives"
+ACCESSIONS_NAME = "accessions.txt"
+CLUSTERS_NAME = "clusters.tsv"
+DATASET_NAME = "dataset.json"
+WRITE_BATCH = 1 << 20  # Cluster TSV lines formatted at once
+
+
+def accession(genome: int) -> str:
+    return f"GCF_{genome + 1:09d}.1"
+
+
+def protein_id(family: int, genome: int, copy: int) -> str:
+    """
+    Synthetic protein IDs encode their family, so stub tools can cluster them without comparing sequences.
+    """
+    return f"SP{family}_{genome}_{copy}"
+
+
+def parse_protein_id(prot_id: str):
+    family, genome, copy = prot_id[2:].split("_")
+    return int(family), int(genome), int(copy)
+
+
+class SyntheticPangenome:
+    """
+    Random pangenome: num_core families present in every genome (with occasional paralog copies),
+    the rest of each proteome drawn from a pool of accessory families. Every family has a random
+    ancestral sequence; genome copies differ from it by point mutations.
+    """
+
+    def __init__(self, proteins_per_genome: int, core_fraction: float = 0.2, accessory_pool: int = 4, paralog_rate: float = 0.05,
+                 mean_length: int = 300, mutation_rate: float = 0.05, seed: int = 0):
+        self.proteins_per_genome = proteins_per_genome
+        self.num_core = max(1, int(proteins_per_genome * core_fraction))
+        self.num_families = self.num_core + max(1, accessory_pool * (proteins_per_genome - self.num_core))
+        self.paralog_rate = paralog_rate
+        self.mutation_rate = mutation_rate
+        self.seed = seed
+
+        rng = np.random.default_rng([seed, 0])
+        self.lengths = rng.integers(mean_length // 3, 5 * mean_length // 3 + 1, size=self.num_families)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)))
+        self.residues = AMINO_ACIDS[rng.integers(0, len(AMINO_ACIDS), size=self.offsets[-1])]
+
+    def genome_members(self, genome: int):
+        """
+        Families and copy numbers of the proteins of one genome.
+
+        Returns:
+        - (families, copies): tuple, int64 arrays with one entry per protein.
+        """
+        rng = np.random.default_rng([self.seed, 1, genome])
+        core = np.arange(self.num_core)
+        paralogs = core[rng.random(self.num_core) < self.paralog_rate]
+        num_accessory = max(0, self.proteins_per_genome - len(core) - len(paralogs))
+        accessory = self.num_core + rng.choice(self.num_families - self.num_core, size=min(num_accessory, self.num_families - self.num_core), replace=False)
+        families = np.concatenate((core, paralogs, np.sort(accessory)))
+        copies = np.concatenate((np.zeros(len(core), dtype=np.int64), np.ones(len(paralogs), dtype=np.int64), np.zeros(len(accessory), dtype=np.int64)))
+        return families, copies
+
+    def proteome(self, genome: int) -> bytes:
+        """
+        FASTA proteome of one genome (NCBI protein.faa style headers).
+        """
+        families, copies = self.genome_members(genome)
+        rng = np.random.default_rng([self.seed, 2, genome])
+        starts, lengths = self.offsets[families], self.lengths[families]
+        # Gather all member sequences at once, then apply point mutations.
+        positions = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) + np.arange(lengths.sum())
+        sequences = self.residues[positions]
+        mutated = rng.random(len(sequences)) < self.mutation_rate
+        sequences[mutated] = AMINO_ACIDS[rng.integers(0, len(AMINO_ACIDS), size=int(mutated.sum()))]
+        data = sequences.tobytes()
+        ends = np.cumsum(lengths)
+        parts = []
+        for family, copy, end, length in zip(families.tolist(), copies.tolist(), ends.tolist(), lengths.tolist()):
+            parts.append(f">{protein_id(family, genome, copy)} synthetic protein {family}\n".encode())
+            parts.append(data[end - length:end] + b"\n")
+        return b"".join(parts)
+
+
+def write_archive(path: str, genome: int, proteome: bytes):
+    """
+    Write a proteome archive in the layout of NCBI Datasets downloads.
+    """
+    with zipfile.ZipFile(path + ".tmp", "w", zipfile.ZIP_DEFLATED, compresslevel=1) as z:
+        z.writestr(f"ncbi_dataset/data/{accession(genome)}/protein.faa", proteome)
+    os.replace(path + ".tmp", path)
+
+
+def write_cluster_tsv(families: np.ndarray, genomes: np.ndarray, copies: np.ndarray, path: str):
+    """
+    Write an MMseqs2-style cluster TSV (representative and member per line, clusters on consecutive lines)
+    with one cluster per family; the first member of a family is its representative.
+    """
+    order = np.lexsort((copies, genomes, families))
+    families, genomes, copies = families[order], genomes[order], copies[order]
+    first = np.concatenate(([True], families[1:] != families[:-1]))
+    representative = np.maximum.accumulate(np.where(first, np.arange(len(families)), 0))
+    rep_genomes, rep_copies = genomes[representative], copies[representative]
+    with open(path + ".tmp", "w") as f:
+        for start in range(0, len(families), WRITE_BATCH):
+            batch = slice(start, start + WRITE_BATCH)
+            f.write("".join(
+                f"{protein_id(family, rep_genome, rep_copy)}\t{protein_id(family, genome, copy)}\n"
+                for family, genome, copy, rep_genome, rep_copy in zip(families[batch].tolist(), genomes[batch].tolist(), copies[batch].tolist(),
+                                                                      rep_genomes[batch].tolist(), rep_copies[batch].tolist())
+            ))
+    os.replace(path + ".tmp", path)
+
+
+def generate_dataset(output_dir: str, num_genomes: int, proteins_per_genome: int, cluster_tsv: bool = False, **pangenome_options):
+    """
+    Generate proteome archives (archives/<accession>.zip), an accession file and, optionally,
+    the cluster TSV MMseqs2 would produce for them. Archives of a dataset generated before with the
+    same parameters are kept, so a dataset is generated once and reused by later benchmark runs.
+
+    Returns:
+    - accession_file: str, Path of the accession file.
+    """
+    archive_dir = os.path.join(output_dir, ARCHIVES_DIRNAME)
+    params = {"proteins_per_genome": proteins_per_genome, **pangenome_options}
+    params_path = os.path.join(output_dir, DATASET_NAME)
+    previous = None
+    if os.path.exists(params_path):
+        with open(params_path, "r") as f:
+            previous = json.load(f)
+    if previous != params:
+        shutil.rmtree(archive_dir, ignore_errors=True)
+    os.makedirs(archive_dir, exist_ok=True)
+    with open(params_path, "w") as f:
+        json.dump(params, f, indent=1, sort_keys=True)
+    pangenome = SyntheticPangenome(proteins_per_genome, **pangenome_options)
+
+    accession_file = os.path.join(output_dir, ACCESSIONS_NAME)
+    with open(accession_file, "w") as f:
+        for genome in range(num_genomes):
+            f.write(f"{accession(genome)}; Synthetic genome {genome}\n")
+
+    for genome in tqdm(range(num_genomes), desc="Generating proteomes", unit="genome"):
+        path = os.path.join(archive_dir, f"{accession(genome)}.zip")
+        if not os.path.exists(path):
+            write_archive(path, genome, pangenome.proteome(genome))
+
+    if cluster_tsv:
+        members = [pangenome.genome_members(genome) for genome in range(num_genomes)]
+        families = np.concatenate([families for families, _ in members])
+        copies = np.concatenate([copies for _, copies in members])
+        genomes = np.repeat(np.arange(num_genomes), [len(families) for families, _ in members])
+        write_cluster_tsv(families, genomes, copies, os.path.join(output_dir, CLUSTERS_NAME))
+    return accession_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script for generating synthetic proteome archives, accession files and cluster TSVs.")
+    parser.add_argument("--output_dir", required=True, help="Directory of the synthetic dataset.")
+    parser.add_argument("--genomes", type=int, default=100, help="Number of genomes.")
+    parser.add_argument("--proteins_per_genome", type=int, default=1000, help="Number of proteins per genome.")
+    parser.add_argument("--core_fraction", type=float, default=0.2, help="Fraction of each proteome from core families (present in every genome).")
+    parser.add_argument("--paralog_rate", type=float, default=0.05, help="Probability of an extra (paralog) copy of a core family.")
+    parser.add_argument("--mean_length", type=int, default=300, help="Mean protein length.")
+    parser.add_argument("--mutation_rate", type=float, default=0.05, help="Fraction of residues mutated in every genome copy.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--cluster_tsv", action="store_true", help=f"Also write {CLUSTERS_NAME} (one cluster per family).")
+    args = parser.parse_args()
+
+    generate_dataset(args.output_dir, args.genomes, args.proteins_per_genome, args.cluster_tsv, core_fraction=args.core_fraction,
+                     paralog_rate=args.paralog_rate, mean_length=args.mean_length, mutation_rate=args.mutation_rate, seed=args.seed)
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from common.telemetry import REPORT_ENV, read_report
+from common.compression import CODECS
+from benchmarks.generate_data import generate_dataset
+from benchmarks.stub_tools import ARCHIVE_DIR_ENV
+
+STUBS_DIR = os.path.join(REPO_DIR, "benchmarks", "stubs")
+RESULTS_DIR = os.path.join(tempfile.gettempdir(), "phylo_bench_results")  # Outside the checkout, kept across runs like the datasets
+CODE_DIRS = ["common", "data_preparation", "clustering", "families", "allignment", "trees"]
+CODE_SUFFIXES = (".py", ".R")
+BASENAME = "bench"
+
+# Dataset sizes: (genomes, proteins per genome). "huge" is 10k genomes and 50M proteins.
+PRESETS = {
+    "tiny": (10, 200),
+    "small": (100, 1000),
+    "medium": (1000, 2000),
+    "large": (10_000, 2000),
+    "huge": (10_000, 5000),
+}
+
+
+def copy_code(workdir: str):
+    """
+    Copy the pipeline scripts (not their results) into workdir, so benchmark runs never touch the checkout.
+    """
+    for directory in CODE_DIRS:
+        for root, dirs, files in os.walk(os.path.join(REPO_DIR, directory)):
+            dirs[:] = [d for d in dirs if d != "__pycache__"]
+            target = os.path.join(workdir, os.path.relpath(root, REPO_DIR))
+            os.makedirs(target, exist_ok=True)
+            for name in files:
+                if name.endswith(CODE_SUFFIXES):
+                    shutil.copy2(os.path.join(root, name), target)
+    shutil.copy2(os.path.join(REPO_DIR, "pipeline.py"), workdir)
+
+
+def stage_commands(args) -> list:
+    """
+    (stage, command) pairs in main.sh order, with the same options main.sh passes.
+    """
+    dedup = ["--dedup"] if args.dedup else []
+    compression = ["--compression", args.compression]
+    compression_threads = ["--compression_threads", str(args.cpu_cores)]
+    commands = [("prepare_data", ["data_preparation/prepare_data.py", "--accession_filename", f"{BASENAME}.txt",
+                                  "--num_workers", str(args.cpu_cores), "--num_processes", str(args.cpu_cores), *compression])]
+    if args.dedup:
+        commands.append(("deduplication", ["clustering/deduplicate.py", "--basename", BASENAME, *compression, *compression_threads]))
+    commands.append(("clustering", ["clustering/cluster.py", "--basename", BASENAME, "--min_seq_id", "0.5", "--coverage", "0.8", *dedup]))
+
+    tree_options = ["--cpu_cores", str(args.cpu_cores), "--bootstrap", str(args.bootstrap), "--support_threshold", "0", "--single_pass"]
+    if args.orchestrator == "pipeline" and args.tree_method == "iqtree":
+        trim = ["--trim"] if args.trim else []
+        fused = ["--fused"] if args.fused else []
+        commands.append(("pipeline", ["pipeline.py", "--basename", BASENAME, "--min_cluster_size", str(args.min_cluster_size), *dedup, *trim, *fused, *tree_options,
+                                                  *compression, *compression_threads]))
+    else:
+        commands.append(("families", ["families/make_families.py", "--basename", BASENAME, "--min_cluster_size", str(args.min_cluster_size), *dedup, *compression]))
+        commands.append(("alignment", ["allignment/allign.py", "--basename", BASENAME, "--num_processes", str(args.cpu_cores), *compression]))
+        trimmed = []
+        if args.trim:
+            commands.append(("trimming", ["allignment/trim_alignments.py", "--basename", BASENAME, "--num_processes", str(args.cpu_cores)]))
+            trimmed = ["--trimmed"]
+        if args.tree_method == "draft":
+            commands.append(("trees", ["trees/draft_trees.py", "--basename", BASENAME, "--num_processes", str(args.cpu_cores), "--bootstrap", str(args.bootstrap),
+                                       "--support_threshold", "0", *trimmed, *compression, *compression_threads]))
+        else:
+            commands.append(("trees", ["trees/make_trees.py", "--basename", BASENAME, "--num_processes", str(args.cpu_cores), *tree_options, *trimmed,
+                                         "--batch_cells", str(args.tree_batch_cells),
+                                         *compression, *compression_threads]))
+    commands.append(("consensus", ["trees/make_consensus_tree.py", "--basename", BASENAME, "--min_support", "0", "--cpu_cores", str(args.cpu_cores)]))
+    commands.append(("supertree", ["trees/make_super_tree.py", "--basename", BASENAME, "--method", "MRP", "--cpu_cores", str(args.cpu_cores)]))
+    return commands
+
+
+def stage_results(records: list) -> dict:
+    """
+    Per-stage measurements from the run report. CPU time of the stubs is separated from the stage's CPU time,
+    so python_cpu_time is the pipeline's own work (main process and pool workers).
+    """
+    stages = {}
+    parents = {}
+    for record in records:
+        if record["type"] == "stage" and record.get("parent") is not None:
+            parents[record["name"]] = record["parent"]
+        elif record["type"] == "stage":
+            stages[record["name"]] = {
+                "wall_time": record["wall_time"],
+                "cpu_time": record["user_time"] + record["sys_time"],
+                "max_rss_kb": record["max_rss_kb"],
+                "children_max_rss_kb": record.get("children_max_rss_kb", 0),
+                "read_bytes": record["read_bytes"],
+                "write_bytes": record["write_bytes"],
+                "tool_calls": 0,
+                "tool_cpu_time": 0.0,
+            }
+    for record in records:
+        name = record.get("stage")
+        while name in parents:
+            name = parents[name]  # Tools of nested stages count for the script's stage
+        if record["type"] == "tool" and name in stages:
+            stage = stages[name]
+            stage["tool_calls"] += 1
+            stage["tool_cpu_time"] += record["user_time"] + record["sys_time"]
+    for stage in stages.values():
+        stage["python_cpu_time"] = max(0.0, stage["cpu_time"] - stage["tool_cpu_time"])
+    return stages
+
+
+def function_results(records: list) -> dict:
+    functions = {}
+    for record in records:
+        if record["type"] == "function":
+            totals = functions.setdefault(record["name"], {"calls": 0, "wall_time": 0.0, "cpu_time": 0.0})
+            totals["calls"] += record["calls"]
+            totals["wall_time"] += record["wall_time"]
+            totals["cpu_time"] += record["cpu_time"]
+    return functions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(result: dict, baseline: dict = None):
+    """
+    Print per-stage results; with a baseline result, the relative change of wall time, Python CPU time
+    and peak RSS of every stage present in both.
+    """
+    previous = baseline["stages"] if baseline else {}
+    print(f"{'stage':<14} {'wall s':>9} {'python cpu s':>12} {'tool cpu s':>10} {'tools':>7} {'max RSS MB':>10}"
+          + (f" {'wall':>8} {'py cpu':>8} {'RSS':>8}" if baseline else ""))
+    for name, stage in result["stages"].items():
+        line = (f"{name:<14} {stage['wall_time']:>9.2f} {stage['python_cpu_time']:>12.2f} {stage['tool_cpu_time']:>10.2f} "
+                f"{stage['tool_calls']:>7} {stage['max_rss_kb'] / 1024:>10.1f}")
+        before = previous.get(name)
+        if before is not None:
+            for key in ("wall_time", "python_cpu_time", "max_rss_kb"):
+                line += f" {100 * (stage[key] / before[key] - 1):>+7.1f}%" if before[key] > 0 else f" {'-':>8}"
+        print(line)
+
+
+def run_benchmark(args) -> dict:
+    """
+    Generate (or reuse) a synthetic dataset, run every stage on it with the stub tools and collect
+    per-stage and per-function measurements from the run report.
+    """
+    genomes, proteins = PRESETS[args.preset]
+    genomes = args.genomes or genomes
+    proteins = args.proteins_per_genome or proteins
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(), "phylo_bench_data", f"{genomes}x{proteins}_seed{args.seed}")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="phylo_bench_")
+
+    start = time.perf_counter()
+    accession_file = generate_dataset(data_dir, genomes, proteins, seed=args.seed)
+    generation_time = time.perf_counter() - start
+
+    # Every run starts from a fresh copy of the code, so no stage is skipped as up to date.
+    shutil.rmtree(workdir, ignore_errors=True)
+    copy_code(workdir)
+    os.makedirs(os.path.join(workdir, "data_preparation", "accession_ids"), exist_ok=True)
+    shutil.copyfile(accession_file, os.path.join(workdir, "data_preparation", "accession_ids", f"{BASENAME}.txt"))
+
+    report = os.path.join(workdir, "run_report.jsonl")
+    env = dict(os.environ, PATH=STUBS_DIR + os.pathsep + os.environ.get("PATH", ""))
+    env[ARCHIVE_DIR_ENV] = os.path.join(data_dir, "archives")
+    env[REPORT_ENV] = report
+    with open(os.path.join(workdir, "benchmark.log"), "w") as log:
+        for name, command in stage_commands(args):
+            print(f"Running {name} ...")
+            completed = subprocess.run([sys.executable, *command], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            if completed.returncode != 0:
+                sys.exit(f"Stage {name} failed (code {completed.returncode}), see {os.path.join(workdir, 'benchmark.log')}")
+
+    records = read_report(report)
+    result = {
+        "name": args.name or f"{args.preset}_{args.orchestrator}",
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count()},
+        "config": {"genomes": genomes, "proteins_per_genome": proteins, "seed": args.seed, "orchestrator": args.orchestrator,
+                   "cpu_cores": args.cpu_cores, "bootstrap": args.bootstrap, "min_cluster_size": args.min_cluster_size,
+                   "dedup": args.dedup, "trim": args.trim, "compression": args.compression,
+                   "tree_batch_cells": args.tree_batch_cells, "fused": args.fused, "tree_method": args.tree_method},
+        "generation_time": generation_time,
+        "stages": stage_results(records),
+        "functions": function_results(records),
+    }
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script for benchmarking the pipeline's Python stages on synthetic data with stub tools (offline).")
+    parser.add_argument("--preset", choices=PRESETS, default="small", help="Dataset size (genomes x proteins per genome).")
+    parser.add_argument("--genomes", type=int, default=None, help="Number of genomes (overrides the preset).")
+    parser.add_argument("--proteins_per_genome", type=int, default=None, help="Number of proteins per genome (overrides the preset).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic dataset.")
+    parser.add_argument("--orchestrator", choices=["pipeline", "stages"], default="stages", help="Run Steps 3-6 with pipeline.py or one script per step.")
+    parser.add_argument("--cpu_cores", type=int, default=os.cpu_count(), help="Number of CPU cores given to every stage.")
+    parser.add_argument("--bootstrap", type=int, default=10, help="Number of bootstrap replicates (passed to the IQ-TREE stub).")
+    parser.add_argument("--min_cluster_size", type=int, default=4, help="Minimum number of sequences in families.")
+    parser.add_argument("--dedup", action="store_true", help="Deduplicate sequences before clustering.")
+    parser.add_argument("--trim", action="store_true", help="Trim alignments before tree computation.")
+    parser.add_argument("--tree_batch_cells", type=float, default=0, help="Batch size (alignment cells) of IQ-TREE batches of small alignments (stages orchestrator, 0 - no batching).")
+    parser.add_argument("--tree_method", choices=["iqtree", "draft"], default="iqtree", help="ML trees (IQ-TREE stub) or draft neighbor joining trees (trees/draft_trees.py, always per stage).")
+    parser.add_argument("--fused", action="store_true", help="Pass alignments from MAFFT to IQ-TREE in memory (pipeline orchestrator).")
+    parser.add_argument("--compression", choices=CODECS, default="none", help="Codec of the intermediate files.")
+    parser.add_argument("--name", default=None, help="Name of the result (default: preset and orchestrator).")
+    parser.add_argument("--data_dir", default=None, help="Directory of the synthetic dataset (reused between runs).")
+    parser.add_argument("--workdir", default=None, help="Working directory of the run (default: a new temporary directory).")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory (results, logs and run report).")
+    parser.add_argument("--results_dir", default=RESULTS_DIR, help="Directory the result file is written to.")
+    parser.add_argument("--baseline", default=None, help="Result file of an earlier run to compare with.")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    os.makedirs(args.results_dir, exist_ok=True)
+    output = os.path.join(args.results_dir, f"{result['name']}_{result['time'].replace(':', '')}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=1)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    print(f"Synthetic dataset: {result['config']['genomes']} genomes x {result['config']['proteins_per_genome']} proteins.")
+    print_results(result, baseline)
+    print(f"Result saved to {output}")
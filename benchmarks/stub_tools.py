@@ -0,0 +1,170 @@
+import os
+import re
+import sys
+import shutil
+import zlib
+import random
+
+# Fast stand-ins for the external tools, producing valid outputs in the formats the pipeline reads.
+# The executables in benchmarks/stubs call main() with their own name. The MAFFT and IQ-TREE stubs
+# run once per family, so they avoid heavy imports.
+
+ARCHIVE_DIR_ENV = "BENCH_ARCHIVE_DIR"  # Directory of the synthetic archives served by the datasets stub
+_TIP_LABEL = re.compile(r"[(,]\s*([^(),:;\s][^(),:;]*)")
+
+
+def option(args: list, name: str, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def read_fasta(handle) -> list:
+    records = []
+    for line in handle:
+        line = line.strip()
+        if line.startswith(">"):
+            records.append([line[1:], []])
+        elif line and records:
+            records[-1][1].append(line)
+    return [(name, "".join(parts)) for name, parts in records]
+
+
+def balanced_newick(names: list, rng: random.Random = None) -> str:
+    """
+    Balanced binary tree over names (built bottom-up, so large trees need no recursion).
+    With rng, internal nodes get random support values.
+    """
+    nodes = [f"{name}:0.1" for name in names]
+    while len(nodes) > 3:
+        paired = []
+        for i in range(0, len(nodes) - 1, 2):
+            support = str(rng.randint(40, 100)) if rng else ""
+            paired.append(f"({nodes[i]},{nodes[i + 1]}){support}:0.05")
+        if len(nodes) % 2:
+            paired.append(nodes[-1])
+        nodes = paired
+    return f"({','.join(nodes)});"
+
+
+def datasets(args: list):
+    """
+    datasets download genome accession ACC --include protein --filename FILE
+    """
+    accession, filename = option(args, "accession"), option(args, "--filename")
+    source = os.path.join(os.environ.get(ARCHIVE_DIR_ENV, ""), f"{accession}.zip")
+    if not os.path.exists(source):
+        sys.exit(f"Accession {accession} not found in {ARCHIVE_DIR_ENV}.")
+    shutil.copyfile(source, filename)
+
+
+def mmseqs(args: list):
+    """
+    easy-cluster, createdb, cluster, clusterupdate and createtsv. Sequences are clustered by the family
+    encoded in their synthetic IDs; databases are arrays of (family, genome, copy).
+    """
+    import numpy as np
+    from benchmarks.generate_data import parse_protein_id, write_cluster_tsv
+
+    def read_ids(fasta: str):
+        import gzip
+        with (gzip.open(fasta, "rt") if fasta.endswith(".gz") else open(fasta, "r")) as f:  # MMseqs2 reads gzip input
+            ids = [parse_protein_id(line[1:].split(None, 1)[0]) for line in f if line.startswith(">")]
+        return np.array(ids, dtype=np.int64).reshape(-1, 3)
+
+    def save(path: str, ids):
+        with open(path, "wb") as f:
+            np.save(f, ids)
+
+    def load(path: str):
+        with open(path, "rb") as f:
+            return np.load(f)
+
+    command = args[0]
+    if command == "easy-cluster":
+        fasta, prefix, tmp_dir = args[1:4]
+        os.makedirs(tmp_dir, exist_ok=True)
+        ids = read_ids(fasta)
+        write_cluster_tsv(ids[:, 0], ids[:, 1], ids[:, 2], f"{prefix}_cluster.tsv")
+    elif command == "createdb":
+        save(args[2], read_ids(args[1]))
+    elif command == "cluster":
+        save(args[2], load(args[1]))
+    elif command == "clusterupdate":
+        new_ids = load(args[2])
+        save(args[4], new_ids)
+        save(args[5], new_ids)
+    elif command == "createtsv":
+        ids = load(args[3])
+        write_cluster_tsv(ids[:, 0], ids[:, 1], ids[:, 2], args[4])
+    else:
+        sys.exit(f"Unsupported mmseqs command: {command}")
+
+
+def mafft(args: list):
+    """
+    mafft [options] FILE|-: sequences are padded with gaps to the longest one.
+    """
+    source = args[-1]
+    if source == "-":
+        records = read_fasta(sys.stdin)
+    else:
+        with open(source, "r") as f:
+            records = read_fasta(f)
+    length = max((len(sequence) for _, sequence in records), default=0)
+    sys.stdout.write("".join(f">{name}\n{sequence}{'-' * (length - len(sequence))}\n" for name, sequence in records))
+
+
+def iqtree(args: list):
+    """
+    iqtree -s ALN | -S DIR | -con TREES, -pre PREFIX, -b/-B N: balanced trees over the alignment's taxa.
+    """
+    prefix = option(args, "-pre")
+    bootstrap = "-b" in args or "-B" in args
+    if "-con" in args:
+        with open(option(args, "-con"), "r") as f:
+            first = f.readline().strip()
+        with open(prefix + ".contree", "w") as f:
+            f.write(first + "\n")
+        return
+
+    if "-S" in args:
+        directory = option(args, "-S")
+        alignments = [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+    else:
+        alignments = [option(args, "-s")]
+    trees = []
+    for alignment in alignments:
+        with open(alignment, "r") as f:
+            records = read_fasta(f)
+        names = [name for name, _ in records]
+        # Supports are seeded by the alignment's content, so copies of an alignment (e.g. in tmpfs) get the same tree.
+        rng = random.Random(zlib.crc32("".join(sequence for _, sequence in records).encode())) if bootstrap else None
+        trees.append(balanced_newick(names, rng))
+    with open(prefix + ".treefile", "w") as f:
+        f.write("\n".join(trees) + "\n")
+    with open(prefix + ".log", "w") as f:
+        f.write(f"IQ-TREE stub: {' '.join(args)}\n")
+    with open(prefix + ".iqtree", "w") as f:
+        f.write("IQ-TREE stub report\n")
+
+
+def rscript(args: list):
+    """
+    Rscript super_tree.R INPUT OUTPUT METHOD MULTICORE CORES: balanced tree over the input taxa
+    (MRP matrix in Phylip format or trees in Newick format).
+    """
+    source, output = args[1], args[2]
+    with open(source, "r") as f:
+        if source.endswith(".phy"):
+            f.readline()
+            taxa = [line.split(None, 1)[0] for line in f if line.strip()]
+        else:
+            taxa = sorted({label.strip() for line in f for label in _TIP_LABEL.findall(line)})
+    with open(output, "w") as f:
+        f.write(balanced_newick(taxa) + "\n")
+
+
+STUBS = {"datasets": datasets, "mmseqs": mmseqs, "mafft": mafft, "iqtree": iqtree, "Rscript": rscript}
+
+
+def main(tool: str):
+    STUBS[tool](sys.argv[1:])
@@ -1,9 +1,24 @@
 import os
+import sys
+import json
 import shutil
-import subprocess
+import hashlib
 import argparse
+from collections import defaultdict
 
-def mmseqs2_cluster(combined_fasta_path, output_dir, tmp_dir, min_seq_id=0.5, coverage=0.8):
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.compression import find_variant, streamed_path
+from common.manifest import load_manifest, save_manifest, describe_files, stage_is_current
+from common.scheduler import run_checked
+from common.telemetry import track_stage, timed
+from clustering.deduplicate import UNIQUE_FASTA_NAME
+
+CLUSTER_TSV_NAME = "clustering_results_cluster.tsv"
+CLUSTER_DIFF_NAME = "clustering_results_cluster_diff.tsv"
+MMSEQS_CODECS = ("gzip",)  # Compressed inputs MMseqs2 reads natively
+
+
+def mmseqs2_cluster(combined_fasta_path, output_dir, tmp_dir, min_seq_id=0.5, coverage=0.8, mmseqs_bin="mmseqs"):
     """
     Perform clustering of protein sequences using MMseqs2.
     
@@ -13,6 +28,7 @@ def mmseqs2_cluster(combined_fasta_path, output_dir, tmp_dir, min_seq_id=0.5, co
     - tmp_dir: str, Path to temporary directory.
     - min_seq_id: float, Minimum sequence identity for clustering.
     - coverage: float, Minimum coverage for clustering.
+    - mmseqs_bin: str, Path to the MMseqs2 executable.
     """
 
     # Ensure the output directory exists
@@ -28,34 +44,179 @@ def mmseqs2_cluster(combined_fasta_path, output_dir, tmp_dir, min_seq_id=0.5, co
 
     try:
         output_name = "clustering_results"
-        # Run MMseqs2 easy-cluster
-        command = [
-            "mmseqs", "easy-cluster",
-            combined_fasta_path, output_name, tmp_dir,
-            '-v', '0',
-            "--min-seq-id", str(min_seq_id),
-            "-c", str(coverage)
-        ]
-
-        print(f"Running MMseqs2 clustering: {' '.join(command)}")
-        subprocess.run(command, check=True)
+        # Run MMseqs2 easy-cluster (it reads gzip input itself, other codecs are streamed through a pipe)
+        with streamed_path(combined_fasta_path, native=MMSEQS_CODECS) as input_path:
+            command = [
+                mmseqs_bin, "easy-cluster",
+                input_path, output_name, tmp_dir,
+                '-v', '0',
+                "--min-seq-id", str(min_seq_id),
+                "-c", str(coverage)
+            ]
+
+            print(f"Running MMseqs2 clustering: {' '.join(command)}")
+            run_checked(command, stdout=None)
         print(f"Clustering complete.")
         shutil.rmtree(tmp_dir)
     finally:
         os.chdir(original_dir)
 
+def run_mmseqs(mmseqs_bin:str, *arguments):
+    command = [mmseqs_bin, *arguments, "-v", "0"]
+    print(f"Running: {' '.join(command)}")
+    run_checked(command)
+
+
+@timed
+def cluster_digests(cluster_tsv:str)->dict:
+    """
+    Summarize a clustering as Representative ID -> (membership digest, size).
+    The digest XORs hashes of member IDs, so it does not depend on member order.
+    """
+    digests = defaultdict(lambda: [0, 0])
+    with open(cluster_tsv, "r") as f:
+        for line in f:
+            cluster, sequence = line.rstrip("\n").split("\t")
+            entry = digests[cluster]
+            entry[0] ^= int.from_bytes(hashlib.blake2b(sequence.encode(), digest_size=8).digest(), "little")
+            entry[1] += 1
+    return {cluster: tuple(entry) for cluster, entry in digests.items()}
+
+
+def diff_clusterings(old_digests:dict, new_tsv:str, output_path:str)->dict:
+    """
+    Compare a previous clustering with a new one and write which clusters were added, removed or changed
+    (cluster ID and status per line), so downstream stages can restrict work to those clusters.
+
+    Returns:
+    - counts: dict, Status -> number of clusters.
+    """
+    new_digests = cluster_digests(new_tsv)
+    counts = {"added": 0, "removed": 0, "changed": 0}
+    with open(output_path, "w") as f:
+        for cluster, digest in new_digests.items():
+            if cluster not in old_digests:
+                status = "added"
+            elif old_digests[cluster] != digest:
+                status = "changed"
+            else:
+                continue
+            counts[status] += 1
+            f.write(f"{cluster}\t{status}\n")
+        for cluster in old_digests:
+            if cluster not in new_digests:
+                counts["removed"] += 1
+                f.write(f"{cluster}\tremoved\n")
+    return counts
+
+
+def mmseqs2_cluster_update(combined_fasta_path, output_dir, db_dir, tmp_dir, min_seq_id=0.5, coverage=0.8, mmseqs_bin="mmseqs"):
+    """
+    Cluster protein sequences with MMseqs2, keeping the sequence and cluster databases between runs.
+    The first run (or a run with changed parameters) clusters everything from scratch. Later runs
+    use MMseqs2 clusterupdate, which only assigns new sequences to the existing clusters (or new ones).
+    Besides clustering_results_cluster.tsv a diff against the previous clustering is written.
+
+    Databases are kept in numbered generations (db_dir/gen_N); a generation becomes current only
+    after it has been fully written.
+
+    Parameters:
+    - combined_fasta_path: str, Path to the FASTA file with all (old and new) sequences.
+    - output_dir: str, Path to save MMseqs2 results.
+    - db_dir: str, Directory with persistent MMseqs2 databases.
+    - tmp_dir: str, Path to temporary directory.
+    - min_seq_id: float, Minimum sequence identity for clustering.
+    - coverage: float, Minimum coverage for clustering.
+    - mmseqs_bin: str, Path to the MMseqs2 executable.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(db_dir, exist_ok=True)
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    params = {"min_seq_id": min_seq_id, "coverage": coverage}
+    options = ["--min-seq-id", str(min_seq_id), "-c", str(coverage)]
+    current_path = os.path.join(db_dir, "current.json")
+    current = None
+    if os.path.exists(current_path):
+        with open(current_path, "r") as f:
+            current = json.load(f)
+
+    generation = current["generation"] + 1 if current else 0
+    gen_dir = os.path.join(db_dir, f"gen_{generation}")
+    if os.path.exists(gen_dir):
+        shutil.rmtree(gen_dir)  # Leftover of an interrupted run
+    os.makedirs(gen_dir)
+    seq_db = os.path.join(gen_dir, "seqDB")
+    cluster_db = os.path.join(gen_dir, "clusterDB")
+    run_tmp = os.path.join(tmp_dir, f"update_{generation}")
+
+    cluster_tsv = os.path.join(output_dir, CLUSTER_TSV_NAME)
+    old_digests = cluster_digests(cluster_tsv) if os.path.exists(cluster_tsv) else {}
+
+    os.makedirs(run_tmp, exist_ok=True)
+    try:
+        if current is None or current["params"] != params:
+            print("Clustering all sequences from scratch.")
+            with streamed_path(combined_fasta_path, native=MMSEQS_CODECS) as input_path:
+                run_mmseqs(mmseqs_bin, "createdb", input_path, seq_db)
+            run_mmseqs(mmseqs_bin, "cluster", seq_db, cluster_db, run_tmp, *options)
+        else:
+            print(f"Updating clustering generation {current['generation']} with new sequences.")
+            old_dir = os.path.join(db_dir, f"gen_{current['generation']}")
+            new_seq_db = os.path.join(run_tmp, "newSeqDB")
+            with streamed_path(combined_fasta_path, native=MMSEQS_CODECS) as input_path:
+                run_mmseqs(mmseqs_bin, "createdb", input_path, new_seq_db)
+            run_mmseqs(mmseqs_bin, "clusterupdate",
+                       os.path.join(old_dir, "seqDB"), new_seq_db, os.path.join(old_dir, "clusterDB"),
+                       seq_db, cluster_db, run_tmp, *options)
+
+        run_mmseqs(mmseqs_bin, "createtsv", seq_db, seq_db, cluster_db, cluster_tsv + ".tmp")
+        os.replace(cluster_tsv + ".tmp", cluster_tsv)
+    finally:
+        shutil.rmtree(run_tmp, ignore_errors=True)
+
+    with open(current_path + ".tmp", "w") as f:
+        json.dump({"generation": generation, "params": params}, f)
+    os.replace(current_path + ".tmp", current_path)
+    if current is not None:
+        shutil.rmtree(os.path.join(db_dir, f"gen_{current['generation']}"), ignore_errors=True)
+
+    counts = diff_clusterings(old_digests, cluster_tsv, os.path.join(output_dir, CLUSTER_DIFF_NAME))
+    print(f"Clustering complete: {counts['added']} clusters added, {counts['changed']} changed, {counts['removed']} removed.")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script for performing clustering with MMSeqs2 algorithm.")
     parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
     parser.add_argument("--min_seq_id", required=True, type=float, help="Minimum sequence identity for clustering.")
     parser.add_argument("--coverage", required=True, type=float, help="Minimum coverage for clustering.")
+    parser.add_argument("--update", action="store_true", help="Keep MMseqs2 databases between runs and only cluster new sequences against existing clusters.")
+    parser.add_argument("--dedup", action="store_true", help="Cluster the unique sequences written by deduplicate.py instead of all sequences.")
+    parser.add_argument("--mmseqs_bin", default="mmseqs", help="Path to the MMseqs2 executable.")
     args = parser.parse_args()
+    track_stage("clustering")
 
     BASENAME = args.basename
-    COMBINED_FASTA_PATH = os.path.join("data_preparation/data/combined_fasta", BASENAME, "combined_proteins.faa")
+    COMBINED_FASTA_PATH = find_variant(os.path.join("data_preparation/data/combined_fasta", BASENAME, "combined_proteins.faa"))
+    if args.dedup:
+        COMBINED_FASTA_PATH = find_variant(os.path.join("clustering/dedup_results", BASENAME, UNIQUE_FASTA_NAME))
     OUTPUT_DIR = os.path.join("clustering/clustering_results/", BASENAME)        # Output name for MMseqs2 results
     TMP_DIR = "clustering/tmp"                   # Temporary directory for MMseqs2
+    DB_DIR = os.path.join("clustering/mmseqs_db", BASENAME)  # Persistent MMseqs2 databases (update mode)
     
     os.makedirs(TMP_DIR, exist_ok=True)
 
-    mmseqs2_cluster(COMBINED_FASTA_PATH, OUTPUT_DIR, TMP_DIR, min_seq_id=args.min_seq_id, coverage=args.coverage)
+    manifest = load_manifest(OUTPUT_DIR)
+    params = {"min_seq_id": args.min_seq_id, "coverage": args.coverage, "dedup": args.dedup}
+    inputs = describe_files([COMBINED_FASTA_PATH], manifest["inputs"])
+    if stage_is_current(manifest, params, inputs):
+        print("Clustering results are up to date!")
+    else:
+        if args.update:
+            mmseqs2_cluster_update(COMBINED_FASTA_PATH, OUTPUT_DIR, DB_DIR, TMP_DIR, min_seq_id=args.min_seq_id,
+                                   coverage=args.coverage, mmseqs_bin=args.mmseqs_bin)
+        else:
+            mmseqs2_cluster(COMBINED_FASTA_PATH, OUTPUT_DIR, TMP_DIR, min_seq_id=args.min_seq_id,
+                            coverage=args.coverage, mmseqs_bin=args.mmseqs_bin)
+        outputs = describe_files([os.path.join(OUTPUT_DIR, CLUSTER_TSV_NAME)])
+        save_manifest(OUTPUT_DIR, {"params": params, "inputs": inputs, "outputs": outputs, "items": {}})
@@ -0,0 +1,122 @@
+import os
+import sys
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.compression import open_compressed, find_variant, remove_variants, CODECS, SUFFIXES
+from common.manifest import load_manifest, save_manifest, describe_files, stage_is_current
+from common.telemetry import track_stage, timed
+
+UNIQUE_FASTA_NAME = "unique_proteins.faa"
+DUPLICATES_NAME = "duplicates.tsv"
+
+
+def iter_fasta(fasta_path: str):
+    """
+    Stream records of a (possibly compressed) FASTA file.
+
+    Yields:
+    - (header, sequence): tuple, Header line (without ">") and sequence joined into a single line.
+    """
+    header = None
+    lines = []
+    with open_compressed(fasta_path, "r") as f:
+        for line in f:
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(lines)
+                header = line[1:].rstrip("\n")
+                lines = []
+            else:
+                lines.append(line.strip())
+    if header is not None:
+        yield header, "".join(lines)
+
+
+@timed
+def deduplicate_proteins(combined_fasta_path: str, output_dir: str, compression: str = "none", threads: int = 1):
+    """
+    Collapse byte-identical protein sequences before clustering.
+    The first occurrence of every sequence becomes its representative and is written to unique_proteins.faa;
+    the remaining occurrences are written to duplicates.tsv as "representative<TAB>member" lines,
+    grouped by representative (same layout as the MMseqs2 cluster TSV). Sequences without duplicates
+    are not listed, which keeps the map compact. An ID shared by several genomes (e.g. RefSeq WP_ accessions)
+    is written once and listed as a duplicate of itself for its other occurrences.
+
+    Parameters:
+    - combined_fasta_path: str, Path to the FASTA file with all sequences.
+    - output_dir: str, Directory for unique_proteins.faa and duplicates.tsv.
+    - compression: str, Codec of unique_proteins.faa (common.compression.CODECS).
+    - threads: int, Number of compression threads.
+
+    Returns:
+    - (num_sequences, num_unique): tuple, Number of all and of unique sequences.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    unique_path = os.path.join(output_dir, UNIQUE_FASTA_NAME + SUFFIXES[compression])
+    duplicates_path = os.path.join(output_dir, DUPLICATES_NAME)
+
+    representatives = {}  # Sequence digest -> representative ID
+    duplicates = {}  # Representative ID -> IDs of its duplicates
+    num_sequences = 0
+    # The temporary name keeps the codec suffix, so the file is written with the right codec.
+    unique_tmp = os.path.join(output_dir, "tmp_" + os.path.basename(unique_path))
+    with open_compressed(unique_tmp, "w", threads) as unique:
+        for header, sequence in iter_fasta(combined_fasta_path):
+            num_sequences += 1
+            prot_id = header.split(maxsplit=1)[0]
+            digest = hashlib.blake2b(sequence.encode(), digest_size=16).digest()
+            if digest not in representatives:
+                representatives[digest] = prot_id
+                unique.write(f">{header}\n{sequence}\n")
+            else:
+                duplicates.setdefault(representatives[digest], []).append(prot_id)
+
+    with open(duplicates_path + ".tmp", "w") as f:
+        for representative, members in duplicates.items():
+            for member in members:
+                f.write(f"{representative}\t{member}\n")
+    os.replace(unique_tmp, unique_path)
+    os.replace(duplicates_path + ".tmp", duplicates_path)
+    remove_variants(unique_path)
+    return num_sequences, len(representatives)
+
+
+def load_duplicates(duplicates_path: str) -> dict:
+    """
+    Load the representative -> duplicates map written by deduplicate_proteins.
+
+    Returns:
+    - duplicates: dict, Representative ID -> list of IDs of its duplicates (representative excluded).
+    """
+    duplicates = {}
+    with open(duplicates_path, "r") as f:
+        for line in f:
+            representative, member = line.rstrip("\n").split("\t")
+            duplicates.setdefault(representative, []).append(member)
+    return duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script for collapsing identical protein sequences before clustering.")
+    parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
+    parser.add_argument("--compression", choices=CODECS, default="none", help="Codec of the unique sequences file.")
+    parser.add_argument("--compression_threads", type=int, default=1, help="Number of compression threads.")
+    args = parser.parse_args()
+    track_stage("deduplication")
+
+    BASENAME = args.basename
+    COMBINED_FASTA_PATH = find_variant(os.path.join("data_preparation/data/combined_fasta", BASENAME, "combined_proteins.faa"))
+    OUTPUT_DIR = os.path.join("clustering/dedup_results", BASENAME)
+
+    manifest = load_manifest(OUTPUT_DIR)
+    inputs = describe_files([COMBINED_FASTA_PATH], manifest["inputs"])
+    params = {"compression": args.compression} if args.compression != "none" else {}
+    if stage_is_current(manifest, params, inputs):
+        print("Deduplicated sequences are up to date!")
+    else:
+        num_sequences, num_unique = deduplicate_proteins(COMBINED_FASTA_PATH, OUTPUT_DIR, args.compression, args.compression_threads)
+        print(f"Kept {num_unique} unique of {num_sequences} sequences ({num_sequences / max(num_unique, 1):.1f}x reduction).")
+        outputs = describe_files([os.path.join(OUTPUT_DIR, UNIQUE_FASTA_NAME + SUFFIXES[args.compression]), os.path.join(OUTPUT_DIR, DUPLICATES_NAME)])
+        save_manifest(OUTPUT_DIR, {"params": params, "inputs": inputs, "outputs": outputs, "items": {}})
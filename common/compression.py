@@ -0,0 +1,230 @@
+import io
+import os
+import gzip
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Compressed intermediates. The codec of a file is given by its suffix, so readers never need to be told
+# how a file was written. Streams are compressed in independent blocks (gzip members or zstd frames), which
+# concatenate into a valid file: blocks are compressed on several threads (zlib and zstd release the GIL),
+# and the output does not depend on the number of threads, so digests of compressed files stay stable.
+
+CODECS = ["none", "gzip", "zstd"]
+SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+LEVELS = {"gzip": 6, "zstd": 3}
+BLOCK_SIZE = 4 << 20
+TMPFS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None  # Decompressed copies for tools which need a seekable file
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The zstd codec requires the zstandard package (pip install zstandard).") from None
+    return zstandard
+
+
+def codec_of(path: str) -> str:
+    for codec, suffix in SUFFIXES.items():
+        if suffix and path.endswith(suffix):
+            return codec
+    return "none"
+
+
+def strip_codec(path: str) -> str:
+    """
+    Path without its codec suffix (e.g. X-aligned.fasta.gz -> X-aligned.fasta).
+    """
+    suffix = SUFFIXES[codec_of(path)]
+    return path[:len(path) - len(suffix)]
+
+
+def with_codec(path: str, codec: str) -> str:
+    return strip_codec(path) + SUFFIXES[codec]
+
+
+def find_variant(path: str) -> str:
+    """
+    The existing file among the codec variants of path (the most recently written one if there are several),
+    or path itself if none exists.
+    """
+    variants = [with_codec(path, codec) for codec in CODECS if os.path.exists(with_codec(path, codec))]
+    return max(variants, key=os.path.getmtime) if variants else path
+
+
+def remove_variants(path: str):
+    """
+    Remove the codec variants of path other than path itself (left behind by a run with another codec).
+    """
+    for codec in CODECS:
+        variant = with_codec(path, codec)
+        if variant != path and os.path.exists(variant):
+            os.remove(variant)
+
+
+def compress_bytes(data: bytes, codec: str, level: int = None) -> bytes:
+    if codec == "none":
+        return data
+    level = LEVELS[codec] if level is None else level
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return _zstd().ZstdCompressor(level=level).compress(data)
+
+
+def decompress_bytes(data: bytes, codec: str) -> bytes:
+    if codec == "none":
+        return data
+    if codec == "gzip":
+        return gzip.decompress(data)
+    reader = _zstd().ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+    return reader.read()
+
+
+def read_file(path: str) -> bytes:
+    """
+    Decompressed content of a (possibly compressed) file.
+    """
+    with open(path, "rb") as f:
+        return decompress_bytes(f.read(), codec_of(path))
+
+
+class CompressedWriter(io.RawIOBase):
+    """
+    Binary file writer compressing in blocks of BLOCK_SIZE, threads blocks at a time. Usable as the stdout of
+    common.scheduler.run_command (tool output is compressed as it is produced).
+    """
+
+    def __init__(self, path: str, codec: str = None, threads: int = 1, level: int = None):
+        self.codec = codec or codec_of(path)
+        self.level = level
+        self.file = open(path, "wb")
+        self.buffer = bytearray()
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.max_pending = 2 * threads
+        self.pending = []
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        if self.executor is None:
+            self.file.write(compress_bytes(block, self.codec, self.level))
+            return
+        self.pending.append(self.executor.submit(compress_bytes, block, self.codec, self.level))
+        while len(self.pending) >= self.max_pending:
+            self.file.write(self.pending.pop(0).result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or self.file.tell() == 0 and not self.pending:
+                self._submit(bytes(self.buffer))  # An empty stream is written as one (empty) block
+                self.buffer.clear()
+            for future in self.pending:
+                self.file.write(future.result())
+            self.pending = []
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.file.close()
+            super().close()
+
+
+def open_compressed(path: str, mode: str = "rb", threads: int = 1, level: int = None):
+    """
+    Open a file for reading or writing with the codec given by its suffix. Text modes ("r", "w", "rt", "wt")
+    return a text stream, binary modes ("rb", "wb") a binary one. threads is the number of compression threads.
+    """
+    codec = codec_of(path)
+    text = "b" not in mode
+    if mode.startswith("r"):
+        if codec == "none":
+            return open(path, "r" if text else "rb")
+        if codec == "gzip":
+            stream = gzip.open(path, "rb")
+        else:
+            stream = io.BufferedReader(_zstd().ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True))
+        return io.TextIOWrapper(stream) if text else stream
+    if codec == "none":
+        return open(path, "w" if text else "wb")
+    stream = io.BufferedWriter(CompressedWriter(path, codec, threads, level), buffer_size=1 << 20)
+    return io.TextIOWrapper(stream) if text else stream
+
+
+@contextmanager
+def decompressed_path(path: str):
+    """
+    Path of the decompressed content of path for tools which cannot read compressed files: path itself if it
+    is not compressed, otherwise a copy in memory-backed storage (tmpfs) removed afterwards.
+    """
+    if codec_of(path) == "none":
+        yield path
+        return
+    name = os.path.basename(strip_codec(path))
+    fd, tmp_path = tempfile.mkstemp(prefix="decompressed_", suffix=f"_{name}", dir=TMPFS_DIR)
+    try:
+        with open_compressed(path, "rb") as source, os.fdopen(fd, "wb") as target:
+            shutil.copyfileobj(source, target, 1 << 20)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+@contextmanager
+def streamed_path(path: str, native: tuple = ()):
+    """
+    Path under which a tool reading its input once, sequentially, gets the decompressed content of path:
+    path itself if it is uncompressed or in a codec the tool reads natively, otherwise a named pipe fed by
+    a decompressing thread (nothing decompressed is written to storage).
+    """
+    codec = codec_of(path)
+    if codec == "none" or codec in native:
+        yield path
+        return
+    tmp_dir = tempfile.mkdtemp(prefix="stream_")
+    fifo = os.path.join(tmp_dir, os.path.basename(strip_codec(path)))
+    os.mkfifo(fifo)
+    opened, abandoned = threading.Event(), threading.Event()
+    errors = []
+
+    def feed():
+        try:
+            with open_compressed(path, "rb") as source, open(fifo, "wb") as target:
+                opened.set()
+                while not abandoned.is_set():
+                    chunk = source.read(1 << 20)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+        except BrokenPipeError:
+            pass  # The tool stopped reading
+        except Exception as e:
+            errors.append(e)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        yield fifo
+    finally:
+        abandoned.set()
+        reader = None
+        if not opened.is_set():
+            # The tool never opened the pipe: open it here, so the feeder's open returns and it stops.
+            reader = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        feeder.join()
+        if reader is not None:
+            os.close(reader)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if errors:
+        raise errors[0]
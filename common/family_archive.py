@@ -0,0 +1,96 @@
+import os
+
+from common.compression import SUFFIXES, codec_of, compress_bytes, decompress_bytes, find_variant, remove_variants
+
+FAMILY_ARCHIVE_NAME = "families.fasta"
+FAMILY_INDEX_NAME = "families.idx"
+
+
+class FamilyArchiveWriter:
+    """
+    Writes protein families into a single container: all family FASTA contents concatenated into
+    one file plus a tab-separated index (family name, byte offset, length). Both files are written
+    under temporary names and moved into place on close.
+    With a compression codec every family is compressed on its own (the index holds compressed offsets
+    and lengths), so single families stay randomly accessible.
+    """
+
+    def __init__(self, output_dir:str, compression:str="none"):
+        self.compression = compression
+        self.archive_path = os.path.join(output_dir, FAMILY_ARCHIVE_NAME + SUFFIXES[compression])
+        self.index_path = os.path.join(output_dir, FAMILY_INDEX_NAME)
+        self.archive = open(self.archive_path + ".tmp", "wb")
+        self.index = open(self.index_path + ".tmp", "w")
+        self.offset = 0
+
+    def add(self, name:str, content):
+        data = content.encode() if isinstance(content, str) else content
+        data = compress_bytes(data, self.compression)
+        self.archive.write(data)
+        self.index.write(f"{name}\t{self.offset}\t{len(data)}\n")
+        self.offset += len(data)
+
+    def close(self):
+        self.archive.close()
+        self.index.close()
+        os.replace(self.archive_path + ".tmp", self.archive_path)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        remove_variants(self.archive_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.archive.close()
+            self.index.close()
+            os.remove(self.archive_path + ".tmp")
+            os.remove(self.index_path + ".tmp")
+
+
+def has_archive(family_dir:str)->bool:
+    return os.path.exists(os.path.join(family_dir, FAMILY_INDEX_NAME))
+
+
+def load_index(family_dir:str)->dict:
+    """
+    Load the index of a family archive.
+
+    Returns:
+    - index: dict, Family name -> (offset, length), in archive order.
+    """
+    index = {}
+    with open(os.path.join(family_dir, FAMILY_INDEX_NAME), "r") as f:
+        for line in f:
+            name, offset, length = line.rstrip("\n").split("\t")
+            index[name] = (int(offset), int(length))
+    return index
+
+
+def archive_path(family_dir:str)->str:
+    """
+    Path of the family archive in family_dir, whichever codec it was written with.
+    """
+    return find_variant(os.path.join(family_dir, FAMILY_ARCHIVE_NAME))
+
+
+def read_member(family_dir:str, offset:int, length:int)->bytes:
+    """
+    Random access read of a single family (decompressed) from the archive.
+    """
+    path = archive_path(family_dir)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return decompress_bytes(os.pread(fd, length, offset), codec_of(path))
+    finally:
+        os.close(fd)
+
+
+def remove_archive(family_dir:str):
+    remove_variants(os.path.join(family_dir, FAMILY_ARCHIVE_NAME))
+    for name in (FAMILY_ARCHIVE_NAME, FAMILY_INDEX_NAME):
+        path = os.path.join(family_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,77 @@
+import os
+import json
+
+
+LEDGER_NAME = "ledger.jsonl"
+
+
+def read_ledger(output_dir:str)->dict:
+    """
+    Read the completion ledger of an interrupted stage. Later records override earlier ones.
+
+    Returns:
+    - records: dict, Item name -> last ledger record.
+    """
+    records = {}
+    path = os.path.join(output_dir, LEDGER_NAME)
+    if not os.path.exists(path):
+        return records
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Truncated line left by a crash
+            records[record["item"]] = record
+    return records
+
+
+def resumable_items(output_dir:str, params:dict, digests:dict, is_valid)->dict:
+    """
+    Select items completed by an interrupted run: recorded as successful with the same parameters
+    and input digest, with outputs which exist and pass validation.
+
+    Parameters:
+    - output_dir: str, Directory with the ledger and item outputs.
+    - params: dict, Parameters of the current run.
+    - digests: dict, Item name -> digest of its current input.
+    - is_valid: callable, is_valid(path) -> bool, validates an output file.
+
+    Returns:
+    - items: dict, Item name -> manifest item.
+    """
+    items = {}
+    for name, record in read_ledger(output_dir).items():
+        if (
+            record["status"] == "Success"
+            and record["params"] == params
+            and digests.get(name) == record["input"]
+            and all(is_valid(os.path.join(output_dir, output)) for output in record["outputs"])
+        ):
+            items[name] = {"input": record["input"], "outputs": record["outputs"]}
+    return items
+
+
+def open_ledger(output_dir:str, resume:bool):
+    """
+    Open the ledger for appending. Without resume, records of earlier runs are discarded.
+    """
+    return open(os.path.join(output_dir, LEDGER_NAME), "a" if resume else "w")
+
+
+def append_record(ledger, record:dict):
+    """
+    Append a record and force it to disk, so it survives a crash of the node.
+    """
+    ledger.write(json.dumps(record) + "\n")
+    ledger.flush()
+    os.fsync(ledger.fileno())
+
+
+def remove_ledger(output_dir:str):
+    """
+    Remove the ledger once the stage completed and its manifest has been saved.
+    """
+    path = os.path.join(output_dir, LEDGER_NAME)
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_digest(path:str, chunk_size:int=1 << 20)->str:
+    """
+    Compute the SHA-256 digest of a file's content.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_entry(path:str, previous:dict=None)->dict:
+    """
+    Describe a file by content digest, size and modification time. The digest of a previous
+    entry is reused when size and modification time are unchanged, so large inputs are not
+    rehashed on every run.
+    """
+    stat = os.stat(path)
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return previous
+    return {"digest": file_digest(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_manifest(output_dir:str)->dict:
+    """
+    Load the manifest of a stage. Missing or unreadable manifests yield an empty one.
+
+    Manifest layout:
+    - params: dict, Parameters of the stage.
+    - inputs: dict, Input path -> file entry.
+    - outputs: dict, Output path -> file entry.
+    - items: dict, Item name (e.g. family) -> {"input": digest, "outputs": [file names]}.
+    """
+    manifest = {"params": {}, "inputs": {}, "outputs": {}, "items": {}}
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                manifest.update(json.load(f))
+        except (json.JSONDecodeError, OSError):
+            print(f"Ignoring unreadable manifest {path}")
+    return manifest
+
+
+def save_manifest(output_dir:str, manifest:dict):
+    """
+    Atomically write the manifest of a stage. It is the last thing a stage writes,
+    so its presence marks the stage as complete.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def describe_files(paths, previous:dict=None)->dict:
+    """
+    Build file entries for a list of paths, reusing digests from a previous description.
+    """
+    previous = previous or {}
+    return {path: file_entry(path, previous.get(path)) for path in paths}
+
+
+def files_intact(entries:dict)->bool:
+    """
+    Check that all described files still exist with the recorded size.
+    """
+    return all(os.path.exists(path) and os.path.getsize(path) == entry["size"] for path, entry in entries.items())
+
+
+def stage_is_current(manifest:dict, params:dict, inputs:dict, output_dir:str=None)->bool:
+    """
+    A stage is current when it ran with the same parameters on the same inputs
+    and all of its recorded outputs (and item outputs in output_dir) are still in place.
+    """
+    items_intact = output_dir is None or all(
+        os.path.exists(os.path.join(output_dir, output))
+        for item in manifest["items"].values() for output in item["outputs"]
+    )
+    return (
+        manifest["params"] == params
+        and {path: entry["digest"] for path, entry in manifest["inputs"].items()} == {path: entry["digest"] for path, entry in inputs.items()}
+        and files_intact(manifest["outputs"])
+        and items_intact
+    )
+
+
+def pending_items(manifest:dict, params:dict, item_digests:dict, output_dir:str)->list:
+    """
+    Select items which have to be (re)computed: items never computed, items whose input content
+    changed, items with missing outputs, or all items when the parameters changed.
+
+    Parameters:
+    - manifest: dict, Manifest of the previous run.
+    - params: dict, Parameters of the current run.
+    - item_digests: dict, Item name -> digest of its current input.
+    - output_dir: str, Directory with item outputs.
+
+    Returns:
+    - pending: list, Item names to compute.
+    """
+    if manifest["params"] != params:
+        return list(item_digests)
+
+    pending = []
+    for name, digest in item_digests.items():
+        item = manifest["items"].get(name)
+        if (
+            item is None
+            or item["input"] != digest
+            or not all(os.path.exists(os.path.join(output_dir, output)) for output in item["outputs"])
+        ):
+            pending.append(name)
+    return pending
+
+
+def remove_stale_items(manifest:dict, item_digests:dict, output_dir:str)->list:
+    """
+    Remove outputs of items which are recorded in the manifest but whose input no longer exists.
+    Outputs shared with a current item (e.g. the treefile of an alignment renamed by a codec change) are kept.
+
+    Returns:
+    - stale: list, Names of removed items.
+    """
+    stale = [name for name in manifest["items"] if name not in item_digests]
+    current = {output for name, item in manifest["items"].items() if name in item_digests for output in item["outputs"]}
+    for name in stale:
+        for output in manifest["items"].pop(name)["outputs"]:
+            output_path = os.path.join(output_dir, output)
+            if output not in current and os.path.exists(output_path):
+                os.remove(output_path)
+    return stale
@@ -0,0 +1,173 @@
+import os
+import json
+import shutil
+import hashlib
+import functools
+import threading
+
+
+def cache_key(tool:str, params:dict, content_digest:str)->str:
+    """
+    Content address of a result: hash of the tool, its parameters and the SHA-256 digest of the input.
+    """
+    header = json.dumps({"tool": tool, "params": params}, sort_keys=True)
+    return hashlib.sha256(f"{header}\n{content_digest}".encode()).hexdigest()
+
+
+def _tmp_name(destination:str)->str:
+    return f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _place(source:str, destination:str):
+    """
+    Put a copy of source at destination atomically. Files are copied, not hard linked: cache entries
+    get their modification time refreshed on hits, which must not touch the outputs placed from them.
+    """
+    tmp = _tmp_name(destination)
+    shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
+
+
+def _write(data:bytes, destination:str):
+    tmp = _tmp_name(destination)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, destination)
+
+
+class ResultCache:
+    """
+    Shared on-disk cache of alignments and trees, addressed by cache_key().
+    Entries are single files in cache_dir/<key[:2]>/<key>. The cache is kept under max_bytes by evicting
+    the least recently used entries (hits refresh the modification time). Safe to use from several threads
+    and from concurrent runs sharing the directory.
+    """
+
+    def __init__(self, cache_dir:str, max_bytes:int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    def __reduce__(self):
+        # Jobs sent to queue workers (common.work_queue) carry the cache by reference; every worker opens it once.
+        return (shared_result_cache, (self.cache_dir, self.max_bytes))
+
+    def _path(self, key:str)->str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _entries(self):
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Evicted by a concurrent run
+                yield stat.st_mtime, entry.path, stat.st_size
+
+    def get(self, key:str, destination:str)->bool:
+        """
+        Place the cached result for key at destination.
+
+        Returns:
+        - hit: bool, The result was in the cache.
+        """
+        path = self._path(key)
+        try:
+            _place(path, destination)
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def get_bytes(self, key:str):
+        """
+        Content of the cached result for key, or None if it is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key:str, source:str):
+        """
+        Store a result file under key and evict old entries if the cache grew over its limit.
+        """
+        self._store(key, lambda path: _place(source, path))
+
+    def put_bytes(self, key:str, data:bytes):
+        """
+        Store a result given by its content under key (see put).
+        """
+        self._store(key, lambda path: _write(data, path))
+
+    def _store(self, key:str, place):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        place(path)
+        with self._lock:
+            self.stores += 1
+            self._size += os.path.getsize(path)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the limit, so eviction does not run on every store.
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+        target = 0.9 * self.max_bytes
+        for _, path, size in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            self.evictions += 1
+
+    def summary(self)->str:
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0.0
+        return (f"Result cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), "
+                f"{self.stores} stored, {self.evictions} evicted, {self._size / 2**20:.1f} MiB in {self.cache_dir}")
+
+
+@functools.lru_cache(maxsize=None)
+def shared_result_cache(cache_dir:str, max_bytes:int)->ResultCache:
+    """
+    The ResultCache of this process for cache_dir, opened on first use.
+    """
+    return ResultCache(cache_dir, max_bytes)
+
+
+def open_result_cache(cache_dir:str, max_gb:float):
+    """
+    Open the result cache, or return None when no cache directory is configured.
+    """
+    if not cache_dir:
+        return None
+    return ResultCache(cache_dir, int(max_gb * 2**30))
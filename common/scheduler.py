@@ -0,0 +1,149 @@
+import io
+import os
+import time
+import shutil
+import threading
+import tempfile
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+
+from common.telemetry import record_tool
+
+
+def _timed(run, job, cores):
+    start = time.perf_counter()
+    result = run(job, cores)
+    return result, time.perf_counter() - start
+
+
+def run_command(command: list, stdout=subprocess.DEVNULL, input: bytes = None):
+    """
+    Run an external tool and measure the resources used by that child process alone
+    (os.wait4), which stays correct when several tools run concurrently.
+    Every run is recorded in the run report (common.telemetry), if one is enabled.
+
+    Parameters:
+    - command: list, Command to run.
+    - stdout: file object or subprocess.DEVNULL, Destination of the tool's standard output. Writable objects
+      without a file descriptor (e.g. a common.compression writer or io.BytesIO) are fed through a pipe.
+    - input: bytes, Data written to the tool's standard input.
+
+    Returns:
+    - returncode: int, Exit code of the tool.
+    - stderr: str, Standard error output of the tool.
+    - usage: dict, Exit code, wall time, user and system CPU time (seconds), peak RSS (KiB)
+      and bytes read from and written to storage.
+    """
+    sink = None
+    if stdout is not None and not isinstance(stdout, int):
+        try:
+            stdout.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            sink, stdout = stdout, subprocess.PIPE
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL, stdout=stdout, stderr=stderr)
+        reader = None
+        if sink is not None:
+            reader = threading.Thread(target=shutil.copyfileobj, args=(process.stdout, sink, 1 << 20))
+            reader.start()
+        if input is not None:
+            try:
+                process.stdin.write(input)
+            except BrokenPipeError:
+                pass
+            process.stdin.close()
+        if reader is not None:
+            reader.join()
+            process.stdout.close()
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        usage = {
+            "exit_code": process.returncode,
+            "wall_time": time.perf_counter() - start,
+            "user_time": rusage.ru_utime,
+            "sys_time": rusage.ru_stime,
+            "max_rss_kb": rusage.ru_maxrss,
+            "read_bytes": 512 * rusage.ru_inblock,
+            "write_bytes": 512 * rusage.ru_oublock,
+        }
+        record_tool(command, usage)
+        stderr.seek(0)
+        return process.returncode, stderr.read().decode(errors="replace"), usage
+
+
+def run_checked(command: list, stdout=subprocess.DEVNULL) -> dict:
+    """
+    run_command for tools whose failure stops the stage (like subprocess.run with check=True).
+    The tool's standard error is kept in the raised exception.
+
+    Returns:
+    - usage: dict, See run_command.
+
+    Raises:
+    - subprocess.CalledProcessError: The tool exited with a non-zero code.
+    """
+    returncode, stderr, usage = run_command(command, stdout=stdout)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+    return usage
+
+
+def run_scheduled(jobs, core_budget: int, run, cores_for, desc: str = "Running jobs", unit: str = "job", max_jobs: int = None, refill=None):
+    """
+    Run jobs which launch external multithreaded tools under a global CPU core budget.
+    Jobs are started in the given order (put the most expensive first). Each job gets its cores
+    when it is started, so cores released by finished jobs go to the jobs started next, and
+    small jobs are packed onto whatever cores remain free. Jobs run in threads, as they only
+    wait for their subprocess.
+
+    Jobs can also be added while running: if jobs is a deque, the caller may append follow-up jobs
+    to it (appendleft to run them next) whenever a completed job is yielded, and refill is called
+    to fetch new jobs whenever fewer jobs are pending than there are cores.
+
+    Parameters:
+    - jobs: list or deque, Jobs in priority order.
+    - core_budget: int, Number of CPU cores shared by all running jobs.
+    - run: callable, run(job, cores) -> result.
+    - cores_for: callable, cores_for(job, free_cores, num_pending) -> number of cores the job should get.
+    - desc: str, Progress bar description.
+    - unit: str, Progress bar unit.
+    - max_jobs: int, Maximum number of jobs running at once (default: core_budget).
+    - refill: callable, refill() -> list of new jobs; an empty list means it has no more jobs.
+
+    Yields:
+    - (job, cores, result, wall_time): tuple, As soon as each job completes.
+    """
+    core_budget = max(1, core_budget)
+    max_jobs = max(1, min(max_jobs or core_budget, core_budget))
+    pending = jobs if isinstance(jobs, deque) else deque(jobs)
+    running = {}
+    free = core_budget
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor, tqdm(total=len(pending), desc=desc, unit=unit) as progress:
+        while True:
+            # Keep at least a budget's worth of jobs pending, so cores_for sees a realistic queue.
+            while refill is not None and len(pending) < core_budget:
+                new_jobs = refill()
+                if not new_jobs:
+                    refill = None
+                pending.extend(new_jobs)
+            progress.total = progress.n + len(running) + len(pending)
+            progress.refresh()
+
+            while pending and free > 0 and len(running) < max_jobs:
+                job = pending.popleft()
+                cores = max(1, min(free, cores_for(job, free, len(pending) + 1)))
+                free -= cores
+                running[executor.submit(_timed, run, job, cores)] = (job, cores)
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, cores = running.pop(future)
+                free += cores
+                result, wall_time = future.result()
+                progress.update(1)
+                yield job, cores, result, wall_time
@@ -0,0 +1,183 @@
+import os
+import mmap
+import shutil
+import pickle
+import sqlite3
+import argparse
+
+
+STORE_DIRNAME = "genome_store"
+SEQUENCES_NAME = "sequences.bin"
+INDEX_NAME = "index.sqlite"
+LOOKUP_BATCH_SIZE = 900  # Stay below the SQLite limit of bound variables per statement.
+
+
+class SequenceStoreWriter:
+    """
+    Builds an on-disk sequence store: all protein sequences are appended to one blob file and
+    an SQLite index maps protein IDs to (genome code, offset, length). Genome IDs and names
+    are interned as small integer codes. The store is built in a temporary directory and moved
+    into place on close, so readers never see a half-written store.
+    """
+
+    def __init__(self, store_dir:str, batch_size:int=100_000):
+        self.store_dir = store_dir
+        self.tmp_dir = store_dir + ".tmp"
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+
+        self.blob = open(os.path.join(self.tmp_dir, SEQUENCES_NAME), "wb")
+        self.offset = 0
+        self.db = sqlite3.connect(os.path.join(self.tmp_dir, INDEX_NAME))
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE genomes (code INTEGER PRIMARY KEY, genome_id TEXT NOT NULL UNIQUE, genome_name TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE proteins (prot_id TEXT PRIMARY KEY, genome INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL) WITHOUT ROWID")
+        self.genome_codes = {}
+        self.batch = []
+        self.batch_size = batch_size
+
+    def genome_code(self, genome_id:str, genome_name:str)->int:
+        """Return the integer code of a genome, registering it on first use."""
+        code = self.genome_codes.get(genome_id)
+        if code is None:
+            code = len(self.genome_codes)
+            self.genome_codes[genome_id] = code
+            self.db.execute("INSERT INTO genomes VALUES (?, ?, ?)", (code, genome_id, genome_name))
+        return code
+
+    def add(self, prot_id:str, genome_code:int, sequence:str):
+        """Append a protein sequence. A repeated protein ID overrides the previous entry."""
+        data = sequence.encode()
+        self.blob.write(data)
+        self.batch.append((prot_id, genome_code, self.offset, len(data)))
+        self.offset += len(data)
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO proteins VALUES (?, ?, ?, ?)", self.batch)
+        self.batch = []
+
+    def close(self):
+        self._flush()
+        self.db.commit()
+        self.db.close()
+        self.blob.close()
+        if os.path.exists(self.store_dir):
+            shutil.rmtree(self.store_dir)
+        os.replace(self.tmp_dir, self.store_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.db.close()
+            self.blob.close()
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class SequenceStore:
+    """
+    Read-only, random-access view of a sequence store. Sequences are sliced lazily from the
+    memory-mapped blob, so only the sequences which are actually requested are read.
+    """
+
+    def __init__(self, store_dir:str):
+        self.store_dir = store_dir
+        self.db = sqlite3.connect(f"file:{os.path.join(store_dir, INDEX_NAME)}?mode=ro", uri=True)
+        self.blob_file = open(os.path.join(store_dir, SEQUENCES_NAME), "rb")
+        size = os.fstat(self.blob_file.fileno()).st_size
+        self.blob = mmap.mmap(self.blob_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+        self.genome_ids = []
+        self.genome_names = []
+        for _, genome_id, genome_name in self.db.execute("SELECT code, genome_id, genome_name FROM genomes ORDER BY code"):
+            self.genome_ids.append(genome_id)
+            self.genome_names.append(genome_name)
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM proteins").fetchone()[0]
+
+    @property
+    def num_genomes(self)->int:
+        return len(self.genome_ids)
+
+    def lookup(self, prot_ids)->dict:
+        """
+        Batch lookup of protein IDs.
+
+        Returns:
+        - entries: dict, Protein ID -> (genome code, offset, length). Unknown IDs are omitted.
+        """
+        prot_ids = list(prot_ids)
+        entries = {}
+        for start in range(0, len(prot_ids), LOOKUP_BATCH_SIZE):
+            batch = prot_ids[start:start + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            query = f"SELECT prot_id, genome, offset, length FROM proteins WHERE prot_id IN ({placeholders})"
+            for prot_id, genome, offset, length in self.db.execute(query, batch):
+                entries[prot_id] = (genome, offset, length)
+        return entries
+
+    def read(self, offset:int, length:int)->str:
+        """Read a sequence from the blob."""
+        return self.blob[offset:offset + length].decode()
+
+    def sequence(self, prot_id:str)->str:
+        entry = self.lookup([prot_id]).get(prot_id)
+        if entry is None:
+            raise KeyError(prot_id)
+        return self.read(entry[1], entry[2])
+
+    def close(self):
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self.blob_file.close()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def migrate_genome_map(pickle_path:str, store_dir:str):
+    """
+    Convert a pickled genome map (Sequence ID -> (Genome ID, Genome name, sequence)) into a sequence store.
+    """
+    print(f"Migrating {pickle_path} to sequence store {store_dir}")
+    with open(pickle_path, "rb") as f:
+        genome_map = pickle.load(f)
+
+    with SequenceStoreWriter(store_dir) as writer:
+        for prot_id, (genome_id, genome_name, sequence) in genome_map.items():
+            writer.add(prot_id, writer.genome_code(genome_id, genome_name), sequence)
+    print(f"Migrated {len(genome_map)} sequences.")
+
+
+def open_sequence_store(maps_dir:str)->SequenceStore:
+    """
+    Open the sequence store of a dataset. Maps directories created before the store existed
+    (only genome_map.pkl present) are migrated on first use.
+    """
+    store_dir = os.path.join(maps_dir, STORE_DIRNAME)
+    pickle_path = os.path.join(maps_dir, "genome_map.pkl")
+    if not os.path.exists(store_dir) and os.path.exists(pickle_path):
+        migrate_genome_map(pickle_path, store_dir)
+    return SequenceStore(store_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script for migrating pickled genome maps to the on-disk sequence store.")
+    parser.add_argument("--genome_map", required=True, help="Path to a genome_map.pkl file.")
+    parser.add_argument("--store_dir", default=None, help="Output store directory. Defaults to genome_store next to the pickle.")
+    args = parser.parse_args()
+
+    STORE_DIR = args.store_dir or os.path.join(os.path.dirname(args.genome_map), STORE_DIRNAME)
+    migrate_genome_map(args.genome_map, STORE_DIR)
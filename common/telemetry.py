@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import argparse
+import functools
+import inspect
+import threading
+from contextlib import contextmanager
+from multiprocessing import util
+
+REPORT_ENV = "RUN_REPORT"  # Path of the JSONL run report; telemetry is disabled when it is not set.
+SUMMARY_COLUMNS = ["kind", "name", "calls", "wall_time_s", "user_time_s", "sys_time_s", "max_rss_kb", "read_bytes", "write_bytes"]
+
+_stages = []  # Names of the open stages of this process (innermost last)
+
+
+def report_path():
+    return os.environ.get(REPORT_ENV) or None
+
+
+def _write(record: dict):
+    """
+    Append one record to the run report. Every record is a single write to a file opened with O_APPEND,
+    so records of concurrent threads and processes (stages, tool runs, pool workers) never interleave.
+    """
+    path = report_path()
+    if path is None:
+        return
+    record = {"time": time.time(), "script": os.path.basename(sys.argv[0]), "pid": os.getpid(), **record}
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+def _io_counters() -> dict:
+    """
+    Bytes read and written by this process, its threads and its reaped children (/proc/self/io).
+    Falls back to block I/O counts from rusage where /proc is not available.
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(":") for line in f)
+        return {"read_bytes": int(counters["rchar"]), "write_bytes": int(counters["wchar"])}
+    except (OSError, KeyError, ValueError):
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {"read_bytes": 512 * (own.ru_inblock + children.ru_inblock), "write_bytes": 512 * (own.ru_oublock + children.ru_oublock)}
+
+
+def _snapshot() -> dict:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "wall_time": time.perf_counter(),
+        "user_time": own.ru_utime + children.ru_utime,
+        "sys_time": own.ru_stime + children.ru_stime,
+        "max_rss_kb": own.ru_maxrss,
+        "children_max_rss_kb": children.ru_maxrss,
+        **_io_counters(),
+    }
+
+
+def _stage_record(name: str, start: dict, **fields) -> dict:
+    end = _snapshot()
+    record = {"type": "stage", "name": name, "parent": _stages[-2] if len(_stages) > 1 else None}
+    for key in ("wall_time", "user_time", "sys_time", "read_bytes", "write_bytes"):
+        record[key] = end[key] - start[key]
+    # Peak RSS is only known per process lifetime: of this process and of the largest reaped child so far.
+    record["max_rss_kb"] = end["max_rss_kb"]
+    record["children_max_rss_kb"] = end["children_max_rss_kb"]
+    record.update(fields)
+    return record
+
+
+@contextmanager
+def stage(name: str, **fields):
+    """
+    Measure a block as a stage: wall time, user and system CPU time (including threads and reaped child
+    processes, i.e. pool workers and external tools), peak RSS (of the process and of its children) and bytes
+    read and written.
+    Tool runs inside the block are attributed to the stage. Extra fields are copied into the record.
+    """
+    if report_path() is None:
+        yield
+        return
+    _stages.append(name)
+    start = _snapshot()
+    status = "Success"
+    try:
+        yield
+    except BaseException as e:
+        status = f"Failed: {type(e).__name__}"
+        raise
+    finally:
+        _write(_stage_record(name, start, status=status, **fields))
+        _stages.pop()
+
+
+def track_stage(name: str, **fields):
+    """
+    Measure the rest of the running script as a stage, recorded when the interpreter exits
+    (also after sys.exit, e.g. when the stage is up to date).
+    """
+    if report_path() is None:
+        return
+    _stages.append(name)
+    start = _snapshot()
+    atexit.register(lambda: _write(_stage_record(name, start, **fields)))
+
+
+def record_tool(command: list, usage: dict):
+    """
+    Record one external tool run (usage as returned by common.scheduler.run_command).
+    The tool is named by its executable and, if it has one, its subcommand or script (e.g. "mmseqs createdb").
+    """
+    if report_path() is None:
+        return
+    tool = os.path.basename(str(command[0]))
+    if len(command) > 1 and not str(command[1]).startswith("-"):
+        tool = f"{tool} {os.path.basename(str(command[1]))}"
+    _write({"type": "tool", "name": tool, "stage": _stages[-1] if _stages else None, **usage})
+
+
+class _FunctionTimes(dict):
+    """
+    Name -> [calls, wall time, CPU time] of timed functions in this process, written to the report
+    when the process exits (pool workers included).
+    """
+
+    def flush(self):
+        for name, (calls, wall_time, cpu_time) in sorted(self.items()):
+            _write({"type": "function", "name": name, "stage": _stages[-1] if _stages else None,
+                    "calls": calls, "wall_time": wall_time, "cpu_time": cpu_time})
+        self.clear()
+
+
+_function_times = _FunctionTimes()
+_function_lock = threading.Lock()
+
+
+def _register_flush(times: _FunctionTimes):
+    times.clear()  # A forked worker starts without the totals of its parent.
+    util.Finalize(None, times.flush, exitpriority=10)
+
+
+util.Finalize(None, _function_times.flush, exitpriority=10)
+util.register_after_fork(_function_times, _register_flush)
+
+
+def _add_time(name: str, wall_time: float, cpu_time: float, calls: int = 1):
+    with _function_lock:
+        totals = _function_times.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += calls
+        totals[1] += wall_time
+        totals[2] += cpu_time
+
+
+def timed(func):
+    """
+    Decorator for Python hot spots: calls, total wall time and CPU time (of the calling thread) are
+    aggregated per process and recorded at exit. For generator functions the time spent producing
+    items is measured. Functions are left undecorated when telemetry is disabled.
+    """
+    if report_path() is None:
+        return func
+    module = func.__module__.rpartition(".")[2]
+    if module == "__main__":
+        module = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    name = f"{module}.{func.__qualname__}"
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            wall_time = cpu_time = 0.0
+            iterator = func(*args, **kwargs)
+            try:
+                while True:
+                    start, start_cpu = time.perf_counter(), time.thread_time()
+                    try:
+                        item = next(iterator)
+                    finally:
+                        wall_time += time.perf_counter() - start
+                        cpu_time += time.thread_time() - start_cpu
+                    yield item
+            except StopIteration:
+                return
+            finally:
+                _add_time(name, wall_time, cpu_time)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _add_time(name, time.perf_counter() - start, time.thread_time() - start_cpu)
+    return wrapper
+
+
+def read_report(path: str) -> list:
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # Truncated line left by an interrupted run
+    return records
+
+
+def summarize(records: list) -> list:
+    """
+    Aggregate report records by kind (stage, tool, function) and name.
+
+    Returns:
+    - rows: list, One dict per (kind, name) with the columns of SUMMARY_COLUMNS; stages, then tools, then functions,
+      each in order of first appearance.
+    """
+    rows = {}
+    for record in records:
+        key = (record["type"], record["name"])
+        row = rows.setdefault(key, {"kind": record["type"], "name": record["name"], "calls": 0, "wall_time_s": 0.0, "user_time_s": 0.0,
+                                    "sys_time_s": 0.0, "max_rss_kb": 0, "read_bytes": 0, "write_bytes": 0})
+        row["calls"] += record.get("calls", 1)
+        row["wall_time_s"] += record.get("wall_time", 0.0)
+        # Functions only know their CPU time, it is reported as user time.
+        row["user_time_s"] += record.get("user_time", record.get("cpu_time", 0.0))
+        row["sys_time_s"] += record.get("sys_time", 0.0)
+        row["max_rss_kb"] = max(row["max_rss_kb"], record.get("max_rss_kb", 0))
+        row["read_bytes"] += record.get("read_bytes", 0)
+        row["write_bytes"] += record.get("write_bytes", 0)
+    order = {"stage": 0, "tool": 1, "function": 2}
+    return sorted(rows.values(), key=lambda row: order.get(row["kind"], len(order)))
+
+
+def write_summary(rows: list, path: str):
+    with open(path + ".tmp", "w") as f:
+        f.write("\t".join(SUMMARY_COLUMNS) + "\n")
+        for row in rows:
+            f.write(f"{row['kind']}\t{row['name']}\t{row['calls']}\t{row['wall_time_s']:.3f}\t{row['user_time_s']:.3f}\t"
+                    f"{row['sys_time_s']:.3f}\t{row['max_rss_kb']}\t{row['read_bytes']}\t{row['write_bytes']}\n")
+    os.replace(path + ".tmp", path)
+
+
+def print_summary(rows: list, baseline: list = None):
+    """
+    Print the summary table. With a baseline (summary rows of an earlier run), the wall time change
+    of every row present in both runs is shown.
+    """
+    previous = {(row["kind"], row["name"]): row for row in baseline or []}
+    print(f"{'kind':<9} {'name':<40} {'calls':>7} {'wall s':>10} {'user s':>10} {'sys s':>8} {'max RSS MB':>10} {'read MB':>9} {'write MB':>9}"
+          + (f" {'wall vs baseline':>16}" if baseline else ""))
+    for row in rows:
+        line = (f"{row['kind']:<9} {row['name'][:40]:<40} {row['calls']:>7} {row['wall_time_s']:>10.2f} {row['user_time_s']:>10.2f} "
+                f"{row['sys_time_s']:>8.2f} {row['max_rss_kb'] / 1024:>10.1f} {row['read_bytes'] / 2**20:>9.1f} {row['write_bytes'] / 2**20:>9.1f}")
+        before = previous.get((row["kind"], row["name"]))
+        if before is not None and before["wall_time_s"] > 0:
+            line += f" {100 * (row['wall_time_s'] / before['wall_time_s'] - 1):>+15.1f}%"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script for summarizing a run report (stages, external tools and timed functions).")
+    parser.add_argument("--report", required=True, help="JSONL run report written by the pipeline scripts.")
+    parser.add_argument("--baseline", default=None, help="Run report of an earlier run to compare wall times with.")
+    parser.add_argument("--output", default=None, help="Path of the summary table (default: report path with .summary.tsv).")
+    args = parser.parse_args()
+
+    rows = summarize(read_report(args.report))
+    baseline = summarize(read_report(args.baseline)) if args.baseline else None
+    print_summary(rows, baseline)
+    output = args.output or f"{os.path.splitext(args.report)[0]}.summary.tsv"
+    write_summary(rows, output)
+    print(f"Summary saved to {output}")
@@ -0,0 +1,304 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import importlib
+import threading
+import traceback
+from collections import deque
+from multiprocessing.managers import BaseManager
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.scheduler import run_scheduled
+
+# Distributed executor for the MSA and tree stages. The stage script is the coordinator: it serves a job
+# queue over TCP (multiprocessing.managers) and collects the results, while workers on any number of nodes
+# lease jobs, run them with their own core budget (common.scheduler.run_scheduled) and send back the results.
+# Jobs only carry paths, so coordinator and workers must run in the same pipeline directory on a shared filesystem.
+
+DEFAULT_ADDRESS = "0.0.0.0:50000"
+LEASE_TIMEOUT = 60.0  # Seconds without a heartbeat after which a worker counts as lost and its jobs are re-queued
+MAX_ATTEMPTS = 3      # Number of lost leases after which a job fails the stage
+POLL_INTERVAL = 1.0
+
+
+def parse_address(address: str):
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def task_reference(func) -> str:
+    """
+    Importable "module:function" name of a task. Functions of a script run as __main__ are named
+    by the script's path relative to the pipeline directory (e.g. allignment.allign).
+    """
+    module = func.__module__
+    if module == "__main__":
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        path = os.path.relpath(os.path.abspath(sys.modules["__main__"].__file__), root)
+        module = os.path.splitext(path)[0].replace(os.sep, ".")
+    return f"{module}:{func.__qualname__}"
+
+
+_tasks = {}
+
+
+def resolve_task(reference: str):
+    if reference not in _tasks:
+        module, _, name = reference.partition(":")
+        _tasks[reference] = getattr(importlib.import_module(module), name)
+    return _tasks[reference]
+
+
+class JobQueue:
+    """
+    Jobs of the coordinator with their leases. Workers lease one job at a time and renew all their leases
+    with heartbeats; leases of a worker which stops sending heartbeats expire and its jobs are re-queued
+    (at the front, as they were started first). A result is accepted once, whichever lease delivers it.
+    """
+
+    def __init__(self, lease_timeout: float = LEASE_TIMEOUT, max_attempts: int = MAX_ATTEMPTS):
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._token = os.urandom(4).hex()  # Job IDs of earlier coordinators are never mistaken for current ones
+        self._count = 0
+        self._condition = threading.Condition()
+        self._pending = deque()
+        self._jobs = {}       # job ID -> (item, attempts) of jobs without a result
+        self._leases = {}     # job ID -> (worker, deadline)
+        self._heartbeats = {} # worker -> time of the last heartbeat
+        self._results = []
+        self._lost = []
+
+    # Coordinator side
+
+    def submit(self, items: list) -> list:
+        with self._condition:
+            ids = []
+            for item in items:
+                job_id = f"{self._token}-{self._count}"
+                self._count += 1
+                self._jobs[job_id] = (item, 0)
+                self._pending.append(job_id)
+                ids.append(job_id)
+            return ids
+
+    def collect(self, timeout: float):
+        """
+        Wait up to timeout for results and re-queue jobs of lost workers.
+
+        Returns:
+        - results: list, (job ID, worker, cores, result, wall_time, error) of completed jobs.
+        - lost: list, (worker, job IDs) of workers whose leases expired since the last call.
+        """
+        with self._condition:
+            if not self._results:
+                self._condition.wait(timeout)
+            self._expire()
+            results, self._results = self._results, []
+            lost, self._lost = self._lost, []
+            return results, lost
+
+    def num_workers(self) -> int:
+        with self._condition:
+            now = time.monotonic()
+            return sum(now - last < self.lease_timeout for last in self._heartbeats.values())
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = {}
+        for job_id, (worker, deadline) in list(self._leases.items()):
+            if deadline < now:
+                del self._leases[job_id]
+                expired.setdefault(worker, []).append(job_id)
+        for worker, job_ids in expired.items():
+            for job_id in reversed(job_ids):
+                item, attempts = self._jobs[job_id]
+                self._jobs[job_id] = (item, attempts + 1)
+                if attempts + 1 >= self.max_attempts:
+                    self._results.append((job_id, worker, 0, None, 0.0, f"Lease lost {attempts + 1} times (last worker: {worker})"))
+                    del self._jobs[job_id]
+                else:
+                    self._pending.appendleft(job_id)
+            self._heartbeats.pop(worker, None)
+            self._lost.append((worker, job_ids))
+
+    # Worker side (called through the manager)
+
+    def lease(self, worker: str):
+        """
+        Returns:
+        - (job ID, item): tuple, or None when no job is waiting.
+        """
+        with self._condition:
+            self._heartbeats[worker] = time.monotonic()
+            while self._pending:
+                job_id = self._pending.popleft()
+                if job_id in self._jobs:  # Not completed by an expired lease in the meantime
+                    self._leases[job_id] = (worker, time.monotonic() + self.lease_timeout)
+                    return job_id, self._jobs[job_id][0]
+            return None
+
+    def heartbeat(self, worker: str):
+        with self._condition:
+            now = time.monotonic()
+            self._heartbeats[worker] = now
+            for job_id, (holder, _) in self._leases.items():
+                if holder == worker:
+                    self._leases[job_id] = (worker, now + self.lease_timeout)
+            return self.lease_timeout / 4
+
+    def complete(self, worker: str, job_id: str, cores: int, result, wall_time: float, error: str = None):
+        with self._condition:
+            self._leases.pop(job_id, None)
+            if self._jobs.pop(job_id, None) is None:
+                return  # Unknown or already completed
+            self._results.append((job_id, worker, cores, result, wall_time, error))
+            self._condition.notify_all()
+
+
+class _QueueManager(BaseManager):
+    pass
+
+
+_QueueManager.register("job_queue")
+
+
+class WorkQueue:
+    """
+    Coordinator of a stage: serves a JobQueue at address (host:port, host 0.0.0.0 for all interfaces)
+    to workers authenticated with authkey. The server runs in a thread for the lifetime of the script,
+    so the stages run by one script (ortologs, paralogs) share it.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, authkey: str = None, lease_timeout: float = LEASE_TIMEOUT):
+        self.address = address
+        self.jobs = JobQueue(lease_timeout)
+
+        class CoordinatorManager(_QueueManager):
+            pass
+        CoordinatorManager.register("job_queue", callable=lambda: self.jobs, exposed=("lease", "heartbeat", "complete"))
+        self._server = CoordinatorManager(address=parse_address(address), authkey=authkey.encode()).get_server()
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Work queue listening on {address}; start workers with: python3 common/work_queue.py --address <host>:{parse_address(address)[1]} --authkey <key>")
+
+
+def open_work_queue(executor: str, address: str = DEFAULT_ADDRESS, authkey: str = None):
+    """
+    Open the coordinator for the "queue" executor, or return None for the local core-budget scheduler.
+    """
+    if executor != "queue":
+        return None
+    if not authkey:
+        raise ValueError("The queue executor requires an authkey shared with the workers.")
+    return WorkQueue(address, authkey)
+
+
+def run_queued(jobs, work_queue: WorkQueue, run, cores_for, desc: str = "Running jobs", unit: str = "job"):
+    """
+    Distributed counterpart of common.scheduler.run_scheduled: jobs are run by queue workers instead of local threads.
+    run and cores_for must be module-level functions and jobs picklable, as both are sent to the workers;
+    each worker sizes jobs with cores_for against its own core budget.
+
+    Yields:
+    - (job, cores, result, wall_time): tuple, As soon as each job completes (in any order).
+
+    Raises:
+    - RuntimeError: A job raised an exception on a worker or lost its lease too many times.
+    """
+    run_reference, cores_reference = task_reference(run), task_reference(cores_for)
+    jobs = list(jobs)
+    ids = work_queue.jobs.submit([{"run": run_reference, "cores_for": cores_reference, "job": job} for job in jobs])
+    by_id = dict(zip(ids, jobs))
+    with tqdm(total=len(ids), desc=desc, unit=unit) as progress:
+        while by_id:
+            results, lost = work_queue.jobs.collect(POLL_INTERVAL)
+            for worker, job_ids in lost:
+                tqdm.write(f"Worker {worker} lost, re-queued {len(job_ids)} job(s).")
+            for job_id, worker, cores, result, wall_time, error in results:
+                job = by_id.pop(job_id, None)
+                if job is None:
+                    continue
+                if error is not None:
+                    raise RuntimeError(f"Queued job {job_id} failed on {worker}: {error}")
+                progress.update(1)
+                yield job, cores, result, wall_time
+            progress.set_postfix(workers=work_queue.jobs.num_workers(), refresh=True)
+
+
+def _connect(address: str, authkey: str):
+    manager = _QueueManager(address=parse_address(address), authkey=authkey.encode())
+    manager.connect()
+    return manager.job_queue()
+
+
+def _run_item(item: dict, cores: int):
+    try:
+        return resolve_task(item["run"])(item["job"], cores), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _item_cores(item: dict, free_cores: int, num_pending: int) -> int:
+    return resolve_task(item["cores_for"])(item["job"], free_cores, num_pending)
+
+
+def _send_heartbeats(address: str, authkey: str, worker: str, stop: threading.Event):
+    queue, interval = None, POLL_INTERVAL
+    while not stop.wait(interval):
+        try:
+            queue = queue or _connect(address, authkey)
+            interval = queue.heartbeat(worker)
+        except (OSError, EOFError):
+            queue, interval = None, POLL_INTERVAL  # Coordinator gone; the worker loop reconnects
+
+
+def run_worker(address: str, authkey: str, cores: int, idle_timeout: float = None):
+    """
+    Lease and run jobs from the coordinator at address on a budget of cores until idle_timeout seconds pass
+    without a job (forever if None). Workers survive coordinator restarts, so one set of workers serves
+    the alignment and the tree stage.
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+    threading.Thread(target=_send_heartbeats, args=(address, authkey, worker, stop), daemon=True).start()
+    queue = None
+    idle_since = time.monotonic()
+    print(f"Worker {worker} serving {address} with {cores} core(s).")
+    try:
+        while idle_timeout is None or time.monotonic() - idle_since < idle_timeout:
+            try:
+                queue = queue or _connect(address, authkey)
+                leased = queue.lease(worker)
+                if leased is None:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+
+                def refill():
+                    # Non-blocking: once the queue is empty, the running jobs finish and the worker polls again.
+                    next_lease = queue.lease(worker)
+                    return [] if next_lease is None else [dict(next_lease[1], id=next_lease[0])]
+
+                jobs = deque([dict(leased[1], id=leased[0])])
+                for item, used_cores, (result, error), wall_time in run_scheduled(jobs, cores, _run_item, _item_cores, desc="Running queued jobs", unit="job", refill=refill):
+                    queue.complete(worker, item["id"], used_cores, result, wall_time, error)
+                idle_since = time.monotonic()
+            except (OSError, EOFError):
+                queue = None  # No coordinator (yet); leases of unfinished jobs expire there and are re-queued
+                time.sleep(POLL_INTERVAL)
+    finally:
+        stop.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker of the distributed executor: runs MSA and tree jobs leased from a coordinator (allign.py or make_trees.py with --executor queue).")
+    parser.add_argument("--address", required=True, help="Address of the coordinator (host:port).")
+    parser.add_argument("--authkey", default=os.environ.get("WORK_QUEUE_AUTHKEY"), help="Key shared with the coordinator (default: $WORK_QUEUE_AUTHKEY).")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Number of CPU cores shared by the jobs of this worker.")
+    parser.add_argument("--idle_timeout", type=float, default=None, help="Exit after this many seconds without jobs (default: never).")
+    args = parser.parse_args()
+    if not args.authkey:
+        parser.error("an authkey is required (--authkey or $WORK_QUEUE_AUTHKEY)")
+    run_worker(args.address, args.authkey, args.cores, args.idle_timeout)
@@ -1,83 +1,302 @@
 import os
+import sys
+import json
+import time
 import zipfile
 import pickle
 import subprocess
+import shutil
 import argparse
-from Bio import SeqIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.compression import CompressedWriter, CODECS, SUFFIXES, remove_variants
+from common.sequence_store import SequenceStoreWriter, STORE_DIRNAME, SEQUENCES_NAME, INDEX_NAME
+from common.manifest import load_manifest, save_manifest, describe_files, stage_is_current
+from common.scheduler import run_checked
+from common.telemetry import stage, track_stage, timed
 
-def fetch_proteomes_ncbi_datasets(accession_file, output_dir):
+
+DOWNLOAD_JOURNAL_NAME = "download_journal.jsonl"
+COMBINED_FASTA_NAME = "combined_proteins.faa"
+
+
+def read_accessions(accession_file):
     """
-    Fetch proteomes from NCBI using the Datasets CLI for given Assembly Accessions.
+    Read Assembly Accessions and optional descriptions from an accession file.
 
     Parameters:
     - accession_file: str, Path to a text file containing Assembly Accessions.
-    - output_dir: str, Directory to save the downloaded proteomes.
-    """
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
 
+    Returns:
+    - accessions: list, (accession, description) tuples in file order.
+    """
+    accessions = []
     with open(accession_file, "r") as f:
         for line in f:
+            if not line.strip():
+                continue
             # Parse Assembly Accession and optional description
             parts = line.strip().split(";")
             accession = parts[0].strip()
             description = parts[1].strip() if len(parts) > 1 else "Unknown organism"
+            accessions.append((accession, description))
+    return accessions
 
-            print(f"Fetching proteome for accession: {accession} ({description})")
 
+def is_valid_archive(zip_path:str)->bool:
+    """
+    Check that a downloaded archive is a readable zip file with intact members (CRC check).
+    """
+    try:
+        with zipfile.ZipFile(zip_path, "r") as z:
+            return z.testzip() is None
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+
+def load_download_journal(journal_path:str)->dict:
+    """
+    Load the per-accession download journal. Later records override earlier ones.
+
+    Returns:
+    - journal: dict, Accession -> last journal record.
+    """
+    journal = {}
+    if not os.path.exists(journal_path):
+        return journal
+    with open(journal_path, "r") as f:
+        for line in f:
             try:
-                # Construct a command
-                output_file = os.path.join(output_dir, f"{accession}.zip")
-                command = [
-                    "datasets", "download", "genome",
-                    "accession", accession,
-                    "--include", "protein",
-                    "--filename", output_file
-                ]
-                
-                # Execute the command
-                subprocess.run(command, check=True)
-                print(f"Saved proteome archive to {output_file}")
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Truncated line left by an interrupted run
+            journal[record["accession"]] = record
+    return journal
+
+
+def archive_is_complete(archive_path:str, record)->bool:
+    """
+    Decide whether an archive can be reused. Archives recorded as done with an unchanged
+    size are trusted, anything else (e.g. archives from runs without a journal) is verified.
+    """
+    if not os.path.exists(archive_path):
+        return False
+    if record and record.get("status") == "done" and record.get("size") == os.path.getsize(archive_path):
+        return True
+    return is_valid_archive(archive_path)
 
-            except subprocess.CalledProcessError as e:
-                print(f"Error fetching proteome for {accession}: {e}")
 
+def download_accession(accession:str, output_dir:str, datasets_bin:str="datasets", max_retries:int=3, backoff:float=2.0):
+    """
+    Download a single proteome archive with retries and exponential backoff.
+    The archive is downloaded under a temporary name and renamed only after it passes validation.
 
-def extract_protein_faa(zip_dir, output_dir):
+    Returns:
+    - record: dict, Journal record describing the outcome.
+    """
+    output_file = os.path.join(output_dir, f"{accession}.zip")
+    partial_file = os.path.join(output_dir, f"{accession}.part.zip")
+    command = [
+        datasets_bin, "download", "genome",
+        "accession", accession,
+        "--include", "protein",
+        "--filename", partial_file
+    ]
+
+    error = None
+    attempt = 0
+    for attempt in range(1, max_retries + 1):
+        try:
+            run_checked(command)
+            if is_valid_archive(partial_file):
+                os.replace(partial_file, output_file)
+                return {"accession": accession, "status": "done", "attempts": attempt,
+                        "size": os.path.getsize(output_file), "time": time.time()}
+            error = "Invalid zip archive"
+        except subprocess.CalledProcessError as e:
+            error = f"Failed (Code {e.returncode})"
+        except FileNotFoundError:
+            error = f"Executable not found: {datasets_bin}"
+            break
+
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        if attempt < max_retries:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+    return {"accession": accession, "status": "failed", "attempts": attempt, "error": error, "time": time.time()}
+
+
+def fetch_proteomes_ncbi_datasets(accession_file, output_dir, num_workers=4, max_retries=3, backoff=2.0, datasets_bin="datasets"):
     """
-    Extract the protein.faa file from each ZIP archive in the specified directory.
+    Fetch proteomes from NCBI using the Datasets CLI for given Assembly Accessions.
+    Downloads run concurrently and every outcome is appended to a journal in output_dir,
+    so a rerun only fetches archives that are missing or corrupt.
 
     Parameters:
-    - zip_dir: str, Path to the directory containing ZIP archives.
-    - output_dir: str, Path to the directory to save extracted protein.faa files.
+    - accession_file: str, Path to a text file containing Assembly Accessions.
+    - output_dir: str, Directory to save the downloaded proteomes.
+    - num_workers: int, Maximum number of concurrent downloads.
+    - max_retries: int, Number of download attempts per accession.
+    - backoff: float, Initial delay in seconds between attempts (doubled after each failure).
+    - datasets_bin: str, Path to the Datasets CLI executable.
+
+    Returns:
+    - failed: list, Accessions which could not be downloaded.
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for filename in os.listdir(zip_dir):
-        if filename.endswith(".zip"):
-            zip_path = os.path.join(zip_dir, filename)
-            try:
-                with zipfile.ZipFile(zip_path, 'r') as z:
-                    # Find the desired file in the archive
-                    target_file = None
-                    for file in z.namelist():
-                        if file.endswith("/protein.faa"):
-                            target_file = file
-                            break
-
-                    if target_file:
-                        print(f"Extracting {target_file} from {filename}")
-                        output_file_path = os.path.join(output_dir, os.path.basename(os.path.dirname(target_file)) + ".faa")
-                        with z.open(target_file) as source, open(output_file_path, 'wb') as target:
-                            target.write(source.read())
-                        print(f"Saved to {output_file_path}")
-                    else:
-                        print(f"No protein.faa file found in {filename}")
-
-            except zipfile.BadZipFile:
-                print(f"Error: {filename} is not a valid zip file.")
+    journal_path = os.path.join(output_dir, DOWNLOAD_JOURNAL_NAME)
+    journal = load_download_journal(journal_path)
+
+    accessions = read_accessions(accession_file)
+    pending = [
+        (accession, description) for accession, description in accessions
+        if not archive_is_complete(os.path.join(output_dir, f"{accession}.zip"), journal.get(accession))
+    ]
+    print(f"{len(accessions) - len(pending)} proteome archives already downloaded, {len(pending)} to fetch.")
+
+    failed = []
+    with open(journal_path, "a") as journal_file, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for accession, description in pending:
+            print(f"Fetching proteome for accession: {accession} ({description})")
+            future = executor.submit(download_accession, accession, output_dir, datasets_bin, max_retries, backoff)
+            futures[future] = accession
+
+        for future in as_completed(futures):
+            record = future.result()
+            journal_file.write(json.dumps(record) + "\n")
+            journal_file.flush()
+            if record["status"] == "done":
+                print(f"Saved proteome archive for {record['accession']} ({record['attempts']} attempt(s))")
+            else:
+                print(f"Error fetching proteome for {record['accession']}: {record['error']}")
+                failed.append(record["accession"])
+
+    return failed
+
+
+def find_protein_member(z:zipfile.ZipFile):
+    """
+    Return the ZipInfo of the protein.faa member of an NCBI Datasets archive (or None).
+    """
+    for info in z.infolist():
+        if info.filename.endswith("/protein.faa"):
+            return info
+    return None
+
+
+def plan_proteome_archives(zip_dir:str):
+    """
+    List proteome archives in a deterministic (sorted) order and assign each protein.faa member
+    its byte offset in the combined FASTA file, based on the uncompressed member sizes.
+
+    Parameters:
+    - zip_dir: str, Path to the directory containing ZIP archives.
+
+    Returns:
+    - plan: list, (zip_path, member_name, genome_id, offset) tuples.
+    - total_size: int, Size of the combined FASTA file in bytes.
+    """
+    plan = []
+    offset = 0
+    for filename in sorted(os.listdir(zip_dir)):
+        if not filename.endswith(".zip") or filename.endswith(".part.zip"):
+            continue
+        zip_path = os.path.join(zip_dir, filename)
+        try:
+            with zipfile.ZipFile(zip_path, 'r') as z:
+                info = find_protein_member(z)
+        except zipfile.BadZipFile:
+            print(f"Error: {filename} is not a valid zip file.")
+            continue
+
+        if info is None:
+            print(f"No protein.faa file found in {filename}")
+            continue
+
+        genome_id = os.path.basename(os.path.dirname(info.filename))
+        plan.append((zip_path, info.filename, genome_id, offset))
+        offset += info.file_size
+    return plan, offset
+
+
+@timed
+def stream_protein_archive(zip_path:str, member:str, combined_fasta:str, offset:int, chunk_size:int=1 << 20, compression:str="none"):
+    """
+    Stream a protein.faa member out of a ZIP archive in chunks. Every chunk is written into the
+    combined FASTA file at the member's reserved offset and parsed into records on the fly,
+    so the data is decompressed and written exactly once.
+    With a compression codec, chunks are compressed into a part file of their own instead
+    (compressed sizes are not known in advance); the parts are concatenated afterwards.
+
+    Parameters:
+    - zip_path: str, Path to the ZIP archive.
+    - member: str, Name of the protein.faa member inside the archive.
+    - combined_fasta: str, Path to the (preallocated) combined FASTA file, or to the part file when compressing.
+    - offset: int, Byte offset reserved for this member in the combined FASTA file.
+    - chunk_size: int, Number of bytes read from the archive at once.
+    - compression: str, Codec of the combined FASTA file (common.compression.CODECS).
+
+    Returns:
+    - records: list, (protein ID, sequence) tuples in file order.
+    """
+    records = []
+    prot_id = None
+    seq_parts = []
+
+    def parse_line(line:bytes):
+        nonlocal prot_id, seq_parts
+        line = line.rstrip(b"\r")
+        if line.startswith(b">"):
+            if prot_id is not None:
+                records.append((prot_id, "".join(seq_parts)))
+            header = line[1:].split(None, 1)
+            prot_id = header[0].decode() if header else ""
+            seq_parts = []
+        elif prot_id is not None and line:
+            seq_parts.append(line.decode())
+
+    part = None
+    if compression != "none":
+        part = CompressedWriter(combined_fasta, compression)
+    else:
+        fd = os.open(combined_fasta, os.O_WRONLY)
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as z, z.open(member) as source:
+            pending = b""
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                if part is not None:
+                    part.write(chunk)
+                else:
+                    view = memoryview(chunk)
+                    while view:
+                        written = os.pwrite(fd, view, offset)
+                        offset += written
+                        view = view[written:]
+
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    parse_line(line)
+            parse_line(pending)
+    finally:
+        if part is not None:
+            part.close()
+        else:
+            os.close(fd)
+
+    if prot_id is not None:
+        records.append((prot_id, "".join(seq_parts)))
+    return records
 
 
 def prepare_genome_names_map(accession_file, output_dir):
@@ -108,88 +327,124 @@ def prepare_genome_names_map(accession_file, output_dir):
     return name_map
 
 
-def prepare_genome_map(protein_files_dir, genomeID2name, output_dir, output_name="genome_map.pkl"):
+@timed
+def process_proteome_archives(zip_dir:str, genomeID2name:dict, combined_fasta_dir:str, maps_dir:str, num_processes:int=4, compression:str="none")->str:
     """
-    Create a mapping from protein sequence IDs to genome IDs, genome names, and sequences based on protein FASTA files.
-    
+    Single streaming pass over all proteome archives: build the combined FASTA file and the sequence
+    store (protein sequence ID -> genome, sequence) at the same time.
+    Archives are processed in parallel; results are merged in sorted archive order, so the outputs
+    are deterministic.
+    At most 2 * num_processes archives are in flight at once, so finished results never pile up in memory.
+
     Parameters:
-    - protein_files_dir: str, Directory containing protein FASTA files.
+    - zip_dir: str, Path to the directory containing ZIP archives.
     - genomeID2name: dict, Mapping of genome IDs to genome names.
-    - output_dir: str, Directory to save the genome map.
-    - output_name: str, Name of the file to save the genome map.
-    """
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    print("Preparing mapping from protein IDs to genome IDs, genome names, and sequences.")
-
-    genome_map = {}
-    for file in os.listdir(protein_files_dir):
-        if file.endswith(".faa"):
-            genome_id = os.path.splitext(file)[0]
-            genome_name = genomeID2name.get(genome_id, "Unknown Genome")
+    - combined_fasta_dir: str, Directory to save the combined FASTA file.
+    - maps_dir: str, Directory to save the sequence store.
+    - num_processes: int, Number of archives processed in parallel.
+    - compression: str, Codec of the combined FASTA file (archives are compressed in parallel, one per process).
 
-            file_path = os.path.join(protein_files_dir, file)
-            for record in SeqIO.parse(file_path, "fasta"):
-                prot_id = record.id  # Protein ID
-                sequence = str(record.seq)  # Protein sequence
-                genome_map[prot_id] = (genome_id, genome_name, sequence)
-
-    output_path = os.path.join(output_dir, output_name)
-    with open(output_path, "wb") as f:
-        pickle.dump(genome_map, f)
-
-
-def combine_fasta_files(input_dir:str, output_dir:str):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    combined_fasta = os.path.join(output_dir, "combined_proteins.faa")
-
-    # Combine all FASTA files into one
-    with open(combined_fasta, "w") as outfile:
-        for file in os.listdir(input_dir):
-            if file.endswith(".faa"):
-                with open(os.path.join(input_dir, file), "r") as infile:
-                    outfile.write(infile.read())
-
-
-def is_done(path2check:str)->bool:
-    if os.path.exists(path2check) and len(os.listdir(path2check)) > 0:
-        return True
+    Returns:
+    - combined_fasta: str, Path of the combined FASTA file.
+    """
+    os.makedirs(combined_fasta_dir, exist_ok=True)
+    os.makedirs(maps_dir, exist_ok=True)
+
+    plan, total_size = plan_proteome_archives(zip_dir)
+    print(f"Processing {len(plan)} proteome archives ({total_size} bytes of protein sequences).")
+
+    # Reserve the full size up front, so every worker can write its member at a fixed offset.
+    combined_fasta = os.path.join(combined_fasta_dir, COMBINED_FASTA_NAME + SUFFIXES[compression])
+    if compression == "none":
+        targets = [combined_fasta] * len(plan)
+        with open(combined_fasta, "wb") as f:
+            f.truncate(total_size)
     else:
-        return False
-    
+        targets = [f"{combined_fasta}.part{i}" for i in range(len(plan))]
+
+    num_sequences = 0
+    with SequenceStoreWriter(os.path.join(maps_dir, STORE_DIRNAME)) as store, ProcessPoolExecutor(max_workers=num_processes) as executor:
+        # Sliding window: the next archive is submitted as the ordered merge consumes a result.
+        jobs = iter(zip(plan, targets))
+        futures = deque()
+
+        def submit_next():
+            job = next(jobs, None)
+            if job is not None:
+                (zip_path, member, _, offset), target = job
+                futures.append(executor.submit(stream_protein_archive, zip_path, member, target, offset, compression=compression))
+
+        for _ in range(2 * num_processes):
+            submit_next()
+        # Ordered merge: consume results in archive order.
+        for _, _, genome_id, _ in tqdm(plan, total=len(plan), desc="Processing proteomes", unit="archive"):
+            sequences = futures.popleft().result()
+            submit_next()
+            genome_code = store.genome_code(genome_id, genomeID2name.get(genome_id, "Unknown Genome"))
+            for prot_id, sequence in sequences:
+                store.add(prot_id, genome_code, sequence)
+                num_sequences += 1
+    print(f"Stored {num_sequences} protein sequences.")
+
+    if compression != "none":
+        # Compressed blocks concatenate into a valid file: join the parts in archive order.
+        with open(combined_fasta, "wb") as f:
+            for part in targets:
+                with open(part, "rb") as source:
+                    shutil.copyfileobj(source, f, 1 << 20)
+                os.remove(part)
+    remove_variants(combined_fasta)
+    return combined_fasta
+
+
+def list_archives(zip_dir:str)->list:
+    """
+    List completed proteome archives (partial downloads excluded) in sorted order.
+    """
+    return sorted(
+        os.path.join(zip_dir, filename) for filename in os.listdir(zip_dir)
+        if filename.endswith(".zip") and not filename.endswith(".part.zip")
+    )
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script for fetching and processing proteomes.")
     parser.add_argument("--accession_filename", required=True, help="Name of an accession file.")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of concurrent downloads.")
+    parser.add_argument("--max_retries", type=int, default=3, help="Number of download attempts per accession.")
+    parser.add_argument("--datasets_bin", default="datasets", help="Path to the NCBI Datasets CLI executable.")
+    parser.add_argument("--num_processes", type=int, default=4, help="Number of proteome archives processed in parallel.")
+    parser.add_argument("--compression", choices=CODECS, default="none", help="Codec of the combined FASTA file.")
     args = parser.parse_args()
+    track_stage("prepare_data")
 
     BASENAME = args.accession_filename.split(".")[0]
     ACCESSION_FILEPATH = os.path.join("data_preparation/accession_ids", args.accession_filename)
     ARCHIVE_DIR = os.path.join("data_preparation/data/proteome_archives", BASENAME)
-    FASTA_DIR = os.path.join("data_preparation/data/proteome_fasta", BASENAME)
     COMBINED_FASTA_DIR = os.path.join("data_preparation/data/combined_fasta", BASENAME)
     MAPS_DIR = os.path.join("data_preparation/data/maps", BASENAME)
 
-    if not is_done(ARCHIVE_DIR):
-        fetch_proteomes_ncbi_datasets(ACCESSION_FILEPATH, ARCHIVE_DIR)
-    else:
-        print("Data already downloaded!")
+    # Downloads are resumable: only missing or corrupt archives are fetched.
+    with stage("download"):
+        failed = fetch_proteomes_ncbi_datasets(ACCESSION_FILEPATH, ARCHIVE_DIR, num_workers=args.num_workers,
+                                               max_retries=args.max_retries, datasets_bin=args.datasets_bin)
+    if failed:
+        print(f"Failed to fetch {len(failed)} proteome(s): {', '.join(failed)}")
     
-    if not is_done(FASTA_DIR):
-        extract_protein_faa(ARCHIVE_DIR, FASTA_DIR)
-    else:
-        print("Data already preprocessed!")
-
-    if not is_done(COMBINED_FASTA_DIR):
-        combine_fasta_files(FASTA_DIR, COMBINED_FASTA_DIR)
-    else:
-        print("Fasta files already merged!")
-
-    if not is_done(MAPS_DIR):
+    # The manifest records digests of all archives, so the stage reruns only when the set of proteomes changed.
+    manifest = load_manifest(COMBINED_FASTA_DIR)
+    inputs = describe_files(list_archives(ARCHIVE_DIR) + [ACCESSION_FILEPATH], manifest["inputs"])
+    params = {"compression": args.compression} if args.compression != "none" else {}
+    if not stage_is_current(manifest, params, inputs):
         genome_name_map = prepare_genome_names_map(ACCESSION_FILEPATH, MAPS_DIR)
-        prepare_genome_map(FASTA_DIR, genome_name_map, MAPS_DIR, output_name="genome_map.pkl")
+        combined_fasta = process_proteome_archives(ARCHIVE_DIR, genome_name_map, COMBINED_FASTA_DIR, MAPS_DIR,
+                                                   num_processes=args.num_processes, compression=args.compression)
+        outputs = describe_files([
+            combined_fasta,
+            os.path.join(MAPS_DIR, "genomeID2name.pkl"),
+            os.path.join(MAPS_DIR, STORE_DIRNAME, SEQUENCES_NAME),
+            os.path.join(MAPS_DIR, STORE_DIRNAME, INDEX_NAME),
+        ])
+        save_manifest(COMBINED_FASTA_DIR, {"params": params, "inputs": inputs, "outputs": outputs, "items": {}})
     else:
-        print("Maps are already prepared!")
+        print("Proteomes are already processed!")
@@ -1,116 +1,173 @@
 import os
+import sys
 import pickle
+import hashlib
 import argparse
-from collections import defaultdict
+import numpy as np
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.sequence_store import open_sequence_store, STORE_DIRNAME, SEQUENCES_NAME, INDEX_NAME
+from common.manifest import load_manifest, save_manifest, describe_files, stage_is_current, remove_stale_items
+from common.family_archive import FamilyArchiveWriter, FAMILY_INDEX_NAME, remove_archive
+from common.compression import CODECS, SUFFIXES, compress_bytes
+from common.telemetry import track_stage, timed
+from clustering.deduplicate import load_duplicates, DUPLICATES_NAME
 
-def parse_clusters(cluster_file: str):
+
+@timed
+def iter_clusters(cluster_file: str):
     """
-    Parse MMseqs2 cluster results to map sequences to clusters.
+    Stream MMseqs2 cluster results cluster by cluster. MMseqs2 writes all members of a cluster
+    on consecutive lines, so only the current cluster is held in memory.
     
     Parameters:
     - cluster_file: str, Path to cluster_results.tsv file.
     
-    Returns:
-    - cluster_map: dict, Cluster ID -> List of sequences.
+    Yields:
+    - (cluster, sequences): tuple, Cluster ID and list of its sequence IDs.
     """
-    cluster_map = defaultdict(list)
+    cluster = None
+    sequences = []
     with open(cluster_file, "r") as f:
         for line in f:
-            cluster, sequence = line.strip().split("\t")
-            cluster_map[cluster].append(sequence)
-    return cluster_map
-
-
-def filter_clusters_ortologs(cluster_map, min_cluster_size, genome_map):
+            current, sequence = line.strip().split("\t")
+            if current != cluster:
+                if sequences:
+                    yield cluster, sequences
+                cluster = current
+                sequences = []
+            sequences.append(sequence)
+    if sequences:
+        yield cluster, sequences
+
+
+def classify_cluster(genome_codes: np.ndarray, min_cluster_size: int, num_genomes: int):
     """
-    Filter clusters to include cluster of size >= min_cluster_size.
-    Also If needed select only 1-1 clusters (one sequence per genome).
+    Classify a cluster by the genome codes of its members.
     
     Parameters:
-    - cluster_map: dict, Cluster ID -> List of sequence IDs.
-    - genome_map: dict, Sequence ID -> (Genome ID, Genome name, sequence) mapping.
+    - genome_codes: np.ndarray, Integer genome code of every member.
+    - min_cluster_size: int, Minimum number of sequences in a family.
+    - num_genomes: int, Number of genomes which every 1-1 cluster has to cover.
     
     Returns:
-    - filtered_clusters: dict, Filtered clusters with genome IDs as keys.
+    - paralog: bool, Cluster is large enough to form a family (paralogs allowed).
+    - ortolog: bool, Cluster is also strictly 1-1 (exactly one sequence from every genome - bijective).
     """
-    filtered_clusters = {}
-    for cluster, sequences in cluster_map.items():
-        if len(sequences) < min_cluster_size:
-            continue
-        genome_counts = defaultdict(int)
-        genome_sequences = {}
-        
-        for seq in sequences:
-            _, genome_name, _ = genome_map.get(seq, "Unknown") # SequenceID : (Genome ID, Genome name, sequence)
-            genome_counts[genome_name] += 1
-            genome_sequences[genome_name] = seq
-        
-        # Check if cluster is 1-1 (exactly one sequence per genome and we want only clusters with ALL sequences - bijective)
-        if len(genome_counts) == len(genome_sequences) and len(genome_counts)==NUMBER_OF_ALL_SEQUENCES and all(count == 1 for count in genome_counts.values()):
-            filtered_clusters[cluster] = {genome_name: genome_sequences[genome_name] for genome_name in genome_sequences}
-
-    return filtered_clusters
-
-
-def filter_clusters_paralogs(cluster_map, min_cluster_size):
-    """Filter out clusters of size lower than threshold"""
-    filtered_clusters = {}
-    for cluster, sequences in cluster_map.items():
-        if len(sequences) < min_cluster_size:
-            continue
+    if len(genome_codes) < min_cluster_size:
+        return False, False
+    if len(genome_codes) != num_genomes:
+        return True, False
+    counts = np.bincount(genome_codes, minlength=num_genomes)
+    return True, bool(np.count_nonzero(counts) == num_genomes and counts.max() == 1)
+
 
-        filtered_clusters[cluster] = sequences
+def expand_duplicates(sequences: list, duplicates: dict) -> list:
+    """
+    Expand representatives of identical sequences (clustering of deduplicated input) back to all members.
+    """
+    expanded = []
+    for seq_ID in sequences:
+        expanded.append(seq_ID)
+        expanded.extend(duplicates.get(seq_ID, ()))
+    return expanded
 
-    return filtered_clusters
+
+@timed
+def iter_families(cluster_file: str, store, min_cluster_size: int, num_genomes: int, duplicates: dict = None):
+    """
+    Single pass over the clustering: classify every cluster once and build the FASTA content of
+    families as soon as a cluster is complete. Sequences are only read for clusters which pass.
+    If duplicates (representative -> identical sequences) is given, clusters are expanded to all members first.
+    
+    Yields:
+    - (kind, cluster, content): tuple, Family kind ("paralogs" or "ortologs"), cluster ID and FASTA content.
+    """
+    for cluster, sequences in iter_clusters(cluster_file):
+        if duplicates:
+            sequences = expand_duplicates(sequences, duplicates)
+        if len(sequences) < min_cluster_size:
+            continue
+        entries = store.lookup(sequences)
+        missing = [seq_ID for seq_ID in sequences if seq_ID not in entries]
+        if missing:
+            raise KeyError(f"Sequences of cluster {cluster} missing in the sequence store: {', '.join(missing[:5])}")
+
+        genome_codes = np.fromiter((entries[seq_ID][0] for seq_ID in sequences), dtype=np.int64, count=len(sequences))
+        paralog, ortolog = classify_cluster(genome_codes, min_cluster_size, num_genomes)
+        content = "".join(
+            f">{store.genome_names[genome_code]}\n{store.read(entries[seq_ID][1], entries[seq_ID][2])}\n"
+            for seq_ID, genome_code in zip(sequences, genome_codes)
+        )
+        if paralog:
+            yield "paralogs", cluster, content
+        if ortolog:
+            yield "ortologs", cluster, content
 
 
 def load_genome_map(dataset:str):
     """
-    Loads previously computed genome maps.
+    Loads previously computed sequence store and genome name map.
+    Sequences are read lazily from the store, only for clusters which are written out.
     """
-    with open(f"data_preparation/data/maps/{dataset}/genome_map.pkl", "rb") as f1: 
-        genome_map = pickle.load(f1)
+    store = open_sequence_store(f"data_preparation/data/maps/{dataset}")
     
     with open(f"data_preparation/data/maps/{dataset}/genomeID2name.pkl", "rb") as f2:
         genomeID2name = pickle.load(f2)
     
-    return genome_map, genomeID2name
+    return store, genomeID2name
 
 
-def prepare_ortologs_families(filtered_clusters:dict, genome_map:dict, output_dir:str):
-    """
-    Prepare protein families for multiple sequence analysis.
+def write_family(output_dir:str, cluster:str, content:str, previous_items:dict, compression:str="none"):
     """
-    for cluster, genomes in filtered_clusters.items():
-        # Save sequences to a file
-        with open(os.path.join(output_dir, f"{cluster}.fasta"), "w") as f:
-            for genome, seq_ID in genomes.items():
-                f.write(f">{genome}\n{genome_map[seq_ID][2]}\n")
+    Write a family FASTA file unless an identical file from a previous run is already in place,
+    so unchanged families keep their files (and downstream results) untouched.
+    With a compression codec the file name gets the codec's suffix; the digest is of the uncompressed content.
 
-
-def prepare_paralogs_families(filtered_clusters:dict, genome_map:dict, output_dir:str):
+    Returns:
+    - filename: str, Name of the family file.
+    - item: dict, Manifest item with the content digest.
+    """
+    filename = f"{cluster}.fasta{SUFFIXES[compression]}"
+    path = os.path.join(output_dir, filename)
+    data = content.encode()
+    digest = hashlib.sha256(data).hexdigest()
+    previous = previous_items.get(filename)
+    if previous is None or previous["input"] != digest or not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(compress_bytes(data, compression))
+    return filename, {"input": digest, "outputs": [filename]}
+
+
+def add_family_to_archive(archive:FamilyArchiveWriter, cluster:str, content:str):
     """
-    Prepare protein families for multiple sequence analysis.
+    Append a family to a family archive (archive layout).
+
+    Returns:
+    - filename: str, Name of the family member (same as in the per-file layout).
+    - item: dict, Manifest item with the content digest.
     """
-    for cluster, seq_ids in filtered_clusters.items():
-        # Save sequences to a file
-        with open(os.path.join(output_dir, f"{cluster}.fasta"), "w") as f:
-            for seq_ID in seq_ids:
-                genome_name = genome_map[seq_ID][1]
-                f.write(f">{genome_name}\n{genome_map[seq_ID][2]}\n")
+    filename = f"{cluster}.fasta"
+    data = content.encode()
+    archive.add(filename, data)
+    return filename, {"input": hashlib.sha256(data).hexdigest(), "outputs": []}
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script for filtering 1-1 clusters from MMseqs2 results.")
     parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
     parser.add_argument("--min_cluster_size", required=True, type=int, help="Minimum number of sequences in clusters.")
+    parser.add_argument("--dedup", action="store_true", help="Clusters were computed on deduplicated sequences; expand them to all identical members.")
+    parser.add_argument("--layout", choices=["files", "archive"], default="files", help="Write one FASTA file per family (files) or a single indexed family archive (archive).")
+    parser.add_argument("--compression", choices=CODECS, default="none", help="Codec of the family files (or of the members of the family archive).")
     args = parser.parse_args()
+    track_stage("families")
 
     # Paths and parameters
     BASENAME = args.basename
     MIN_CLUSTER_SIZE = args.min_cluster_size
     CLUSTER_RES_PATH = os.path.join("clustering/clustering_results", BASENAME, "clustering_results_cluster.tsv")
+    DUPLICATES_PATH = os.path.join("clustering/dedup_results", BASENAME, DUPLICATES_NAME)
     
     CLUSTER_OUTPUT_DIR_ORTOLOGS = os.path.join("families/clusters_ortologs", BASENAME)
     CLUSTER_OUTPUT_DIR_PARALOGS = os.path.join("families/clusters_paralogs", BASENAME)
@@ -122,26 +179,63 @@ if __name__ == "__main__":
     os.makedirs(ORTOLOGS_FAMILIES_OUTPUT_DIR, exist_ok=True)
     os.makedirs(PARALOGS_FAMILIES_OUTPUT_DIR, exist_ok=True)
 
+    # Skip the stage when clusters, sequences and parameters are unchanged.
+    MAPS_DIR = os.path.join("data_preparation/data/maps", BASENAME)
+    params = {"min_cluster_size": MIN_CLUSTER_SIZE, "layout": args.layout, "dedup": args.dedup}
+    if args.compression != "none":
+        params["compression"] = args.compression
+    manifest_ortologs = load_manifest(ORTOLOGS_FAMILIES_OUTPUT_DIR)
+    manifest_paralogs = load_manifest(PARALOGS_FAMILIES_OUTPUT_DIR)
+    input_files = [
+        CLUSTER_RES_PATH,
+        os.path.join(MAPS_DIR, "genomeID2name.pkl"),
+        os.path.join(MAPS_DIR, STORE_DIRNAME, SEQUENCES_NAME),
+        os.path.join(MAPS_DIR, STORE_DIRNAME, INDEX_NAME),
+    ]
+    if args.dedup:
+        input_files.append(DUPLICATES_PATH)
+    inputs = describe_files(input_files, manifest_paralogs["inputs"])
+    if stage_is_current(manifest_ortologs, params, inputs, ORTOLOGS_FAMILIES_OUTPUT_DIR) and stage_is_current(manifest_paralogs, params, inputs, PARALOGS_FAMILIES_OUTPUT_DIR):
+        print("Protein families are up to date!")
+        sys.exit(0)
+
     # Load genome map
-    genome_map, genomeID2name = load_genome_map(BASENAME)
-    print(f"Loaded genome map with {len(genome_map)} sequences.")
+    store, genomeID2name = load_genome_map(BASENAME)
+    print(f"Loaded sequence store with {len(store)} sequences.")
 
     NUMBER_OF_ALL_SEQUENCES = len(genomeID2name.keys())
 
-    # Parse clusters
-    cluster_map = parse_clusters(CLUSTER_RES_PATH)
-    print(f"Parsed {len(cluster_map)} clusters from {CLUSTER_RES_PATH}.")
-
-    # Prepare clusters with paralogs
-    clusters_paralogs = filter_clusters_paralogs(cluster_map, MIN_CLUSTER_SIZE)
-    print(f"Extracted {len(clusters_paralogs)} clusters with paralogs.")
-
-    # Filter 1-1 clusters
-    clusters_ortologs = filter_clusters_ortologs(cluster_map, MIN_CLUSTER_SIZE, genome_map)
-    print(f"Extracted {len(clusters_ortologs)} 1-1 clusters (without paralogs, bijective).")
-
-    # Prepare families for MSA (with paralogs):
-    prepare_paralogs_families(clusters_paralogs, genome_map, PARALOGS_FAMILIES_OUTPUT_DIR)
-
-    # Prepare families for MSA (without paralogs):
-    prepare_ortologs_families(clusters_ortologs, genome_map, ORTOLOGS_FAMILIES_OUTPUT_DIR)
\ No newline at end of file
+    duplicates = None
+    if args.dedup:
+        duplicates = load_duplicates(DUPLICATES_PATH)
+        print(f"Loaded {len(duplicates)} representatives of identical sequences.")
+
+    # Classify clusters and write families (with and without paralogs) in a single pass.
+    # In the files layout only new or changed families are rewritten.
+    output_dirs = {"paralogs": PARALOGS_FAMILIES_OUTPUT_DIR, "ortologs": ORTOLOGS_FAMILIES_OUTPUT_DIR}
+    manifests = {"paralogs": manifest_paralogs, "ortologs": manifest_ortologs}
+    items = {"paralogs": {}, "ortologs": {}}
+    archives = {kind: FamilyArchiveWriter(output_dir, args.compression) for kind, output_dir in output_dirs.items()} if args.layout == "archive" else None
+    for kind, cluster, content in iter_families(CLUSTER_RES_PATH, store, MIN_CLUSTER_SIZE, NUMBER_OF_ALL_SEQUENCES, duplicates):
+        if archives:
+            filename, item = add_family_to_archive(archives[kind], cluster, content)
+        else:
+            filename, item = write_family(output_dirs[kind], cluster, content, manifests[kind]["items"], args.compression)
+        if filename in items[kind]:
+            raise ValueError(f"Cluster {cluster} is not stored contiguously in {CLUSTER_RES_PATH}.")
+        items[kind][filename] = item
+    print(f"Extracted {len(items['paralogs'])} clusters with paralogs.")
+    print(f"Extracted {len(items['ortologs'])} 1-1 clusters (without paralogs, bijective).")
+
+    for kind in ("paralogs", "ortologs"):
+        outputs = {}
+        if archives:
+            archives[kind].close()
+            # Family files left over from the per-file layout are no longer needed.
+            remove_stale_items(manifests[kind], {}, output_dirs[kind])
+            outputs = describe_files([archives[kind].archive_path, os.path.join(output_dirs[kind], FAMILY_INDEX_NAME)])
+        else:
+            remove_archive(output_dirs[kind])
+            stale = remove_stale_items(manifests[kind], items[kind], output_dirs[kind])
+            print(f"Removed {len(stale)} {kind} families which no longer pass filtering.")
+        save_manifest(output_dirs[kind], {"params": params, "inputs": inputs, "outputs": outputs, "items": items[kind]})
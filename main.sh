@@ -6,19 +6,54 @@ set -e
 # Step 0: Set global variables
 ACCESSION_FILE="bacteria.txt" # PUT THERE NAME OF ACCESION FILE
 
+## Download options
+DOWNLOAD_WORKERS=4        # Number of concurrent proteome downloads.
+PREPARE_NUM_PROCESSES=4   # Number of proteome archives processed in parallel.
+
+## Storage options
+COMPRESSION="none"       # Codec of intermediate files (combined and unique proteins, families, alignments, merged tree sets): "none", "gzip" or "zstd" (needs the zstandard package). Other codecs change the file names (e.g. all_trees.txt.gz).
+COMPRESSION_THREADS=4    # Number of threads compressing the large intermediate files.
+
 ## Clustering options
 MIN_SEQ_ID=0.5      # Minimum sequence identity for clustering.
 COVERAGE=0.8        # Minimum coverage for clustering.
 MIN_CLUSTER_SIZE=25 # Minimum number of sequences in clusters.
+CLUSTER_UPDATE=false  # If true, MMseqs2 databases are kept and later runs only cluster newly added sequences.
+DEDUPLICATE=false     # If true, identical sequences are collapsed before clustering and expanded again in families.
+
+## Orchestration options
+ORCHESTRATOR="stages"    # "stages" - one script per step, "pipeline" - (opt-in) Steps 3-6 run as one per-family task graph (pipeline.py) where alignments and trees of different families overlap.
+FUSED_WORKERS=false      # If true (ORCHESTRATOR="pipeline" only), alignments go from MAFFT to IQ-TREE in memory and IQ-TREE runs in memory-backed storage; only treefiles are written.
+KEEP_ALIGNMENTS=true     # With FUSED_WORKERS=true: also write the (trimmed) alignments to their result directories.
+
+## Executor options (ORCHESTRATOR="stages" only)
+EXECUTOR="local"               # "local" - MAFFT and IQ-TREE jobs run on this machine, "queue" - on workers started on any nodes sharing this directory: cd <pipeline dir> && python3 common/work_queue.py --address <this host>:50000 --cores <N>
+QUEUE_ADDRESS="0.0.0.0:50000"  # Address the work queue listens on. The key shared with the workers is read from $WORK_QUEUE_AUTHKEY.
+
+## Families options
+FAMILY_LAYOUT="files"  # "files" - one FASTA file per family, "archive" - single indexed family archive (fewer small files).
 
 ## MSA options
-MSA_NUM_PROCESSES=4
+MSA_NUM_PROCESSES=4  # Number of CPU cores shared by MAFFT jobs (large families get several threads). Only used with ORCHESTRATOR="stages".
+RESUME=false         # If true, alignments and trees completed by an interrupted run are kept and not recomputed.
+RESULT_CACHE_DIR=""               # Directory of alignments and trees shared between runs (keyed by family content and settings), e.g. "cache/results". Empty - no cache.
+RESULT_CACHE_SIZE_GB=50           # Size limit of the result cache, least recently used results are evicted.
+
+## Trimming options
+TRIM_ALIGNMENTS=false  # If true, gap-heavy (and optionally conserved) alignment columns are removed before tree computation.
+MAX_GAP_FRACTION=0.5   # Columns with a larger fraction of gaps are removed.
+MAX_CONSERVATION=1.1   # Columns whose most common residue reaches this frequency are removed (1.0 - constant columns, above 1 - none). Keep constant columns with the WAG+I model: +I estimates the proportion of invariable sites from them.
 
 ## Tree options
-CPU_CORES=12                      # Number of CPU cores to use during tree computation (If you don't know, try: os.cpu_count())
-TREE_NUM_PROCESSES=4              # Number of separate processes to run. Note, it would be better if: CPU_CORES % NUM_PROCESSES == 0
-BOOTSTRAP_REPLICATES=10           # Number of bootstrap replicates. If greater than zero, trees will be computed two times. Once without bootstraping and second one with apllying bootstrap.
+CPU_CORES=12                      # Number of CPU cores to use during tree computation (If you don't know, try: os.cpu_count()). With ORCHESTRATOR="pipeline" shared by all MAFFT and IQ-TREE processes.
+TREE_NUM_PROCESSES=4              # Maximum number of IQ-TREE processes running at once. CPU_CORES are assigned to them according to alignment size. Only used with ORCHESTRATOR="stages".
+BOOTSTRAP_REPLICATES=10           # Number of bootstrap replicates. If greater than zero, trees are computed with bootstrap support.
+TREE_SINGLE_PASS=false            # If true, every tree is computed once (with bootstrap) and plain trees are derived from it. If false, trees are computed two times: once without bootstraping and once with bootstrap.
+ULTRAFAST_BOOTSTRAP=false         # If true, ultrafast bootstrap (-B, at least 1000 replicates) is used instead of the standard bootstrap.
 BOOTSTRAP_SUPPORT_THRESHOLD=70.0  # Bootstrap trees with mean support lower than threshold are eliminated from analysis.
+TREE_BATCH_CELLS=0                # Small alignments (single-threaded) are computed together in IQ-TREE runs over batches of up to this many alignment cells (taxa x sites). 0 - one IQ-TREE run per alignment. Only used with ORCHESTRATOR="stages".
+TREE_METHOD="iqtree"              # "iqtree" - ML trees, "draft" - fast neighbor joining trees from protein distances (trees/draft_trees.py), e.g. for tuning clustering parameters. Draft trees always run as a separate step (as with ORCHESTRATOR="stages").
+DRAFT_DISTANCE="poisson"          # Distance of draft trees: "p" - p-distance, "poisson" - Poisson-corrected distance.
 
 ## Consensus Tree options
 MIN_SUPPORT=0           # Value from 0 to 1. If zero it perform Greedy Consensus, if 0.5 it performs Majority Consensus
@@ -27,40 +62,94 @@ CONSENSUS_CPU_CORES=4
 ## SuperTree options
 SUPER_TREE_METHOD="MRP"
 SUPERTREE_CPU_CORES=4
+MRP_MATRIX_BACKEND="r"       # "python" - MRP matrix is built in Python and R only runs the parsimony search, "r" - R builds it from the trees.
+
+## Telemetry options
+RUN_REPORT_DIR=""         # Wall/CPU time, peak memory and I/O of every stage, tool run and timed function are written to RUN_REPORT_DIR/<basename>/run_<date>.jsonl. Empty - disabled (the default; use a directory outside the checkout).
+BASELINE_REPORT=""        # Run report of an earlier run; the summary shows the wall time change of every stage and tool against it.
 
 
 BASENAME="${ACCESSION_FILE%.*}"
+if [ -n "$RUN_REPORT_DIR" ]; then export RUN_REPORT="$RUN_REPORT_DIR/$BASENAME/run_$(date +%Y%m%d_%H%M%S).jsonl"; fi
 
 # Step 1: Prepare data - download proteomes using accessions IDs defined in the ACCESSION_FILE.
 echo "Step 1: Downloading proteomes..."
-python3 data_preparation/prepare_data.py --accession_file "$ACCESSION_FILE" 
+python3 data_preparation/prepare_data.py --accession_filename "$ACCESSION_FILE" --num_workers "$DOWNLOAD_WORKERS" --num_processes "$PREPARE_NUM_PROCESSES" --compression "$COMPRESSION"
+COMPRESSION_FLAGS="--compression $COMPRESSION --compression_threads $COMPRESSION_THREADS"
 
 # Step 2: Perform clustering with MMseqs2
 echo "Step 2: Clustering protein sequences with MMseqs2..."
-python3 clustering/cluster.py --basename "$BASENAME" --min_seq_id $MIN_SEQ_ID --coverage $COVERAGE
-
-# Step 3: Analyze clusters and extract families (1-to-1)
-echo "Step 4: Analyzing clusters to extract gene families..."
-python3 families/make_families.py --basename "$BASENAME" --min_cluster_size $MIN_CLUSTER_SIZE
-
-# Step 4: Multi-sequence alignment
-echo "Step 4: Performing multiple sequence alignments..."
-python3 allignment/allign.py --basename "$BASENAME" --num_processes "$MSA_NUM_PROCESSES"
-
-# Step 5: Construct gene trees
-echo "Step 5: Constructing family trees..."
-python3 trees/make_trees.py --basename "$BASENAME" --cpu_cores "$CPU_CORES" --bootstrap "$BOOTSTRAP_REPLICATES" --num_processes "$TREE_NUM_PROCESSES" --support_threshold "$BOOTSTRAP_SUPPORT_THRESHOLD"
-
-# Step 6: Construct Consensus Tree (based on orthological sequences)
-echo "Step 6: Constructing Consensus tree..."
+CLUSTER_FLAGS=""
+DEDUP_FLAGS=""
+if [ "$DEDUPLICATE" = true ]; then
+    python3 clustering/deduplicate.py --basename "$BASENAME" $COMPRESSION_FLAGS
+    DEDUP_FLAGS="--dedup"
+fi
+if [ "$CLUSTER_UPDATE" = true ]; then CLUSTER_FLAGS="--update"; fi
+CLUSTER_FLAGS="$CLUSTER_FLAGS $DEDUP_FLAGS"
+python3 clustering/cluster.py --basename "$BASENAME" --min_seq_id $MIN_SEQ_ID --coverage $COVERAGE $CLUSTER_FLAGS
+
+CACHE_FLAGS=""
+if [ -n "$RESULT_CACHE_DIR" ]; then CACHE_FLAGS="--cache_dir $RESULT_CACHE_DIR --cache_size_gb $RESULT_CACHE_SIZE_GB"; fi
+BOOTSTRAP_FLAGS=""
+if [ "$TREE_SINGLE_PASS" = true ]; then BOOTSTRAP_FLAGS="--single_pass"; fi
+if [ "$ULTRAFAST_BOOTSTRAP" = true ]; then BOOTSTRAP_FLAGS="$BOOTSTRAP_FLAGS --ufboot"; fi
+
+if [ "$ORCHESTRATOR" = "pipeline" ] && [ "$TREE_METHOD" = "iqtree" ]; then
+    # Steps 3-6: Families, alignments, trimming and gene trees as one task graph.
+    # Interrupted runs always resume from the stage manifests and finished IQ-TREE runs.
+    echo "Steps 3-6: Extracting families, aligning them and constructing family trees..."
+    PIPELINE_FLAGS="$DEDUP_FLAGS $CACHE_FLAGS $BOOTSTRAP_FLAGS $COMPRESSION_FLAGS"
+    if [ "$FUSED_WORKERS" = true ]; then PIPELINE_FLAGS="$PIPELINE_FLAGS --fused"; fi
+    if [ "$FUSED_WORKERS" = true ] && [ "$KEEP_ALIGNMENTS" = true ]; then PIPELINE_FLAGS="$PIPELINE_FLAGS --keep_alignments"; fi
+    if [ "$TRIM_ALIGNMENTS" = true ]; then PIPELINE_FLAGS="$PIPELINE_FLAGS --trim --max_gap_fraction $MAX_GAP_FRACTION --max_conservation $MAX_CONSERVATION"; fi
+    python3 pipeline.py --basename "$BASENAME" --min_cluster_size $MIN_CLUSTER_SIZE --layout "$FAMILY_LAYOUT" --cpu_cores "$CPU_CORES" --bootstrap "$BOOTSTRAP_REPLICATES" --support_threshold "$BOOTSTRAP_SUPPORT_THRESHOLD" $PIPELINE_FLAGS
+else
+    # Step 3: Analyze clusters and extract families (1-to-1)
+    echo "Step 3: Analyzing clusters to extract gene families..."
+    python3 families/make_families.py --basename "$BASENAME" --min_cluster_size $MIN_CLUSTER_SIZE --layout "$FAMILY_LAYOUT" --compression "$COMPRESSION" $DEDUP_FLAGS
+
+    # Step 4: Multi-sequence alignment
+    echo "Step 4: Performing multiple sequence alignments..."
+    STAGE_FLAGS="$CACHE_FLAGS --executor $EXECUTOR --queue_address $QUEUE_ADDRESS"
+    if [ "$RESUME" = true ]; then STAGE_FLAGS="$STAGE_FLAGS --resume"; fi
+    python3 allignment/allign.py --basename "$BASENAME" --num_processes "$MSA_NUM_PROCESSES" --compression "$COMPRESSION" $STAGE_FLAGS
+
+    # Step 5: Trim alignments
+    TREE_FLAGS="$STAGE_FLAGS $BOOTSTRAP_FLAGS --batch_cells $TREE_BATCH_CELLS"
+    if [ "$TRIM_ALIGNMENTS" = true ]; then
+        echo "Step 5: Trimming alignments..."
+        python3 allignment/trim_alignments.py --basename "$BASENAME" --num_processes "$MSA_NUM_PROCESSES" --max_gap_fraction "$MAX_GAP_FRACTION" --max_conservation "$MAX_CONSERVATION"
+        TREE_FLAGS="$TREE_FLAGS --trimmed"
+    fi
+
+    # Step 6: Construct gene trees
+    echo "Step 6: Constructing family trees..."
+    if [ "$TREE_METHOD" = "draft" ]; then
+        DRAFT_FLAGS="--bootstrap $BOOTSTRAP_REPLICATES --support_threshold $BOOTSTRAP_SUPPORT_THRESHOLD --distance $DRAFT_DISTANCE $COMPRESSION_FLAGS"
+        if [ "$TRIM_ALIGNMENTS" = true ]; then DRAFT_FLAGS="$DRAFT_FLAGS --trimmed"; fi
+        python3 trees/draft_trees.py --basename "$BASENAME" --num_processes "$CPU_CORES" $DRAFT_FLAGS
+    else
+        python3 trees/make_trees.py --basename "$BASENAME" --cpu_cores "$CPU_CORES" --bootstrap "$BOOTSTRAP_REPLICATES" --num_processes "$TREE_NUM_PROCESSES" --support_threshold "$BOOTSTRAP_SUPPORT_THRESHOLD" $COMPRESSION_FLAGS $TREE_FLAGS
+    fi
+fi
+
+# Step 7: Construct Consensus Tree (based on orthological sequences)
+echo "Step 7: Constructing Consensus tree..."
 python3 trees/make_consensus_tree.py --basename "$BASENAME" --min_support "$MIN_SUPPORT" --cpu_cores "$CONSENSUS_CPU_CORES"
 
-# Step 7: Construct SuperTree (based on paralogical sequences)
-echo "Step 7: Constructin SuperTree..."
-python3 trees/make_super_tree.py --basename "$BASENAME" --method "$SUPER_TREE_METHOD" --cpu_cores "$SUPERTREE_CPU_CORES"
+# Step 8: Construct SuperTree (based on paralogical sequences)
+echo "Step 8: Constructin SuperTree..."
+python3 trees/make_super_tree.py --basename "$BASENAME" --method "$SUPER_TREE_METHOD" --cpu_cores "$SUPERTREE_CPU_CORES" --matrix_backend "$MRP_MATRIX_BACKEND"
 
-# Step 8: Saving figures with achieved trees:
+# Step 9: Saving figures with achieved trees:
 echo "Saving figures with achieved trees..."
 Rscript trees/visualize_trees.R
 
+if [ -n "$RUN_REPORT_DIR" ]; then
+    REPORT_FLAGS=""
+    if [ -n "$BASELINE_REPORT" ]; then REPORT_FLAGS="--baseline $BASELINE_REPORT"; fi
+    python3 common/telemetry.py --report "$RUN_REPORT" $REPORT_FLAGS
+fi
+
 echo "Pipeline completed successfully!"
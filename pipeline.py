@@ -0,0 +1,462 @@
+import os
+import sys
+import shutil
+import hashlib
+import argparse
+from collections import deque
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common.manifest import load_manifest, save_manifest, describe_files, file_digest, pending_items, remove_stale_items
+from common.scheduler import run_scheduled
+from common.result_cache import cache_key, open_result_cache
+from common.telemetry import track_stage
+from common.family_archive import FamilyArchiveWriter, FAMILY_INDEX_NAME, remove_archive
+from common.compression import CODECS, compress_bytes, decompress_bytes, read_file
+from common.sequence_store import STORE_DIRNAME, SEQUENCES_NAME, INDEX_NAME
+from clustering.deduplicate import load_duplicates, DUPLICATES_NAME
+from families.make_families import iter_families, load_genome_map, write_family, add_family_to_archive
+from allignment.allign import run_mafft, align_in_memory, mafft_cache_key, aligned_name, family_stats, mafft_threads, MAFFT_OPTIONS
+from allignment.trim_alignments import trim_alignment, trim_data
+from trees.make_trees import run_tree_computation, run_tree_in_memory, alignment_dimensions, tree_threads, tree_prefix, merge_results, merge_single_pass, IQTREE_MODEL
+
+KINDS = ("paralogs", "ortologs")
+REPORT_NAME = "pipeline_report.tsv"
+SAVE_EVERY = 100  # Completed tasks between manifest checkpoints
+
+
+class FamilyPipeline:
+    """
+    Runs Steps 3-5 of main.sh (families, alignments, optional trimming, gene trees) as one task graph with
+    per-family granularity. Families are streamed from the clustering and turned into alignment tasks as cores
+    become free; tree tasks are queued (ahead of further alignments) as soon as their alignment is done.
+    All MAFFT and IQ-TREE processes share one core budget, and ortholog and paralog families are interleaved
+    as they come out of the clustering.
+
+    In fused mode an alignment never goes through storage on its way from MAFFT to IQ-TREE: MAFFT output is
+    kept in memory (and trimmed there), and IQ-TREE runs in a working directory in memory-backed storage of
+    which only the treefile is kept. Alignments are written to the alignment directories only if they are kept.
+
+    Outputs, manifests and directory layout are the same as those of the per-stage scripts, so the
+    following steps (and later per-stage runs) see the same results. An ortholog family is also a
+    paralog family with identical content: its alignment and trees are computed once and copied.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.cache = open_result_cache(args.cache_dir, args.cache_size_gb)
+        self.trim_params = {"max_gap_fraction": args.max_gap_fraction, "max_conservation": args.max_conservation}
+        self.msa_params = {"tool": "mafft", "options": MAFFT_OPTIONS}
+        if args.compression != "none":
+            self.msa_params["compression"] = args.compression
+        self.store_alignments = not args.fused or args.keep_alignments
+        if not self.store_alignments:
+            # Manifest items without alignment files, so a later run writing them does not take them as current.
+            self.msa_params["files"] = False
+            self.trim_params["files"] = False
+
+        base = args.basename
+        self.dirs = {}
+        for kind in KINDS:
+            boot_dir = os.path.join("trees/tree_results", base, f"{kind}_boot")
+            plain_dir = os.path.join("trees/tree_results", base, kind)
+            if args.bootstrap > 0 and args.single_pass:
+                variants = [(boot_dir, args.bootstrap)]
+            else:
+                variants = [(plain_dir, 0)] + ([(boot_dir, args.bootstrap)] if args.bootstrap > 0 else [])
+            self.dirs[kind] = {
+                "families": os.path.join("families/protein_families", kind, base),
+                "msa": os.path.join("allignment/msa_results", kind, base),
+                "trimmed": os.path.join("allignment/trimmed_results", kind, base),
+                "trees": variants,
+                "plain": plain_dir,
+                "boot": boot_dir,
+            }
+
+        # Manifest and the names/digests of items seen in this run, per output directory.
+        self.manifests = {}
+        self.params = {}
+        self.seen = {}
+        for kind in KINDS:
+            self._open(self.dirs[kind]["msa"], self.msa_params)
+            if args.trim:
+                self._open(self.dirs[kind]["trimmed"], self.trim_params)
+            for tree_dir, bootstrap in self.dirs[kind]["trees"]:
+                self._open(tree_dir, self.tree_params(bootstrap))
+
+        self.pending = deque()
+        self.align_leaders = {}  # Family digest -> followers [(kind, family)] of the alignment in progress
+        self.aligned = {}  # Family digest -> (kind, family, result) of a finished alignment
+        self.tree_leaders = {}  # (bootstrap, alignment digest) -> followers [(tree_dir, msa_file)]
+        self.trees_done = {}  # (bootstrap, alignment digest) -> path of the finished treefile
+        self.failed = 0
+        self.completed = 0
+
+    def tree_params(self, bootstrap: int) -> dict:
+        return {"tool": "iqtree", "model": IQTREE_MODEL, "bootstrap": bootstrap, "ufboot": self.args.ufboot and bootstrap > 0}
+
+    def _open(self, output_dir: str, params: dict):
+        os.makedirs(output_dir, exist_ok=True)
+        manifest = load_manifest(output_dir)
+        if manifest["params"] != params:
+            manifest["items"] = {}
+            manifest["params"] = params
+        self.manifests[output_dir] = manifest
+        self.params[output_dir] = params
+        self.seen[output_dir] = {}
+
+    def _is_current(self, output_dir: str, name: str, digest: str) -> bool:
+        return not pending_items(self.manifests[output_dir], self.params[output_dir], {name: digest}, output_dir)
+
+    def _record(self, output_dir: str, name: str, digest: str, outputs: list, **details):
+        self.seen[output_dir][name] = digest
+        self.manifests[output_dir]["items"][name] = {"input": digest, "outputs": outputs, **details}
+
+    def _trees_current(self, kind: str, family: str) -> bool:
+        """
+        Whether the (trimmed alignment and) trees of a family with an up to date alignment are up to date as well,
+        judged by the digests recorded with its alignment. Fused tasks then need neither MAFFT nor the alignment.
+        """
+        item = self.manifests[self.dirs[kind]["msa"]]["items"].get(family, {})
+        if "tree_digest" not in item:
+            return False
+        msa_file = aligned_name(family, self.args.compression)
+        if self.args.trim and not self._is_current(self.dirs[kind]["trimmed"], msa_file, item["msa_digest"]):
+            return False
+        return all(self._is_current(tree_dir, msa_file, item["tree_digest"]) for tree_dir, _ in self.dirs[kind]["trees"])
+
+    def _save_manifests(self):
+        for output_dir, manifest in self.manifests.items():
+            save_manifest(output_dir, manifest)
+
+    # Families ---------------------------------------------------------------------------------------------
+
+    def open_families(self):
+        """
+        Prepare the family stage (same parameters, inputs and outputs as make_families.py).
+        """
+        args = self.args
+        base = args.basename
+        maps_dir = os.path.join("data_preparation/data/maps", base)
+        cluster_path = os.path.join("clustering/clustering_results", base, "clustering_results_cluster.tsv")
+        duplicates_path = os.path.join("clustering/dedup_results", base, DUPLICATES_NAME)
+
+        self.family_params = {"min_cluster_size": args.min_cluster_size, "layout": args.layout, "dedup": args.dedup}
+        if args.compression != "none":
+            self.family_params["compression"] = args.compression
+        self.family_manifests = {kind: load_manifest(self.dirs[kind]["families"]) for kind in KINDS}
+        input_files = [cluster_path, os.path.join(maps_dir, "genomeID2name.pkl"),
+                       os.path.join(maps_dir, STORE_DIRNAME, SEQUENCES_NAME), os.path.join(maps_dir, STORE_DIRNAME, INDEX_NAME)]
+        if args.dedup:
+            input_files.append(duplicates_path)
+        self.family_inputs = describe_files(input_files, self.family_manifests["paralogs"]["inputs"])
+        self.family_items = {kind: {} for kind in KINDS}
+        for kind in KINDS:
+            os.makedirs(self.dirs[kind]["families"], exist_ok=True)
+        self.archives = {kind: FamilyArchiveWriter(self.dirs[kind]["families"], args.compression) for kind in KINDS} if args.layout == "archive" else None
+
+        store, genomeID2name = load_genome_map(base)
+        duplicates = load_duplicates(duplicates_path) if args.dedup else None
+        self.families = iter_families(cluster_path, store, args.min_cluster_size, len(genomeID2name), duplicates)
+
+    def close_families(self):
+        for kind in KINDS:
+            family_dir = self.dirs[kind]["families"]
+            manifest = self.family_manifests[kind]
+            outputs = {}
+            if self.archives:
+                self.archives[kind].close()
+                remove_stale_items(manifest, {}, family_dir)
+                outputs = describe_files([self.archives[kind].archive_path, os.path.join(family_dir, FAMILY_INDEX_NAME)])
+            else:
+                remove_archive(family_dir)
+                remove_stale_items(manifest, self.family_items[kind], family_dir)
+            save_manifest(family_dir, {"params": self.family_params, "inputs": self.family_inputs, "outputs": outputs, "items": self.family_items[kind]})
+            print(f"Extracted {len(self.family_items[kind])} {kind} families.")
+
+    def refill(self) -> list:
+        """
+        Pull the next family from the clustering and return its alignment task
+        (or nothing, if an identical family is already being aligned).
+        """
+        while True:
+            try:
+                kind, cluster, content = next(self.families)
+            except StopIteration:
+                return []
+            family_dir = self.dirs[kind]["families"]
+            if self.archives:
+                family, item = add_family_to_archive(self.archives[kind], cluster, content)
+            else:
+                family, item = write_family(family_dir, cluster, content, self.family_manifests[kind]["items"], self.args.compression)
+            if family in self.family_items[kind]:
+                raise ValueError(f"Cluster {cluster} is not stored contiguously in the clustering results.")
+            self.family_items[kind][family] = item
+            digest = item["input"]
+
+            if digest in self.align_leaders:
+                self.align_leaders[digest].append((kind, family))
+                continue
+            if digest in self.aligned:
+                self.copy_alignment(self.aligned[digest], kind, family)
+                continue
+            self.align_leaders[digest] = []
+            data = content.encode()
+            num_sequences, mean_length = family_stats(data)
+            current = self._is_current(self.dirs[kind]["msa"], family, digest)
+            return [{"task": "align", "kind": kind, "family": family, "content": data, "digest": digest,
+                     "cost": num_sequences * mean_length, "current": current,
+                     "trees_current": self.args.fused and current and self._trees_current(kind, family)}]
+
+    # Tasks --------------------------------------------------------------------------------------------------
+
+    def run(self, job: dict, cores: int):
+        if job["task"] == "align":
+            return self.align_fused(job, cores) if self.args.fused else self.align(job, cores)
+        key = cache_key("iqtree", self.params[job["output_dir"]], job["digest"])
+        if "alignment" in job:
+            _, status, _ = run_tree_in_memory(job["msa_file"], job["alignment"], job["output_dir"], cores, job["bootstrap"],
+                                              self.args.ufboot, self.cache, key)
+            return {"status": status}
+        _, status, _ = run_tree_computation(job["msa_file"], job["input_dir"], job["output_dir"], cores, job["bootstrap"],
+                                            self.args.ufboot, self.cache, key)
+        return {"status": status}
+
+    def cores_for(self, job: dict, free_cores: int, num_pending: int) -> int:
+        if job["task"] == "align":
+            return mafft_threads(job["cost"], free_cores, num_pending, self.args.thread_cost, self.args.max_msa_threads)
+        return tree_threads(job["cells"], free_cores, num_pending, self.args.cells_per_core, self.args.max_tree_threads)
+
+    def align(self, job: dict, threads: int) -> dict:
+        """
+        Align a family (unless its alignment is up to date), trim it if requested, and measure the tree input.
+        Runs in a worker thread, so it only reads the manifests.
+        """
+        kind, family = job["kind"], job["family"]
+        msa_dir = self.dirs[kind]["msa"]
+        msa_file = aligned_name(family, self.args.compression)
+        status = "Up to date"
+        if not job["current"]:
+            _, status, _ = run_mafft(family, self.dirs[kind]["families"], msa_dir, None, threads, self.cache,
+                                     mafft_cache_key(job["digest"]), job["content"], self.args.compression)
+            if status != "Success":
+                return {"status": status}
+        msa_digest = file_digest(os.path.join(msa_dir, msa_file))
+
+        tree_input_dir = msa_dir
+        if self.args.trim:
+            tree_input_dir = self.dirs[kind]["trimmed"]
+            if not self._is_current(tree_input_dir, msa_file, msa_digest):
+                _, trim_status, _ = trim_alignment(msa_file, msa_dir, tree_input_dir, self.args.max_gap_fraction, self.args.max_conservation)
+                if trim_status != "Success":
+                    return {"status": f"Trimming failed: {trim_status}"}
+        data = read_file(os.path.join(tree_input_dir, msa_file))
+        taxa, sites = alignment_dimensions(data)
+        return {"status": status, "msa_digest": msa_digest, "tree_digest": hashlib.sha256(data).hexdigest(), "cells": taxa * sites}
+
+    def align_fused(self, job: dict, threads: int) -> dict:
+        """
+        Align a family in memory (unless its trees are up to date or its kept alignment is), trim it in memory
+        if requested, and write the alignments only if they are kept. The result carries the tree input
+        for the tree tasks. Runs in a worker thread, so it only reads the manifests.
+        """
+        kind, family = job["kind"], job["family"]
+        msa_dir = self.dirs[kind]["msa"]
+        if job["trees_current"]:
+            item = self.manifests[msa_dir]["items"][family]
+            return {"status": "Up to date", "msa_digest": item["msa_digest"], "tree_digest": item["tree_digest"], "cells": item["cells"]}
+
+        msa_file = aligned_name(family, self.args.compression)
+        msa_path = os.path.join(msa_dir, msa_file)
+        status = "Up to date"
+        if self.store_alignments and job["current"]:
+            with open(msa_path, "rb") as f:
+                data = f.read()
+            alignment = decompress_bytes(data, self.args.compression)
+        else:
+            alignment, status, _ = align_in_memory(job["content"], threads, self.cache, mafft_cache_key(job["digest"]))
+            if alignment is None:
+                return {"status": status}
+            data = self.write_alignment(msa_path, alignment) if self.store_alignments else alignment
+        # Digest of the alignment file (if kept), as recorded by per-stage runs.
+        msa_digest = hashlib.sha256(data).hexdigest()
+        if self.args.trim:
+            trimmed_path = os.path.join(self.dirs[kind]["trimmed"], msa_file)
+            try:
+                alignment, _ = trim_data(alignment, self.args.max_gap_fraction, self.args.max_conservation, msa_path)
+            except Exception as e:
+                return {"status": f"Trimming failed: Unexpected Error: {e}"}
+            if self.store_alignments:
+                self.write_alignment(trimmed_path, alignment)
+        taxa, sites = alignment_dimensions(alignment)
+        return {"status": status, "msa_digest": msa_digest, "tree_digest": hashlib.sha256(alignment).hexdigest(),
+                "cells": taxa * sites, "alignment": alignment}
+
+    def write_alignment(self, path: str, alignment: bytes) -> bytes:
+        data = compress_bytes(alignment, self.args.compression)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        return data
+
+    def finish_alignment(self, kind: str, family: str, result: dict):
+        """
+        Record a finished alignment in the stage manifests and queue its trees.
+        """
+        msa_file = aligned_name(family, self.args.compression)
+        outputs = [msa_file] if self.store_alignments else []
+        self._record(self.dirs[kind]["msa"], family, self.family_items[kind][family]["input"], outputs,
+                     msa_digest=result["msa_digest"], tree_digest=result["tree_digest"], cells=result["cells"])
+        tree_input_dir = self.dirs[kind]["msa"]
+        if self.args.trim:
+            tree_input_dir = self.dirs[kind]["trimmed"]
+            self._record(tree_input_dir, msa_file, result["msa_digest"], outputs)
+
+        for tree_dir, bootstrap in self.dirs[kind]["trees"]:
+            treefile = f"{tree_prefix(msa_file)}.treefile"
+            key = (bootstrap, result["tree_digest"])
+            if self._is_current(tree_dir, msa_file, result["tree_digest"]):
+                self.seen[tree_dir][msa_file] = result["tree_digest"]
+                self.trees_done.setdefault(key, os.path.join(tree_dir, treefile))
+                continue
+            if key in self.tree_leaders:
+                self.tree_leaders[key].append((tree_dir, msa_file))
+            elif key in self.trees_done:
+                shutil.copyfile(self.trees_done[key], os.path.join(tree_dir, treefile))
+                self._record(tree_dir, msa_file, result["tree_digest"], [treefile])
+            elif self.args.fused and "alignment" not in result:
+                # A copied alignment whose leader's tree failed: its content is no longer in memory.
+                self.failed += 1
+                tqdm.write(f"Tree computation for {msa_file} ({kind}) skipped: the tree of an identical alignment failed.")
+            else:
+                self.tree_leaders[key] = []
+                # Trees go ahead of further alignments, so families are finished in the order they started.
+                job = {"task": "tree", "kind": kind, "msa_file": msa_file, "input_dir": tree_input_dir,
+                       "output_dir": tree_dir, "bootstrap": bootstrap, "digest": result["tree_digest"], "cells": result["cells"]}
+                if self.args.fused:
+                    job["alignment"] = result["alignment"]
+                self.pending.appendleft(job)
+
+    def copy_alignment(self, leader: tuple, kind: str, family: str):
+        """
+        Give a family the alignment (and trimmed alignment) of an identical family aligned in this run.
+        """
+        leader_kind, leader_family, result = leader
+        msa_file = aligned_name(leader_family, self.args.compression)
+        stages = (["msa", "trimmed"] if self.args.trim else ["msa"]) if self.store_alignments else []
+        for stage in stages:
+            source = os.path.join(self.dirs[leader_kind][stage], msa_file)
+            destination = os.path.join(self.dirs[kind][stage], aligned_name(family, self.args.compression))
+            if os.path.abspath(source) != os.path.abspath(destination):
+                shutil.copyfile(source, destination)
+        self.finish_alignment(kind, family, result)
+
+    def complete(self, job: dict, result: dict) -> str:
+        status = result["status"]
+        if job["task"] == "align":
+            followers = self.align_leaders.pop(job["digest"])
+            if status in ("Success", "Up to date"):
+                self.finish_alignment(job["kind"], job["family"], result)
+                # Alignment content is only needed by the trees just queued.
+                self.aligned[job["digest"]] = (job["kind"], job["family"], {k: v for k, v in result.items() if k != "alignment"})
+                for kind, family in followers:
+                    self.copy_alignment(self.aligned[job["digest"]], kind, family)
+            else:
+                self.failed += 1 + len(followers)
+                tqdm.write(f"Alignment of {job['family']} ({job['kind']}) failed: {status}")
+            return status
+
+        key = (job["bootstrap"], job["digest"])
+        followers = self.tree_leaders.pop(key)
+        treefile = f"{tree_prefix(job['msa_file'])}.treefile"
+        if status == "Success":
+            path = os.path.join(job["output_dir"], treefile)
+            self.trees_done[key] = path
+            self._record(job["output_dir"], job["msa_file"], job["digest"], [treefile])
+            for tree_dir, msa_file in followers:
+                shutil.copyfile(path, os.path.join(tree_dir, f"{tree_prefix(msa_file)}.treefile"))
+                self._record(tree_dir, msa_file, job["digest"], [f"{tree_prefix(msa_file)}.treefile"])
+        else:
+            self.manifests[job["output_dir"]]["items"].pop(job["msa_file"], None)
+            self.failed += 1 + len(followers)
+            tqdm.write(f"Tree computation for {job['msa_file']} ({job['kind']}) failed: {status}")
+        return status
+
+    # Run ----------------------------------------------------------------------------------------------------
+
+    def execute(self):
+        self.open_families()
+        report_path = os.path.join("trees/tree_results", self.args.basename, REPORT_NAME)
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+        with open(report_path, "w") as report:
+            report.write("task\tkind\tfamily\tcores\twall_time_s\tstatus\n")
+            for job, cores, result, wall_time in run_scheduled(self.pending, self.args.cpu_cores, self.run, self.cores_for,
+                                                               desc="Families, alignments and trees", unit="task",
+                                                               max_jobs=self.args.max_processes, refill=self.refill):
+                status = self.complete(job, result)
+                report.write(f"{job['task']}\t{job['kind']}\t{job.get('family', job.get('msa_file'))}\t{cores}\t{wall_time:.3f}\t{status}\n")
+                self.completed += 1
+                if self.completed % SAVE_EVERY == 0:
+                    report.flush()
+                    self._save_manifests()
+        self.close_families()
+
+        # Remove results of families which no longer exist, then save every stage manifest.
+        for output_dir, manifest in self.manifests.items():
+            remove_stale_items(manifest, self.seen[output_dir], output_dir)
+        self._save_manifests()
+        print(f"{self.completed} tasks completed, {self.failed} failed. Report saved to {report_path}")
+        if self.cache is not None:
+            print(self.cache.summary())
+
+    def merge(self):
+        """
+        Merge gene trees into the tree sets used by the following steps (same as make_trees.py).
+        """
+        args = self.args
+        options = {"num_processes": args.cpu_cores, "compression": args.compression, "compression_threads": args.compression_threads}
+        for kind in KINDS:
+            plain_dir, boot_dir = self.dirs[kind]["plain"], self.dirs[kind]["boot"]
+            if args.bootstrap > 0 and args.single_pass:
+                merge_single_pass(boot_dir, plain_dir, args.support_threshold, **options)
+                continue
+            merge_results(plain_dir, output_file="all_trees.txt", **options)
+            if args.bootstrap > 0:
+                merge_results(boot_dir, output_file="all_trees_bootstrap.txt", eliminate_trees=True, support_threshold=args.support_threshold, **options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script for computing protein families, alignments and gene trees as one overlapping per-family task graph.")
+    parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
+    parser.add_argument("--min_cluster_size", required=True, type=int, help="Minimum number of sequences in clusters.")
+    parser.add_argument("--layout", choices=["files", "archive"], default="files", help="Write one FASTA file per family (files) or a single indexed family archive (archive).")
+    parser.add_argument("--dedup", action="store_true", help="Clusters were computed on deduplicated sequences; expand them to all identical members.")
+    parser.add_argument("--compression", choices=CODECS, default="none", help="Codec of family files, alignments and merged tree sets.")
+    parser.add_argument("--compression_threads", type=int, default=1, help="Number of threads compressing the merged tree sets.")
+    parser.add_argument("--cpu_cores", required=True, type=int, help="Number of CPU cores shared by all MAFFT and IQ-TREE processes.")
+    parser.add_argument("--max_processes", type=int, default=None, help="Maximum number of tool processes running at once (default: cpu_cores).")
+    parser.add_argument("--thread_cost", type=float, default=200_000, help="Estimated family cost (sequences x mean length) per additional MAFFT thread.")
+    parser.add_argument("--max_msa_threads", type=int, default=8, help="Maximum number of MAFFT threads for a single family.")
+    parser.add_argument("--trim", action="store_true", help="Trim alignments (allignment/trim_alignments.py) before tree computation.")
+    parser.add_argument("--max_gap_fraction", type=float, default=0.5, help="Trimming: columns with a larger fraction of gaps are removed.")
+    parser.add_argument("--max_conservation", type=float, default=1.1, help="Trimming: columns whose most common residue reaches this frequency are removed (above 1 - none).")
+    parser.add_argument("--fused", action="store_true", help="Pass alignments from MAFFT to IQ-TREE in memory and run IQ-TREE in memory-backed storage, keeping only its treefile.")
+    parser.add_argument("--keep_alignments", action="store_true", help="Fused mode: also write the alignments (and trimmed alignments) to their directories.")
+    parser.add_argument("--bootstrap", required=True, type=int, help="Number of bootstrap replicates.")
+    parser.add_argument("--support_threshold", required=True, type=float, help="Threshold for mean bootstrap support in Tree.")
+    parser.add_argument("--single_pass", action="store_true", help="Compute every tree once with bootstrap and derive both the plain and the bootstrapped tree sets from it.")
+    parser.add_argument("--ufboot", action="store_true", help="Use ultrafast bootstrap (-B, at least 1000 replicates) instead of the standard bootstrap (-b).")
+    parser.add_argument("--cells_per_core", type=float, default=20_000, help="Alignment cells (taxa x sites) per IQ-TREE thread.")
+    parser.add_argument("--max_tree_threads", type=int, default=16, help="Maximum number of threads of a single IQ-TREE process.")
+    parser.add_argument("--cache_dir", default=None, help="Directory of the result cache shared between runs (disabled if not given).")
+    parser.add_argument("--cache_size_gb", type=float, default=50.0, help="Size limit of the result cache in GB (least recently used results are evicted).")
+    args = parser.parse_args()
+    track_stage("pipeline")
+
+    if args.ufboot and 0 < args.bootstrap < 1000:
+        print(f"Ultrafast bootstrap requires at least 1000 replicates, using 1000 instead of {args.bootstrap}.")
+        args.bootstrap = 1000
+
+    pipeline = FamilyPipeline(args)
+    pipeline.execute()
+    pipeline.merge()
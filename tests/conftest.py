@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+STUBS_DIR = os.path.join(REPO_DIR, "benchmarks", "stubs")
+
+
+@pytest.fixture
+def stubs(monkeypatch):
+    """
+    Put the stand-ins for the external tools (benchmarks/stubs) first on PATH.
+    """
+    monkeypatch.setenv("PATH", STUBS_DIR + os.pathsep + os.environ["PATH"])
+    return STUBS_DIR
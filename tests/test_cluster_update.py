@@ -0,0 +1,66 @@
+import os
+import json
+
+import pytest
+
+from benchmarks.generate_data import protein_id
+from clustering.cluster import mmseqs2_cluster_update, CLUSTER_TSV_NAME, CLUSTER_DIFF_NAME
+
+
+@pytest.fixture
+def run_update(tmp_path, stubs):
+    """
+    Run an update with the MMseqs2 stub over proteins given as (family, genome, copy).
+    """
+    def run(proteins, min_seq_id=0.5):
+        fasta = tmp_path / "combined.faa"
+        fasta.write_text("".join(f">{protein_id(*protein)}\nMKV\n" for protein in proteins))
+        mmseqs2_cluster_update(str(fasta), str(tmp_path / "out"), str(tmp_path / "db"), str(tmp_path / "tmp"), min_seq_id=min_seq_id)
+        with open(tmp_path / "db" / "current.json") as f:
+            current = json.load(f)
+        with open(tmp_path / "out" / CLUSTER_DIFF_NAME) as f:
+            diff = dict(line.rstrip("\n").split("\t") for line in f)
+        return current["generation"], diff
+    return run
+
+
+def representative(family: int) -> str:
+    return protein_id(family, 0, 0)
+
+
+def test_generations_and_diff(run_update, tmp_path):
+    genomes = [(family, genome, 0) for family in (0, 1) for genome in (0, 1)]
+    generation, diff = run_update(genomes)
+    assert generation == 0
+    assert diff == {representative(0): "added", representative(1): "added"}
+
+    # A new genome with a member of family 1 and a new family.
+    generation, diff = run_update(genomes + [(1, 2, 0), (2, 0, 0)])
+    assert generation == 1
+    assert diff == {representative(1): "changed", representative(2): "added"}
+    assert sorted(os.listdir(tmp_path / "db")) == ["current.json", "gen_1"]
+
+    generation, diff = run_update([(1, 0, 0), (2, 0, 0)])
+    assert generation == 2
+    assert diff == {representative(0): "removed", representative(1): "changed"}
+    assert (tmp_path / "out" / CLUSTER_TSV_NAME).read_text().split() == [representative(1)] * 2 + [representative(2)] * 2
+
+    # Unchanged input: nothing to report.
+    assert run_update([(1, 0, 0), (2, 0, 0)]) == (3, {})
+
+
+def test_leftover_generation_is_replaced(run_update, tmp_path):
+    run_update([(0, 0, 0)])
+    leftover = tmp_path / "db" / "gen_1"
+    leftover.mkdir()
+    (leftover / "seqDB").write_text("interrupted")
+
+    assert run_update([(0, 0, 0), (0, 1, 0)]) == (1, {representative(0): "changed"})
+    assert sorted(os.listdir(leftover)) == ["clusterDB", "seqDB"]
+
+
+def test_changed_parameters_recluster_from_scratch(run_update, capsys):
+    run_update([(0, 0, 0)])
+    capsys.readouterr()
+    assert run_update([(0, 0, 0)], min_seq_id=0.7) == (1, {})
+    assert "from scratch" in capsys.readouterr().out
@@ -0,0 +1,39 @@
+from trees.make_consensus_tree import count_splits, select_splits, consensus_newick, make_consensus_tree, CONSENSUS_NAME
+
+TAXA = ["A", "B", "C", "D", "E", "F"]
+TREES = [
+    "((A:0.1,B:0.1)90:0.1,(C:0.1,D:0.1)80:0.1,(E:0.1,F:0.1)70:0.1);",
+    "((A,B),C,(D,(E,F)));",
+    "((A,C),(B,D),(F,E));",
+    # Skipped: a taxon missing, a different taxon.
+    "(A,B,(C,D),E);",
+    "((A,B),(C,D),(E,G));",
+]
+# Splits (side without A): {E,F} in 3 trees, {C,D,E,F} in 2, {C,D}, {D,E,F}, {B,D,E,F} and {B,D} in 1.
+MAJORITY = "(((E,F)100,C,D)67,A,B);"
+
+
+def test_majority_rule_consensus():
+    counts, used, skipped = count_splits(TREES, TAXA, 1)
+
+    assert (used, skipped) == (3, 2)
+    assert sorted(counts.values(), reverse=True) == [3, 2, 1, 1, 1, 1]
+    accepted = select_splits(counts, used, len(TAXA), 0.5)
+    assert consensus_newick(accepted, TAXA, used) == MAJORITY
+
+
+def test_consensus_file(tmp_path, capsys):
+    trees = tmp_path / "all_trees.txt"
+    trees.write_text("\n".join(TREES) + "\n")
+
+    assert make_consensus_tree(str(trees), str(tmp_path / "out"), 0.5, 1) == "Success"
+    assert (tmp_path / "out" / CONSENSUS_NAME).read_text() == MAJORITY + "\n"
+    assert "Skipped 2 tree(s)" in capsys.readouterr().out
+
+
+def test_greedy_consensus_skips_incompatible_splits():
+    counts, used, _ = count_splits(TREES, TAXA, 1)
+
+    # {B,D} conflicts with {C,D,E,F}; {C,D} resolves the tree.
+    accepted = select_splits(counts, used, len(TAXA), 0)
+    assert consensus_newick(accepted, TAXA, used) == "(((E,F)100,(C,D)33)67,A,B);"
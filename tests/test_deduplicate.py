@@ -0,0 +1,16 @@
+from clustering.deduplicate import deduplicate_proteins, load_duplicates, UNIQUE_FASTA_NAME, DUPLICATES_NAME
+
+
+def test_identical_sequences_are_collapsed(tmp_path):
+    fasta = tmp_path / "combined.faa"
+    fasta.write_text(
+        ">WP_1 genome A\nMKV\nLL\n"
+        ">WP_2 genome A\nMKA\n"
+        ">WP_1 genome B\nMKVLL\n"  # Same ID and sequence in another genome
+        ">XP_3 genome B\nMKVLL\n"
+        ">XP_4 genome B\nMKA\n"
+    )
+
+    assert deduplicate_proteins(str(fasta), str(tmp_path / "out")) == (5, 2)
+    assert (tmp_path / "out" / UNIQUE_FASTA_NAME).read_text() == ">WP_1 genome A\nMKVLL\n>WP_2 genome A\nMKA\n"
+    assert load_duplicates(str(tmp_path / "out" / DUPLICATES_NAME)) == {"WP_1": ["WP_1", "XP_3"], "WP_2": ["XP_4"]}
@@ -0,0 +1,98 @@
+import os
+import json
+import stat
+
+import pytest
+
+from benchmarks.generate_data import generate_dataset, accession, ARCHIVES_DIRNAME
+from benchmarks.stub_tools import ARCHIVE_DIR_ENV
+from data_preparation.prepare_data import download_accession, fetch_proteomes_ncbi_datasets, load_download_journal, DOWNLOAD_JOURNAL_NAME
+
+NUM_GENOMES = 3
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch, stubs):
+    """
+    Synthetic proteome archives served by the datasets stub. Returns the accession file.
+    """
+    data_dir = str(tmp_path / "data")
+    accession_file = generate_dataset(data_dir, NUM_GENOMES, 20)
+    monkeypatch.setenv(ARCHIVE_DIR_ENV, os.path.join(data_dir, ARCHIVES_DIRNAME))
+    return accession_file
+
+
+def wrapper(path, body: str) -> str:
+    """
+    datasets executable running body before handing over to the stub; the accession is $4.
+    """
+    with open(path, "w") as f:
+        f.write(f"#!/bin/sh\n{body}\nexec datasets \"$@\"\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def test_download_retries_failed_attempts(dataset, tmp_path):
+    marker = tmp_path / "failed_once"
+    flaky = wrapper(tmp_path / "flaky_datasets", f"[ -e {marker} ] || {{ touch {marker}; exit 1; }}")
+    output_dir = tmp_path / "proteomes"
+    output_dir.mkdir()
+
+    record = download_accession(accession(0), str(output_dir), datasets_bin=flaky, max_retries=3, backoff=0)
+
+    assert record["status"] == "done"
+    assert record["attempts"] == 2
+    assert record["size"] == os.path.getsize(output_dir / f"{accession(0)}.zip")
+    assert not (output_dir / f"{accession(0)}.part.zip").exists()
+
+
+def test_download_gives_up_after_max_retries(dataset, tmp_path):
+    output_dir = tmp_path / "proteomes"
+    output_dir.mkdir()
+
+    record = download_accession("GCF_999999999.1", str(output_dir), max_retries=3, backoff=0)
+
+    assert record["status"] == "failed"
+    assert record["attempts"] == 3
+    assert record["error"] == "Failed (Code 1)"
+    assert os.listdir(output_dir) == []
+
+
+def test_rerun_fetches_only_missing_and_corrupt_archives(dataset, tmp_path):
+    log = tmp_path / "downloads.log"
+    counting = wrapper(tmp_path / "counting_datasets", f"echo \"$4\" >> {log}")
+    output_dir = tmp_path / "proteomes"
+
+    assert fetch_proteomes_ncbi_datasets(dataset, str(output_dir), num_workers=2, backoff=0, datasets_bin=counting) == []
+    assert sorted(log.read_text().split()) == [accession(genome) for genome in range(NUM_GENOMES)]
+    journal = load_download_journal(str(output_dir / DOWNLOAD_JOURNAL_NAME))
+    assert {record["status"] for record in journal.values()} == {"done"}
+
+    # An interrupted run: one archive missing, one truncated, a partial journal line.
+    os.remove(output_dir / f"{accession(0)}.zip")
+    with open(output_dir / f"{accession(1)}.zip", "r+b") as f:
+        f.truncate(10)
+    with open(output_dir / DOWNLOAD_JOURNAL_NAME, "a") as f:
+        f.write(json.dumps({"accession": accession(2), "status": "done"})[:20])
+    log.unlink()
+
+    assert fetch_proteomes_ncbi_datasets(dataset, str(output_dir), num_workers=2, backoff=0, datasets_bin=counting) == []
+    assert sorted(log.read_text().split()) == [accession(0), accession(1)]
+    journal = load_download_journal(str(output_dir / DOWNLOAD_JOURNAL_NAME))
+    assert all(record["size"] == os.path.getsize(output_dir / f"{name}.zip") for name, record in journal.items())
+
+
+def test_failed_downloads_are_journaled_and_retried(dataset, tmp_path, monkeypatch):
+    output_dir = tmp_path / "proteomes"
+    archive_dir = os.environ[ARCHIVE_DIR_ENV]
+    monkeypatch.setenv(ARCHIVE_DIR_ENV, str(tmp_path / "unavailable"))
+
+    failed = fetch_proteomes_ncbi_datasets(dataset, str(output_dir), max_retries=2, backoff=0)
+
+    assert sorted(failed) == [accession(genome) for genome in range(NUM_GENOMES)]
+    journal = load_download_journal(str(output_dir / DOWNLOAD_JOURNAL_NAME))
+    assert {(record["status"], record["attempts"]) for record in journal.values()} == {("failed", 2)}
+
+    monkeypatch.setenv(ARCHIVE_DIR_ENV, archive_dir)
+    assert fetch_proteomes_ncbi_datasets(dataset, str(output_dir), backoff=0) == []
+    assert all(record["status"] == "done" for record in load_download_journal(str(output_dir / DOWNLOAD_JOURNAL_NAME)).values())
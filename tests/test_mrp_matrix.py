@@ -0,0 +1,44 @@
+import numpy as np
+
+from trees.mrp_matrix import tree_characters, write_mrp_matrix
+from trees.newick import parse_newick
+
+TAXA = ["A", "B", "C", "D", "E", "F"]
+TREES = [
+    "((A:0.1,B:0.1)90:0.1,(C:0.1,D:0.1)80:0.1,(E:0.1,F:0.1)70:0.1);",
+    # Paralogs: A has leaves on both sides of two clades, the clade (A,D) has a single taxon coded 1.
+    "((A:0.1,B:0.1,C:0.1):0.1,(A:0.1,D:0.1):0.1,(E:0.1,F:0.1):0.1);",
+    # E and F are absent.
+    "(A,(B,C),D);",
+]
+# Characters in tree and preorder: (A,B) (C,D) (E,F) | (A,B,C) (E,F) | (B,C)
+MATRIX = {
+    "A": "100?00",
+    "B": "100101",
+    "C": "010101",
+    "D": "010000",
+    "E": "00101?",
+    "F": "00101?",
+}
+
+
+def unpack(masks: np.ndarray) -> np.ndarray:
+    return np.unpackbits(masks, axis=1)[:, :len(TAXA)].astype(bool)
+
+
+def test_tree_characters_with_paralogs():
+    inside, outside = tree_characters(parse_newick(TREES[1]), {taxon: i for i, taxon in enumerate(TAXA)}, len(TAXA))
+
+    # (A,B,C): A inside and outside; (A,D) is uninformative; (E,F): A outside twice.
+    assert unpack(inside).tolist() == [[True, True, True, False, False, False], [False, False, False, False, True, True]]
+    assert unpack(outside).tolist() == [[True, False, False, True, True, True], [True, True, True, True, False, False]]
+
+
+def test_mrp_matrix(tmp_path):
+    tree_file, matrix_file = tmp_path / "trees.nwk", tmp_path / "mrp_matrix.phy"
+    tree_file.write_text("\n".join(TREES) + "\n")
+
+    assert write_mrp_matrix(str(tree_file), str(matrix_file), num_processes=1) == (6, 6)
+    lines = matrix_file.read_text().splitlines()
+    assert lines[0] == "6 6"
+    assert dict(line.split(" ") for line in lines[1:]) == MATRIX
@@ -0,0 +1,44 @@
+import os
+
+from trees.make_trees import run_tree_batch, run_tree_computation, match_batch_trees, batch_tag
+from trees.newick import tip_labels
+
+
+def tagged_tree(index: int, labels: list) -> str:
+    return "(" + ",".join(f"{batch_tag(index)}{label}:0.1" for label in labels) + ")95:0.0;"
+
+
+def test_trees_are_matched_by_tags_not_order():
+    trees = [tagged_tree(2, "abc"), tagged_tree(0, "def"), tagged_tree(1, "ghi")]
+
+    assert match_batch_trees(trees, [3, 3, 3]) == {0: "(d:0.1,e:0.1,f:0.1)95:0.0;", 1: "(g:0.1,h:0.1,i:0.1)95:0.0;",
+                                                   2: "(a:0.1,b:0.1,c:0.1)95:0.0;"}
+
+
+def test_ambiguous_or_incomplete_trees_are_not_matched():
+    trees = [tagged_tree(0, "abc"), tagged_tree(0, "abd"), tagged_tree(1, "ab"), "(B000002_a,B000001_b,B000002_c);"]
+
+    assert match_batch_trees(trees, [3, 3, 3]) == {}
+
+
+def test_batch_matches_single_runs(tmp_path, stubs):
+    msa_dir = tmp_path / "msa"
+    msa_dir.mkdir()
+    msa_files = []
+    for family in range(3):
+        msa_file = f"OG{family}-aligned.fasta"
+        (msa_dir / msa_file).write_text("".join(f">SP{family}_{genome}_0\nMKV-\n" for genome in range(4)))
+        msa_files.append(msa_file)
+    batch_dir, single_dir = tmp_path / "batch", tmp_path / "single"
+    batch_dir.mkdir()
+    single_dir.mkdir()
+
+    results = run_tree_batch(msa_files, str(msa_dir), str(batch_dir), 1, 0, [None] * 3, [(4, 4)] * 3)
+    assert [status for _, status, _ in results] == ["Success"] * 3
+    for msa_file in msa_files:
+        assert run_tree_computation(msa_file, str(msa_dir), str(single_dir), 1, 0)[1] == "Success"
+        prefix = msa_file.split("-")[0]
+        batch_tree = (batch_dir / f"{prefix}.treefile").read_text()
+        assert batch_tree == (single_dir / f"{prefix}.treefile").read_text()
+        assert sorted(tip_labels(batch_tree)) == [f"SP{prefix[2:]}_{genome}_0" for genome in range(4)]
+    assert sorted(os.listdir(batch_dir)) == sorted(f"{msa_file.split('-')[0]}.treefile" for msa_file in msa_files)
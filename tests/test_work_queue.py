@@ -0,0 +1,98 @@
+import time
+import socket
+import threading
+
+import pytest
+
+from common import work_queue
+from common.work_queue import JobQueue, WorkQueue, run_queued, run_worker, _connect
+
+LEASE_TIMEOUT = 0.2
+AUTHKEY = "test"
+
+
+def expire_leases():
+    time.sleep(LEASE_TIMEOUT * 1.5)
+
+
+def test_expired_lease_is_requeued_first():
+    queue = JobQueue(lease_timeout=LEASE_TIMEOUT)
+    first, second = queue.submit(["a", "b"])
+    assert queue.lease("lost") == (first, "a")
+
+    expire_leases()
+    assert queue.collect(0) == ([], [("lost", [first])])
+    assert queue.lease("other") == (first, "a")
+    assert queue.lease("other") == (second, "b")
+
+
+def test_heartbeat_keeps_leases():
+    queue = JobQueue(lease_timeout=LEASE_TIMEOUT)
+    job_id, = queue.submit(["a"])
+    queue.lease("worker")
+    for _ in range(3):
+        time.sleep(LEASE_TIMEOUT / 2)
+        queue.heartbeat("worker")
+
+    assert queue.collect(0) == ([], [])
+    queue.complete("worker", job_id, 1, "A", 0.1)
+    assert queue.collect(0) == ([(job_id, "worker", 1, "A", 0.1, None)], [])
+
+
+def test_result_is_accepted_once():
+    queue = JobQueue(lease_timeout=LEASE_TIMEOUT)
+    job_id, = queue.submit(["a"])
+    queue.lease("slow")
+    expire_leases()
+    queue.collect(0)
+    queue.lease("other")
+
+    queue.complete("slow", job_id, 1, "late", 0.1)
+    queue.complete("other", job_id, 1, "A", 0.1)
+    assert queue.collect(0)[0] == [(job_id, "slow", 1, "late", 0.1, None)]
+    assert queue.lease("other") is None
+
+
+def test_job_fails_after_max_attempts():
+    queue = JobQueue(lease_timeout=LEASE_TIMEOUT, max_attempts=2)
+    job_id, = queue.submit(["a"])
+    for worker in ("first", "second"):
+        assert queue.lease(worker) == (job_id, "a")
+        expire_leases()
+        results, lost = queue.collect(0)
+        assert lost == [(worker, [job_id])]
+
+    assert results == [(job_id, "second", 0, None, 0.0, "Lease lost 2 times (last worker: second)")]
+    assert queue.lease("third") is None
+
+
+def double(job, cores):
+    return job * 2
+
+
+def one_core(job, free_cores, num_pending):
+    return 1
+
+
+@pytest.fixture
+def coordinator(monkeypatch):
+    monkeypatch.setattr(work_queue, "POLL_INTERVAL", 0.05)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return WorkQueue(f"127.0.0.1:{port}", AUTHKEY, lease_timeout=LEASE_TIMEOUT)
+
+
+def test_jobs_of_a_lost_worker_are_run_by_another(coordinator):
+    def lose_a_job():
+        # A worker which leases a job and disappears without heartbeats, then a working one.
+        lost = _connect(coordinator.address, AUTHKEY)
+        while lost.lease("lost:1") is None:
+            time.sleep(0.01)
+        threading.Thread(target=run_worker, args=(coordinator.address, AUTHKEY, 2, 1.0), daemon=True).start()
+
+    threading.Thread(target=lose_a_job, daemon=True).start()
+    jobs = list(range(5))
+    completed = sorted((job, result) for job, _, result, _ in run_queued(jobs, coordinator, double, one_core))
+
+    assert completed == [(job, job * 2) for job in jobs]
@@ -0,0 +1,257 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+import numpy as np
+import hashlib
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import load_manifest, save_manifest, pending_items, remove_stale_items
+from common.telemetry import track_stage, timed
+from common.compression import CODECS, read_file, strip_codec
+from allignment.trim_alignments import parse_alignment
+from trees.make_trees import merge_results, merge_single_pass, tree_prefix, TIMINGS_NAME
+
+# Draft trees: neighbor joining on protein distances, computed in-process without IQ-TREE. Trees are written
+# as <family>.treefile in the tree result directories, so merging, consensus and supertree steps are unchanged.
+
+DISTANCES = ["p", "poisson"]
+RESIDUES = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+MAX_DISTANCE = {"p": 1.0, "poisson": 10.0}  # Saturated pairs and pairs without shared sites
+_CODES = np.full(256, -1, dtype=np.int8)
+_CODES[RESIDUES] = np.arange(len(RESIDUES))
+_UNSAFE = re.compile(r"[^A-Za-z0-9_\-.|/]")
+
+
+def tip_name(name: str) -> str:
+    """
+    Sequence name as written by IQ-TREE (characters other than letters, digits and _-.|/ replaced by _).
+    """
+    return _UNSAFE.sub("_", name)
+
+
+def encode_alignment(matrix: np.ndarray) -> np.ndarray:
+    """
+    Residue indices (0-19) of an alignment matrix of upper case residue codes; gaps and ambiguous residues are -1.
+    """
+    return _CODES[matrix]
+
+
+def pairwise_distances(encoded: np.ndarray, distance: str = "poisson", weights: np.ndarray = None) -> np.ndarray:
+    """
+    Pairwise distances between the sequences of an encoded alignment over the sites where both have a residue:
+    p-distance (fraction of differing sites) or Poisson-corrected distance (-ln(1 - p)). Matching and shared
+    sites of all pairs are counted with one matrix product per residue. weights (per site) count every site as
+    many times as it was drawn by a bootstrap replicate.
+    """
+    num_sequences, num_sites = encoded.shape
+    weights = np.ones(num_sites, dtype=np.float32) if weights is None else weights.astype(np.float32)
+    valid = (encoded >= 0).astype(np.float32)
+    shared = (valid * weights) @ valid.T
+    matching = np.zeros((num_sequences, num_sequences), dtype=np.float32)
+    for residue in range(len(RESIDUES)):
+        present = (encoded == residue).astype(np.float32)
+        matching += (present * weights) @ present.T
+    p = 1.0 - np.divide(matching, shared, out=np.zeros(shared.shape), where=shared > 0)
+    distances = -np.log(np.maximum(1.0 - p, np.exp(-MAX_DISTANCE["poisson"]))) if distance == "poisson" else p
+    distances[shared == 0] = MAX_DISTANCE[distance]
+    np.fill_diagonal(distances, 0.0)
+    return distances
+
+
+def neighbor_joining(distances: np.ndarray):
+    """
+    Neighbor joining (Saitou & Nei) on a distance matrix. Each step evaluates the Q criterion of all pairs of
+    remaining nodes at once; negative branch lengths are set to zero. The tree is unrooted, with a trifurcation
+    at the last three nodes joined.
+
+    Returns:
+    - children: list, Child nodes (index, branch length) of every node; tips are nodes 0..n-1, the root is the last node.
+    """
+    num_tips = len(distances)
+    children = [[] for _ in range(num_tips)]
+    if num_tips == 1:
+        return children
+    if num_tips == 2:
+        children.append([(0, distances[0, 1] / 2), (1, distances[0, 1] / 2)])
+        return children
+
+    matrix = distances.astype(np.float64, copy=True)
+    active = np.arange(num_tips)  # Matrix rows of the remaining nodes
+    nodes = list(range(num_tips))  # Node joined in each matrix row
+    while len(active) > 3:
+        m = len(active)
+        sub = matrix[np.ix_(active, active)]
+        totals = sub.sum(axis=1)
+        q = (m - 2) * sub - totals[:, None] - totals[None, :]
+        np.fill_diagonal(q, np.inf)
+        a, b = np.unravel_index(np.argmin(q), q.shape)
+        length_a = 0.5 * sub[a, b] + (totals[a] - totals[b]) / (2 * (m - 2))
+        length_b = sub[a, b] - length_a
+        i, j = active[a], active[b]
+        children.append([(nodes[i], max(length_a, 0.0)), (nodes[j], max(length_b, 0.0))])
+        # The joined node takes the row of i.
+        merged = 0.5 * (matrix[i, active] + matrix[j, active] - sub[a, b])
+        matrix[i, active] = merged
+        matrix[active, i] = merged
+        matrix[i, i] = 0.0
+        nodes[i] = len(children) - 1
+        active = np.delete(active, b)
+
+    i, j, k = active
+    d_ij, d_ik, d_jk = matrix[i, j], matrix[i, k], matrix[j, k]
+    children.append([(nodes[i], max(0.5 * (d_ij + d_ik - d_jk), 0.0)), (nodes[j], max(0.5 * (d_ij + d_jk - d_ik), 0.0)),
+                     (nodes[k], max(0.5 * (d_ik + d_jk - d_ij), 0.0))])
+    return children
+
+
+def tree_splits(children: list, num_tips: int) -> list:
+    """
+    Split (bitmask of the tips below, on the side without tip 0) of every node, None for tips and the root.
+    """
+    full = (1 << num_tips) - 1
+    below = [1 << node if node < num_tips else 0 for node in range(len(children))]
+    splits = [None] * len(children)
+    for node in range(num_tips, len(children)):  # Children are created before their parents
+        for child, _ in children[node]:
+            below[node] |= below[child]
+        if node < len(children) - 1:
+            splits[node] = full ^ below[node] if below[node] & 1 else below[node]
+    return splits
+
+
+def to_newick(children: list, names: list, supports: list = None) -> str:
+    """
+    Newick string of a tree from neighbor_joining, with the supports of internal nodes (if given) as node labels.
+    """
+    text = list(names)
+    for node in range(len(names), len(children)):  # Children are created before their parents
+        subtrees = ",".join(f"{text[child]}:{length + 0.0:.10g}" for child, length in children[node])  # + 0.0: no "-0"
+        label = f"{supports[node]}" if supports is not None and supports[node] is not None else ""
+        text.append(f"({subtrees}){label}")
+    return text[-1] + ";"
+
+
+@timed
+def draft_tree(msa_file: str, msa_path: str, output_dir: str, distance: str = "poisson", bootstrap: int = 0):
+    """
+    Compute a neighbor joining tree of one alignment and write it to output_dir as <family>.treefile.
+    With bootstrap > 0 internal nodes carry the percentage of bootstrap replicates (sites resampled
+    with replacement) which contain their split. Replicates are drawn from a generator seeded with
+    the alignment content, so trees are reproducible.
+
+    Returns:
+    - (msa_file, status, stats): tuple, stats holds the number of taxa and sites.
+    """
+    exact_filepath = os.path.join(msa_path, msa_file)
+    treefile = os.path.join(output_dir, f"{tree_prefix(msa_file)}.treefile")
+    try:
+        data = read_file(exact_filepath)
+        names, matrix = parse_alignment(data, exact_filepath)
+        if not names:
+            return (msa_file, "Empty alignment", {})
+        encoded = encode_alignment(matrix)
+        num_tips, num_sites = encoded.shape
+        children = neighbor_joining(pairwise_distances(encoded, distance))
+
+        supports = None
+        if bootstrap > 0 and num_tips > 3:
+            splits = tree_splits(children, num_tips)
+            counts = {split: 0 for split in splits if split is not None}
+            rng = np.random.default_rng(int.from_bytes(hashlib.sha256(data).digest()[:8], "little"))
+            for _ in range(bootstrap):
+                weights = np.bincount(rng.integers(0, num_sites, num_sites), minlength=num_sites) if num_sites else None
+                replicate = neighbor_joining(pairwise_distances(encoded, distance, weights))
+                for split in set(tree_splits(replicate, num_tips)):
+                    if split in counts:
+                        counts[split] += 1
+            supports = [None if split is None else round(100 * counts[split] / bootstrap) for split in splits]
+
+        with open(treefile + ".tmp", "w") as f:
+            f.write(to_newick(children, [tip_name(name) for name in names], supports) + "\n")
+        os.replace(treefile + ".tmp", treefile)
+        return (msa_file, "Success", {"taxa": num_tips, "sites": num_sites})
+    except FileNotFoundError as e:
+        return (msa_file, "File Not Found", {})
+    except Exception as e:
+        if os.path.exists(treefile + ".tmp"):
+            os.remove(treefile + ".tmp")
+        return (msa_file, f"Unexpected Error: {e}", {})
+
+
+def _draft_job(arguments):
+    return draft_tree(*arguments)
+
+
+def draft_trees(msa_path: str, output_dir: str, num_processes: int = 4, distance: str = "poisson", bootstrap: int = 0):
+    """
+    Compute neighbor joining trees for all alignments in parallel (same treefile layout as make_trees.make_trees).
+    Alignments unchanged since the last run with the same settings (per the manifest in output_dir) are skipped,
+    and trees of alignments which disappeared are removed. Trees computed by IQ-TREE in output_dir are
+    recomputed, as the settings differ.
+
+    Returns:
+    - failed: list, (family, status) of failed alignments.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    params = {"tool": "nj", "distance": distance, "bootstrap": bootstrap}
+
+    all_msa_files = sorted(f for f in os.listdir(msa_path) if strip_codec(f).endswith("-aligned.fasta"))
+    digests = {f: hashlib.sha256(read_file(os.path.join(msa_path, f))).hexdigest() for f in all_msa_files}
+    remove_stale_items(manifest, digests, output_dir)
+    if manifest["params"] != params:
+        manifest["items"] = {}
+        manifest["params"] = params
+    msa_files = pending_items(manifest, params, digests, output_dir)
+    print(f"{len(all_msa_files) - len(msa_files)} trees up to date, {len(msa_files)} to compute.")
+
+    failed = []
+    jobs = [(msa_file, msa_path, output_dir, distance, bootstrap) for msa_file in msa_files]
+    with open(os.path.join(output_dir, TIMINGS_NAME), "w") as timings, ProcessPoolExecutor(max_workers=num_processes) as executor:
+        timings.write("family\ttaxa\tsites\tstatus\n")
+        results = executor.map(_draft_job, jobs, chunksize=max(1, len(jobs) // (4 * num_processes)))
+        for msa_file, status, stats in tqdm(results, total=len(jobs), desc="Computing draft trees", unit="file"):
+            timings.write(f"{tree_prefix(msa_file)}\t{stats.get('taxa', '')}\t{stats.get('sites', '')}\t{status}\n")
+            if status == "Success":
+                manifest["items"][msa_file] = {"input": digests[msa_file], "outputs": [f"{tree_prefix(msa_file)}.treefile"]}
+            else:
+                tqdm.write(f"Draft tree for {msa_file} failed: {status}")
+                manifest["items"].pop(msa_file, None)
+                failed.append((msa_file, status))
+
+    save_manifest(output_dir, manifest)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script for computing fast draft trees (neighbor joining on protein distances) instead of ML trees.")
+    parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
+    parser.add_argument("--num_processes", type=int, default=4, help="Number of alignments processed in parallel.")
+    parser.add_argument("--distance", choices=DISTANCES, default="poisson", help="Protein distance: p-distance or Poisson-corrected distance.")
+    parser.add_argument("--bootstrap", type=int, default=0, help="Number of bootstrap replicates (neighbor joining on resampled sites).")
+    parser.add_argument("--support_threshold", type=float, default=70.0, help="Threshold for mean bootstrap support in Tree.")
+    parser.add_argument("--trimmed", action="store_true", help="Compute trees from trimmed alignments (allignment/trim_alignments.py).")
+    parser.add_argument("--compression", choices=CODECS, default="none", help="Codec of the merged tree sets (all_trees*.txt).")
+    parser.add_argument("--compression_threads", type=int, default=1, help="Number of compression threads.")
+    args = parser.parse_args()
+    track_stage("draft_trees")
+
+    BASENAME = args.basename
+    MSA_RESULTS = "allignment/trimmed_results" if args.trimmed else "allignment/msa_results"
+    MERGE_OPTIONS = {"num_processes": args.num_processes, "compression": args.compression, "compression_threads": args.compression_threads}
+
+    for kind in ("ortologs", "paralogs"):
+        msa_path = os.path.join(MSA_RESULTS, kind, BASENAME)
+        output_dir = os.path.join("trees/tree_results/", BASENAME, kind)
+        bootstrap_output_dir = os.path.join("trees/tree_results/", BASENAME, f"{kind}_boot")
+        print(f"Computing draft trees of {kind} ...")
+        if args.bootstrap > 0:
+            # The tree of the full alignment does not depend on the replicates: computed once, like make_trees.py --single_pass.
+            draft_trees(msa_path, bootstrap_output_dir, args.num_processes, args.distance, args.bootstrap)
+            merge_single_pass(bootstrap_output_dir, output_dir, args.support_threshold, **MERGE_OPTIONS)
+        else:
+            draft_trees(msa_path, output_dir, args.num_processes, args.distance)
+            merge_results(output_dir, output_file="all_trees.txt", **MERGE_OPTIONS)
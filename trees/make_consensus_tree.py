@@ -1,37 +1,204 @@
-import subprocess
 import argparse
 import os
+import sys
+from itertools import repeat
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import load_manifest, save_manifest, describe_files, stage_is_current
+from common.telemetry import track_stage, timed
+from common.compression import find_variant, open_compressed
+from trees.newick import parse_newick
+
+CONSENSUS_NAME = "consensus_tree.contree"
+SPLITS_REPORT_NAME = "split_frequencies.tsv"
+CHUNK_SIZE = 256
+
+
+def split_bitsets(tree, taxon_index: dict, num_words: int) -> set:
+    """
+    Non-trivial bipartitions (splits) of a parsed tree as bitsets over the taxon set.
+    Every split is one row of num_words uint64 words, normalized to the side without the first taxon,
+    and returned as bytes so it can be counted in a hash table.
+    """
+    num_nodes = len(tree.parent)
+    taxa = np.array([taxon_index[label] for label in tree.labels], dtype=np.int64)
+    bits = np.zeros((num_nodes, num_words), dtype=np.uint64)
+    bits[np.flatnonzero(tree.is_tip), taxa // 64] = np.left_shift(np.uint64(1), (taxa % 64).astype(np.uint64))
+    # Nodes are in preorder, so visiting them backwards sees every child before its parent.
+    parent = tree.parent
+    for node in range(num_nodes - 1, 0, -1):
+        bits[parent[node]] |= bits[node]
+
+    internal = np.flatnonzero(~tree.is_tip[1:]) + 1
+    splits = bits[internal]
+    flip = (splits[:, 0] & np.uint64(1)).astype(bool)
+    splits[flip] ^= bits[0]
+    sizes = np.bitwise_count(splits).sum(axis=1)
+    splits = splits[(sizes > 1) & (sizes < len(taxa) - 1)]
+    return {split.tobytes() for split in splits}
+
+
+def _count_splits(lines: list, taxa: list):
+    """
+    Count splits of a chunk of trees. Trees over a different taxon set (or with repeated taxa) are skipped.
+
+    Returns:
+    - (counts, used, skipped): tuple, Split -> number of trees, number of counted and skipped trees.
+    """
+    taxon_index = {taxon: i for i, taxon in enumerate(taxa)}
+    num_words = (len(taxa) + 63) // 64
+    counts = Counter()
+    used = skipped = 0
+    for line in lines:
+        tree = parse_newick(line)
+        if len(tree.labels) != len(taxa) or set(tree.labels) != taxon_index.keys():
+            skipped += 1
+            continue
+        counts.update(split_bitsets(tree, taxon_index, num_words))
+        used += 1
+    return counts, used, skipped
+
+
+@timed
+def count_splits(lines: list, taxa: list, num_processes: int):
+    """
+    Count splits over all trees, in parallel over chunks of trees.
+    """
+    chunks = [lines[i:i + CHUNK_SIZE] for i in range(0, len(lines), CHUNK_SIZE)]
+    if num_processes == 1 or len(chunks) <= 1:
+        results = list(map(_count_splits, chunks, repeat(taxa)))
+    else:
+        with ProcessPoolExecutor(max_workers=num_processes) as executor:
+            results = list(executor.map(_count_splits, chunks, repeat(taxa)))
+    counts = Counter()
+    used = skipped = 0
+    for chunk_counts, chunk_used, chunk_skipped in results:
+        counts.update(chunk_counts)
+        used += chunk_used
+        skipped += chunk_skipped
+    return counts, used, skipped
+
+
+@timed
+def select_splits(counts: Counter, num_trees: int, num_taxa: int, min_support: float) -> list:
+    """
+    Greedy consensus: splits are taken in order of decreasing frequency if their frequency exceeds
+    min_support and they are compatible with all splits taken so far. With min_support 0.5 this is
+    the majority-rule consensus (splits in more than half of the trees are always compatible),
+    with 0 the greedy (extended majority-rule) consensus.
+
+    Returns:
+    - accepted: list, (split, count) of consensus splits.
+    """
+    num_words = (num_taxa + 63) // 64
+    taken = np.empty((0, num_words), dtype=np.uint64)
+    accepted = []
+    for split, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+        if count / num_trees <= min_support or len(accepted) == num_taxa - 3:
+            break
+        bits = np.frombuffer(split, dtype=np.uint64)
+        common = taken & bits
+        # Both sides exclude the first taxon, so splits are compatible iff they are disjoint or nested.
+        compatible = np.all(common == 0, axis=1) | np.all(common == bits, axis=1) | np.all(common == taken, axis=1)
+        if compatible.all():
+            taken = np.vstack((taken, bits))
+            accepted.append((split, count))
+    return accepted
+
+
+def consensus_newick(accepted: list, taxa: list, num_trees: int) -> str:
+    """
+    Newick string of the consensus tree of compatible splits, rooted at the first taxon's side.
+    Internal nodes are labeled with their split frequency in percent.
+    """
+    clusters = sorted(((int.from_bytes(split, "little"), count) for split, count in accepted),
+                      key=lambda cluster: -cluster[0].bit_count())
+    root = (1 << len(taxa)) - 1
+    children = {root: []}
+    support = {root: None}
+    for i, (bits, count) in enumerate(clusters):
+        # The smallest cluster added so far which contains this one is its parent.
+        parent = next((other for other, _ in reversed(clusters[:i]) if other & bits == bits), root)
+        children[parent].append(bits)
+        children[bits] = []
+        support[bits] = count
+
+    def to_newick(bits: int) -> str:
+        covered = 0
+        parts = []
+        for child in children[bits]:
+            covered |= child
+            parts.append(to_newick(child))
+        leftover = bits & ~covered
+        parts.extend(taxa[i] for i in range(len(taxa)) if leftover >> i & 1)
+        label = "" if support[bits] is None else f"{100 * support[bits] / num_trees:.0f}"
+        return f"({','.join(parts)}){label}"
+
+    return to_newick(root) + ";"
+
+
+def write_split_report(path: str, counts: Counter, accepted: list, taxa: list, num_trees: int):
+    """
+    Write the frequency of every split (taxa on the side without the first taxon) and whether it is in the consensus.
+    """
+    in_consensus = {split for split, _ in accepted}
+    with open(path, "w") as f:
+        f.write("size\tcount\tfrequency\tin_consensus\ttaxa\n")
+        for split, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+            bits = int.from_bytes(split, "little")
+            members = [taxa[i] for i in range(len(taxa)) if bits >> i & 1]
+            f.write(f"{len(members)}\t{count}\t{count / num_trees:.4f}\t{split in in_consensus}\t{','.join(members)}\n")
 
 
 def make_consensus_tree(all_trees_path: str, output_dir: str, min_support: float, cpu_cores: int):
+    """
+    Compute the consensus of gene trees in process. Splits of every tree are encoded as bitsets over the
+    taxon set and counted (in parallel over cpu_cores); the consensus keeps splits by decreasing frequency
+    (see select_splits). Writes consensus_tree.contree and split_frequencies.tsv to output_dir.
+    """
     os.makedirs(output_dir, exist_ok=True)
 
-    output_prefix = os.path.join(output_dir, "consensus_tree")
+    output_path = os.path.join(output_dir, CONSENSUS_NAME)
+
+    if not os.path.exists(all_trees_path):
+        print(f"Input trees not found: {all_trees_path}")
+        return ("File Not Found")
+
+    # Skip when the input trees and the support threshold are unchanged.
+    manifest = load_manifest(output_dir)
+    params = {"min_support": min_support, "method": "bitset"}
+    inputs = describe_files([all_trees_path], manifest["inputs"])
+    if stage_is_current(manifest, params, inputs):
+        print(f"Consensus tree in {output_dir} is up to date!")
+        return ("Up to date")
 
     try:
-        # Prepare the IQ-TREE command
-        command = [
-            "iqtree",
-            "-con", all_trees_path,
-            "-minsup", str(min_support),
-            "-nt", str(cpu_cores),
-            "-pre", output_prefix,
-            #"-quiet"
-        ]
-        
-        # Run the IQ-TREE command
-        result = subprocess.run(command, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        # Return success
+        with open_compressed(all_trees_path, "r") as f:
+            lines = [line.strip() for line in f if line.strip()]
+        if not lines:
+            print(f"No trees in {all_trees_path}")
+            return ("No Trees")
+
+        taxa = sorted(parse_newick(lines[0]).labels)
+        counts, used, skipped = count_splits(lines, taxa, cpu_cores)
+        if skipped:
+            print(f"Skipped {skipped} tree(s) whose taxa differ from the first tree.")
+        accepted = select_splits(counts, used, len(taxa), min_support)
+
+        with open(output_path + ".tmp", "w") as f:
+            f.write(consensus_newick(accepted, taxa, used) + "\n")
+        os.replace(output_path + ".tmp", output_path)
+        write_split_report(os.path.join(output_dir, SPLITS_REPORT_NAME), counts, accepted, taxa, used)
+        print(f"Consensus of {used} trees: {len(accepted)} of {len(counts)} distinct splits kept.")
+
+        outputs = describe_files([output_path])
+        save_manifest(output_dir, {"params": params, "inputs": inputs, "outputs": outputs, "items": {}})
         return ("Success")
-    except subprocess.CalledProcessError as e:
-        return (f"Failed (Code {e.returncode})")
-    except FileNotFoundError as e:
-        return ("File Not Found")
     except Exception as e:
         return (f"Unexpected Error: {e}")
-    
-
 
 
 if __name__ == "__main__":
@@ -40,12 +207,13 @@ if __name__ == "__main__":
     parser.add_argument("--min_support", required=True, type=float, help="Value of Consensus support threshold.")
     parser.add_argument("--cpu_cores", required=True, type=int, help="NUmber of CPU cores.")
     args = parser.parse_args()
+    track_stage("consensus")
 
     BASENAME = args.basename
     MIN_SUPPORT = args.min_support
     CPU_CORES = args.cpu_cores
-    ALL_TREES_PATH = os.path.join("trees/tree_results/", BASENAME, "ortologs", "all_trees.txt")
-    ALL_TREES_PATH_BOOTSTRAP = os.path.join("trees/tree_results/", BASENAME, "ortologs_boot", "all_trees_bootstrap.txt")
+    ALL_TREES_PATH = find_variant(os.path.join("trees/tree_results/", BASENAME, "ortologs", "all_trees.txt"))
+    ALL_TREES_PATH_BOOTSTRAP = find_variant(os.path.join("trees/tree_results/", BASENAME, "ortologs_boot", "all_trees_bootstrap.txt"))
 
     OUTPUT_DIR = os.path.join("trees/consensus_results", BASENAME)
 
@@ -54,5 +222,3 @@ if __name__ == "__main__":
 
     # Make Consensus Tree from ML Trees build on Ortological sequences WITH Bootstrap
     make_consensus_tree(ALL_TREES_PATH_BOOTSTRAP, os.path.join(OUTPUT_DIR, "boostrapped"), MIN_SUPPORT, CPU_CORES)
-
-
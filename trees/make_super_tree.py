@@ -1,17 +1,56 @@
 from typing import Literal
 import subprocess
 import argparse
+import time
 import os
+import sys
 
-def run_r_script(tree_file, output_file, method:Literal["MRP", "RF", "SPR"], n_cores:int):
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import load_manifest, save_manifest, describe_files, stage_is_current
+from common.scheduler import run_checked
+from common.telemetry import track_stage
+from common.compression import decompressed_path, find_variant
+from trees.mrp_matrix import write_mrp_matrix, MRP_MATRIX_NAME
+
+def run_r_script(tree_file, output_file, method:Literal["MRP", "RF", "SPR"], n_cores:int, matrix_backend:Literal["python", "r"]="r"):
+    """
+    Infer a supertree with phangorn. For MRP with the python matrix backend, the MRP matrix is built
+    here (in parallel over n_cores) and R only runs the parsimony search on it; with the r backend
+    R reads the raw trees and builds the matrix itself. Wall times of both steps are printed,
+    so the backends can be compared on the same trees.
+    """
     rscript_path = "Rscript" #Needed to run scripts written in R
     r_script = "trees/super_tree.R"
     multicore = "True" if n_cores>1 else "False"
+
+    if not os.path.exists(tree_file):
+        print(f"Input trees not found: {tree_file}")
+        return
+
+    # Skip when the input trees and the method are unchanged.
+    output_dir = os.path.dirname(output_file)
+    manifest = load_manifest(output_dir)
+    params = {"method": method, "matrix_backend": matrix_backend}
+    inputs = describe_files([tree_file], manifest["inputs"])
+    if stage_is_current(manifest, params, inputs):
+        print(f"Supertree is up to date: {output_file}")
+        return
+
     try:
-        subprocess.run([rscript_path, r_script, tree_file, output_file, method, multicore, str(n_cores)], check=True)
-        print(f"Supertree created successfully: {output_file}")
+        r_input = tree_file
+        if method == "MRP" and matrix_backend == "python":
+            start = time.perf_counter()
+            r_input = os.path.join(output_dir, MRP_MATRIX_NAME)
+            num_taxa, num_characters = write_mrp_matrix(tree_file, r_input, n_cores)
+            print(f"MRP matrix with {num_taxa} taxa and {num_characters} characters built in {time.perf_counter() - start:.2f} s")
+
+        start = time.perf_counter()
+        with decompressed_path(r_input) as input_path:  # Raw trees for the r backend may be compressed
+            run_checked([rscript_path, r_script, input_path, output_file, method, multicore, str(n_cores)], stdout=None)
+        print(f"Supertree created successfully in {time.perf_counter() - start:.2f} s (R, {matrix_backend} matrix): {output_file}")
+        save_manifest(output_dir, {"params": params, "inputs": inputs, "outputs": describe_files([output_file]), "items": {}})
     except subprocess.CalledProcessError as e:
-        print(f"Error running R script: {e}")
+        print(f"Error running R script: {e}\n{e.stderr}")
 
 
 if __name__ == "__main__":
@@ -19,21 +58,23 @@ if __name__ == "__main__":
     parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
     parser.add_argument("--method", required=True, help="Method used to infer SuperTree. Available: MRP, RF, SPR")
     parser.add_argument("--cpu_cores", required=True, type=int, help="Number of CPU cores.")
+    parser.add_argument("--matrix_backend", choices=["python", "r"], default="r", help="Build the MRP matrix in Python (R gets a ready matrix) or in R from the raw trees.")
     args = parser.parse_args()
+    track_stage("supertree")
 
     BASENAME = args.basename
     METHOD = args.method
     CPU_CORES = args.cpu_cores
-    ALL_TREES_PATH = os.path.join("trees/tree_results/", BASENAME, "paralogs", "all_trees.txt")
-    ALL_TREES_PATH_BOOTSTRAP = os.path.join("trees/tree_results/", BASENAME, "paralogs_boot", "all_trees_bootstrap.txt")
+    ALL_TREES_PATH = find_variant(os.path.join("trees/tree_results/", BASENAME, "paralogs", "all_trees.txt"))
+    ALL_TREES_PATH_BOOTSTRAP = find_variant(os.path.join("trees/tree_results/", BASENAME, "paralogs_boot", "all_trees_bootstrap.txt"))
 
     OUTPUT_DIR = os.path.join("trees/super_tree_results", BASENAME)
 
     # Make SuperTree from ML Trees build on Paralogical sequences WITHOUT Bootstrap
     os.makedirs(os.path.join(OUTPUT_DIR, "vanilla"), exist_ok=True)
-    run_r_script(ALL_TREES_PATH, os.path.join(OUTPUT_DIR, "vanilla", "supertree.nwk"), METHOD, CPU_CORES)
+    run_r_script(ALL_TREES_PATH, os.path.join(OUTPUT_DIR, "vanilla", "supertree.nwk"), METHOD, CPU_CORES, args.matrix_backend)
 
     # Make SuperTree from ML Trees build on Paralogical sequences WITH Bootstrap
     os.makedirs(os.path.join(OUTPUT_DIR, "boostrapped"), exist_ok=True)
-    run_r_script(ALL_TREES_PATH_BOOTSTRAP, os.path.join(OUTPUT_DIR, "boostrapped", "supertree.nwk"), METHOD, CPU_CORES)
+    run_r_script(ALL_TREES_PATH_BOOTSTRAP, os.path.join(OUTPUT_DIR, "boostrapped", "supertree.nwk"), METHOD, CPU_CORES, args.matrix_backend)
 
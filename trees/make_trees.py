@@ -1,100 +1,532 @@
-from concurrent.futures import ProcessPoolExecutor
-import subprocess
 import argparse
 from pathlib import Path
 from tqdm import tqdm
 import os
 import re
+import sys
+import glob
+import math
+import shutil
+import hashlib
+import tempfile
+import numpy as np
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import load_manifest, save_manifest, pending_items, remove_stale_items
+from common.scheduler import run_command, run_scheduled
+from common.ledger import resumable_items, open_ledger, append_record, remove_ledger
+from common.result_cache import cache_key, open_result_cache
+from common.telemetry import track_stage, timed
+from common.work_queue import open_work_queue, run_queued, DEFAULT_ADDRESS
+from common.compression import CODECS, TMPFS_DIR, decompressed_path, open_compressed, read_file, remove_variants, strip_codec, with_codec
+from trees.newick import parse_newick, tip_labels, tree_stats, collect_tree_stats, write_stats_table, read_stats_table, STATS_COLUMNS
 
-def run_tree_computation(msa_file: str, msa_path: str, output_dir: str, cpu_cores: int, bootstrap: int):
+
+IQTREE_MODEL = "WAG+I"
+TIMINGS_NAME = "tree_timings.tsv"
+TREE_STATS_NAME = "tree_stats.tsv"
+IQTREE_SUFFIXES = [".iqtree", ".log", ".mldist", ".ckp.gz", ".bionj", ".model.gz", ".boottrees", ".contree", ".splits.nex", ".uniqueseq.phy", ".parstree"]
+
+
+def tree_prefix(msa_file: str) -> str:
+    return msa_file.split('-')[0]
+
+
+def promote_outputs(partial_prefix: str, output_prefix: str):
+    """
+    Rename IQ-TREE outputs written under the partial prefix to their final names.
+    The treefile is moved last, so its presence marks a complete result.
+    """
+    for suffix in IQTREE_SUFFIXES:
+        if os.path.exists(partial_prefix + suffix):
+            os.replace(partial_prefix + suffix, output_prefix + suffix)
+    os.replace(partial_prefix + ".treefile", output_prefix + ".treefile")
+
+
+def remove_outputs(prefix: str):
+    for suffix in IQTREE_SUFFIXES + [".treefile"]:
+        if os.path.exists(prefix + suffix):
+            os.remove(prefix + suffix)
+
+
+def is_valid_treefile(path: str) -> bool:
+    """
+    Check that a treefile is complete: a Newick tree terminated by a semicolon.
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, "r") as f:
+        return f.readline().strip().endswith(";")
+
+
+def run_tree_computation(msa_file: str, msa_path: str, output_dir: str, cpu_cores: int, bootstrap: int, ufboot: bool = False, cache=None, key: str = None):
+    """
+    Run IQ-TREE on a single alignment.
+    With bootstrap > 0 the ML tree in the treefile carries support values, from standard (-b)
+    or ultrafast (-B) bootstrap replicates.
+
+    IQ-TREE writes under a partial prefix; outputs get their final names only after a successful run.
+    An interrupted run leaves its checkpoint under the partial prefix, from which IQ-TREE continues.
+    With a result cache, the treefile is taken from the cache under key if present (IQ-TREE is not run)
+    and stored there otherwise. Compressed alignments are decompressed to memory-backed storage for IQ-TREE.
+
+    Returns:
+    - (msa_file, status, usage): tuple, usage holds exit code, wall time, CPU times and peak RSS of the IQ-TREE process.
+    """
     exact_filepath = os.path.join(msa_path, msa_file)
-    output_prefix = os.path.join(output_dir, f"{msa_file.split('-')[0]}")
+    output_prefix = os.path.join(output_dir, tree_prefix(msa_file))
+    partial_prefix = output_prefix + ".partial"
+    usage = {}
     
     try:
-        # Prepare the IQ-TREE command
-        command = [
-            "iqtree",
-            "-s", exact_filepath,
-            "-T", str(cpu_cores),
-            "-pre", output_prefix,
-            "-m", "WAG+I",
-            "-quiet"
-        ]
+        if cache is not None and cache.get(key, output_prefix + ".treefile"):
+            return (msa_file, "Success", usage)
 
-        if bootstrap > 0:
-            command.extend(["-b", str(bootstrap)])
-        
-        # Run the IQ-TREE command
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        # A previous run finished IQ-TREE but was interrupted before renaming its outputs.
+        if is_valid_treefile(partial_prefix + ".treefile"):
+            promote_outputs(partial_prefix, output_prefix)
+            return (msa_file, "Success", usage)
+
+        with decompressed_path(exact_filepath) as alignment:
+            # Prepare the IQ-TREE command
+            command = [
+                "iqtree",
+                "-s", alignment,
+                "-T", str(cpu_cores),
+                "-pre", partial_prefix,
+                "-m", IQTREE_MODEL,
+                "-quiet"
+            ]
+
+            if bootstrap > 0:
+                command.extend(["-B" if ufboot else "-b", str(bootstrap)])
+
+            # Run the IQ-TREE command
+            returncode, _, usage = run_command(command)
+        if returncode != 0 or not is_valid_treefile(partial_prefix + ".treefile"):
+            remove_outputs(partial_prefix)
+            return (msa_file, f"Failed (Code {returncode})", usage)
         
+        promote_outputs(partial_prefix, output_prefix)
+        if cache is not None:
+            cache.put(key, output_prefix + ".treefile")
         # Return success
-        return (msa_file, "Success")
-    except subprocess.CalledProcessError as e:
-        return (msa_file, f"Failed (Code {e.returncode})")
+        return (msa_file, "Success", usage)
     except FileNotFoundError as e:
-        return (msa_file, "File Not Found")
+        return (msa_file, "File Not Found", usage)
     except Exception as e:
-        return (msa_file, f"Unexpected Error: {e}")
+        return (msa_file, f"Unexpected Error: {e}", usage)
+
+
+def run_tree_in_memory(msa_file: str, alignment: bytes, output_dir: str, cpu_cores: int, bootstrap: int, ufboot: bool = False, cache=None, key: str = None):
+    """
+    Run IQ-TREE on an alignment held in memory (fused align-tree tasks of pipeline.py). The alignment is written
+    to a working directory in memory-backed storage where IQ-TREE also writes all its side files (.log, .iqtree,
+    .mldist, .ckp.gz, ...); only the treefile is moved to output_dir, named as by run_tree_computation, and the
+    working directory is removed. Interrupted runs are therefore not continued from a checkpoint.
+    With a result cache, the treefile is taken from the cache under key if present (IQ-TREE is not run)
+    and stored there otherwise.
+
+    Returns:
+    - (msa_file, status, usage): tuple, See run_tree_computation.
+    """
+    treefile = os.path.join(output_dir, f"{tree_prefix(msa_file)}.treefile")
+    usage = {}
+    work_dir = None
+    try:
+        if cache is not None and cache.get(key, treefile):
+            return (msa_file, "Success", usage)
+
+        work_dir = tempfile.mkdtemp(prefix="iqtree_", dir=TMPFS_DIR)
+        alignment_path = os.path.join(work_dir, strip_codec(msa_file))
+        with open(alignment_path, "wb") as f:
+            f.write(alignment)
+        prefix = os.path.join(work_dir, tree_prefix(msa_file))
+        command = ["iqtree", "-s", alignment_path, "-T", str(cpu_cores), "-pre", prefix, "-m", IQTREE_MODEL, "-quiet"]
+        if bootstrap > 0:
+            command.extend(["-B" if ufboot else "-b", str(bootstrap)])
+        returncode, _, usage = run_command(command)
+        if returncode != 0 or not is_valid_treefile(prefix + ".treefile"):
+            return (msa_file, f"Failed (Code {returncode})", usage)
+
+        shutil.copyfile(prefix + ".treefile", treefile + ".tmp")  # Across file systems, so copied and renamed
+        os.replace(treefile + ".tmp", treefile)
+        if cache is not None:
+            cache.put(key, treefile)
+        return (msa_file, "Success", usage)
+    except FileNotFoundError as e:
+        return (msa_file, "File Not Found", usage)
+    except Exception as e:
+        return (msa_file, f"Unexpected Error: {e}", usage)
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if os.path.exists(treefile + ".tmp"):
+            os.remove(treefile + ".tmp")
+
+
+def batch_tag(index: int) -> str:
+    return f"B{index:06d}_"
+
+
+_BATCH_TAG = re.compile(r"(?<=[(,])(\s*)B(\d{6})_")
+
+
+def match_batch_trees(trees: list, taxa: list) -> dict:
+    """
+    Match the trees of a batch run to the alignments by the tags of their tip labels (see batch_tag).
+    A tree matches when all its tips carry the tag of one alignment and their number is the alignment's
+    number of taxa; alignments with no or several matching trees are left out.
+
+    Parameters:
+    - trees: list, Newick trees of the batch run, in any order.
+    - taxa: list, Number of taxa of the alignments, in batch order.
+
+    Returns:
+    - matched: dict, Position of the alignment in the batch -> its tree without tags.
+    """
+    candidates = {}
+    for tree in trees:
+        labels = tip_labels(tree)
+        tags = {int(tag) for _, tag in _BATCH_TAG.findall(tree)}
+        if not tree.endswith(";") or len(tags) != 1:
+            continue
+        index = tags.pop()
+        if index < len(taxa) and len(labels) == taxa[index] and all(label.startswith(batch_tag(index)) for label in labels):
+            candidates.setdefault(index, []).append(_BATCH_TAG.sub(r"\1", tree))
+    return {index: matches[0] for index, matches in candidates.items() if len(matches) == 1}
+
+
+def run_tree_batch(msa_files: list, msa_path: str, output_dir: str, cpu_cores: int, bootstrap: int, keys: list, dimensions: list,
+                   ufboot: bool = False, cache=None):
+    """
+    Run IQ-TREE once on a batch of small alignments (-S: a separate tree for every alignment file in a directory),
+    which saves the process startup, alignment parsing and model setup of one run per alignment. The trees are
+    split back into one treefile per alignment, named as by run_tree_computation.
+
+    Alignments are copied (compressed ones decompressed) into a directory in memory-backed storage with their taxon
+    labels tagged by the alignment's position in the batch, so every tree is matched to its alignment by its tips
+    rather than by the order in which IQ-TREE writes the trees; the tags are removed from the trees. Alignments
+    without exactly one matching tree (tips of one tag, as many as the alignment's taxa) or of a failed batch run
+    are computed one by one. With a result cache, alignments found in it are left out of the batch.
+
+    Parameters:
+    - keys: list, Result cache keys of the alignments (None entries without a result cache).
+    - dimensions: list, (taxa, sites) of the alignments.
+
+    Returns:
+    - results: list, (msa_file, status, usage) of every alignment, in the order of msa_files. The usage of the batch
+      run is shared out among its alignments by alignment cells (taxa x sites).
+    """
+    results = {}
+    batch = []
+    for msa_file, key, (taxa, sites) in zip(msa_files, keys, dimensions):
+        if cache is not None and cache.get(key, os.path.join(output_dir, f"{tree_prefix(msa_file)}.treefile")):
+            results[msa_file] = (msa_file, "Success", {})
+        else:
+            batch.append((msa_file, key, taxa, taxa * sites))
+
+    if len(batch) > 1:
+        partial_prefix = os.path.join(output_dir, f"batch_{tree_prefix(batch[0][0])}.partial")
+        input_dir = tempfile.mkdtemp(prefix="iqtree_batch_", dir=TMPFS_DIR)
+        try:
+            for i, (msa_file, _, _, _) in enumerate(batch):
+                data = read_file(os.path.join(msa_path, msa_file))
+                with open(os.path.join(input_dir, f"{i:06d}_{strip_codec(msa_file)}"), "wb") as f:
+                    f.write(re.sub(rb"^>", b">" + batch_tag(i).encode(), data, flags=re.MULTILINE))
+            command = ["iqtree", "-S", input_dir, "-T", str(cpu_cores), "-pre", partial_prefix, "-m", IQTREE_MODEL, "-quiet"]
+            if bootstrap > 0:
+                command.extend(["-B" if ufboot else "-b", str(bootstrap)])
+            returncode, _, usage = run_command(command)
+
+            trees = []
+            if returncode == 0 and os.path.exists(partial_prefix + ".treefile"):
+                with open(partial_prefix + ".treefile", "r") as f:
+                    trees = [line.strip() for line in f if line.strip()]
+            matched = match_batch_trees(trees, [taxa for _, _, taxa, _ in batch])
+            total_cells = sum(cells for _, _, _, cells in batch) or 1
+            for i, tree in matched.items():
+                msa_file, key, _, cells = batch[i]
+                treefile = os.path.join(output_dir, f"{tree_prefix(msa_file)}.treefile")
+                with open(treefile + ".tmp", "w") as f:
+                    f.write(tree + "\n")
+                os.replace(treefile + ".tmp", treefile)
+                if cache is not None:
+                    cache.put(key, treefile)
+                share = cells / total_cells
+                results[msa_file] = (msa_file, "Success", {name: value * share if name.endswith(("_time", "_bytes")) else value
+                                                           for name, value in usage.items()})
+            if len(matched) < len(batch):
+                tqdm.write(f"Batch of {len(batch)} alignments: {len(batch) - len(matched)} without a matching tree (Code {returncode}), computing them one by one.")
+        finally:
+            shutil.rmtree(input_dir, ignore_errors=True)
+            for path in glob.glob(glob.escape(partial_prefix) + ".*"):
+                os.remove(path)
+
+    for msa_file, key, _, _ in batch:
+        if msa_file not in results:
+            results[msa_file] = run_tree_computation(msa_file, msa_path, output_dir, cpu_cores, bootstrap, ufboot, cache, key)
+    return [results[msa_file] for msa_file in msa_files]
+
+
+def batch_jobs(jobs: list, batch_cells: float, max_batch_size: int, cells_per_core: float) -> list:
+    """
+    Group jobs of small alignments (fewer cells than cells_per_core, i.e. single-threaded) into batches of up to
+    batch_cells cells and max_batch_size alignments, so the batch size adapts to the alignment size: many tiny
+    alignments or a few larger ones per IQ-TREE run. Jobs must be sorted largest first; batches are built from
+    alignments of similar size and sized (cells) as one job.
+
+    Returns:
+    - jobs: list, Jobs of large alignments as they were and batches (jobs with msa_files), largest first.
+    """
+    large = [job for job in jobs if job["cells"] >= cells_per_core]
+    batches = []
+    batch = []
+    for job in jobs:
+        if job["cells"] >= cells_per_core:
+            continue
+        if batch and (len(batch) >= max_batch_size or sum(member["cells"] for member in batch) + job["cells"] > batch_cells):
+            batches.append(batch)
+            batch = []
+        batch.append(job)
+    if batch:
+        batches.append(batch)
+
+    for members in batches:
+        if len(members) == 1:
+            large.append(members[0])
+            continue
+        batch = {name: value for name, value in members[0].items() if name not in ("msa_file", "key", "dimensions")}
+        batch.update(msa_files=[member["msa_file"] for member in members], keys=[member["key"] for member in members],
+                     dimensions=[member["dimensions"] for member in members], cells=sum(member["cells"] for member in members))
+        large.append(batch)
+    return sorted(large, key=lambda job: job["cells"], reverse=True)
+
+
+def alignment_dimensions(data: bytes):
+    """
+    Number of taxa and sites of an aligned FASTA file.
+    """
+    taxa = 0
+    sites = 0
+    for line in data.splitlines():
+        if line.startswith(b">"):
+            taxa += 1
+        elif taxa == 1:
+            sites += len(line.strip())
+    return taxa, sites
 
 
-def make_trees(msa_path: str, output_dir: str, cpu_cores: int, bootstrap: int, num_processes: int = 4):
+def tree_threads(cells: int, free_cores: int, num_pending: int, cells_per_core: float, max_threads: int) -> int:
+    """
+    Number of IQ-TREE threads for an alignment: one thread per cells_per_core alignment cells
+    (taxa x sites), capped by max_threads. When fewer alignments remain than cores are free,
+    the released cores are handed to the remaining (largest) alignments.
+    """
+    threads = max(1, math.ceil(cells / cells_per_core))
+    if num_pending < free_cores:
+        threads = max(threads, free_cores // num_pending)
+    return min(threads, max_threads)
+
+
+def tree_job(job: dict, threads: int) -> list:
+    """
+    Run one scheduled tree job (a single alignment or a batch). Jobs carry all their arguments, so they also run on queue workers.
+
+    Returns:
+    - results: list, (msa_file, status, usage) of every alignment of the job.
+    """
+    if "msa_files" in job:
+        return run_tree_batch(job["msa_files"], job["msa_path"], job["output_dir"], threads, job["bootstrap"], job["keys"], job["dimensions"],
+                              job["ufboot"], job["cache"])
+    return [run_tree_computation(job["msa_file"], job["msa_path"], job["output_dir"], threads, job["bootstrap"], job["ufboot"], job["cache"], job["key"])]
+
+
+def tree_job_threads(job: dict, free_cores: int, num_pending: int) -> int:
+    return tree_threads(job["cells"], free_cores, num_pending, job["cells_per_core"], job["max_threads"])
+
+
+def make_trees(msa_path: str, output_dir: str, cpu_cores: int, bootstrap: int, num_processes: int = None, cells_per_core: float = 20_000, max_threads: int = 16, ufboot: bool = False, resume: bool = False, cache=None, work_queue=None,
+               batch_cells: float = 0, max_batch_size: int = 256):
+    """
+    Compute ML trees for all alignments in parallel.
+    Alignments unchanged since the last run with the same settings (per the manifest in output_dir) are skipped,
+    and trees of alignments which disappeared are removed.
+
+    Jobs share a global budget of cpu_cores. Alignments are started largest first and each job's -T
+    is sized from the alignment's taxa x sites when it starts, so cores released by finished jobs go to
+    the remaining jobs. Per-tree wall and CPU times are written to tree_timings.tsv, which can be used
+    to calibrate cells_per_core.
+
+    Parameters:
+    - num_processes: int, Maximum number of concurrent IQ-TREE processes (default: no limit besides cpu_cores).
+    - cells_per_core: float, Alignment cells (taxa x sites) per IQ-TREE thread.
+    - max_threads: int, Maximum number of threads of a single IQ-TREE process.
+    - ufboot: bool, Use ultrafast bootstrap (-B) instead of the standard nonparametric bootstrap (-b).
+    - resume: bool, Skip alignments whose trees were completed by an interrupted run (per the completion ledger).
+    - cache: ResultCache, Shared result cache (common.result_cache); trees of identical alignments computed
+      with the same settings in any run are taken from it.
+    - work_queue: WorkQueue, Run IQ-TREE on the workers of a work queue (common.work_queue), each with its own
+      core budget, instead of on cpu_cores local cores.
+    - batch_cells: float, Alignments smaller than cells_per_core are computed in IQ-TREE runs over batches of up to
+      this many cells (see run_tree_batch); 0 - one IQ-TREE run per alignment.
+    - max_batch_size: int, Maximum number of alignments in a batch.
+    """
     os.makedirs(output_dir, exist_ok=True)
     
-    msa_files = os.listdir(msa_path)
-    
-    with ProcessPoolExecutor(max_workers=num_processes) as executor:
-        results = list(tqdm(
-            executor.map(
-                run_tree_computation,
-                msa_files,
-                [msa_path] * len(msa_files),
-                [output_dir] * len(msa_files),
-                [cpu_cores // num_processes] * len(msa_files),
-                [bootstrap] * len(msa_files)
-            ),
-            total=len(msa_files),
-            desc="Computing trees",
-            unit="file"
-        ))
+    all_msa_files = sorted(f for f in os.listdir(msa_path) if strip_codec(f).endswith("-aligned.fasta"))
+
+    manifest = load_manifest(output_dir)
+    params = {"tool": "iqtree", "model": IQTREE_MODEL, "bootstrap": bootstrap, "ufboot": ufboot and bootstrap > 0}
+    digests = {}
+    dimensions = {}
+    for msa_file in all_msa_files:
+        data = read_file(os.path.join(msa_path, msa_file))
+        digests[msa_file] = hashlib.sha256(data).hexdigest()
+        dimensions[msa_file] = alignment_dimensions(data)
+    remove_stale_items(manifest, digests, output_dir)
+    if manifest["params"] != params:
+        manifest["items"] = {}
+        manifest["params"] = params
+    if resume:
+        resumed = resumable_items(output_dir, params, digests, is_valid_treefile)
+        manifest["items"].update(resumed)
+        print(f"Resuming: {len(resumed)} trees completed by the interrupted run.")
+    msa_files = pending_items(manifest, params, digests, output_dir)
+    print(f"{len(all_msa_files) - len(msa_files)} trees up to date, {len(msa_files)} to compute.")
+
+    jobs = [{"msa_file": msa_file, "msa_path": msa_path, "output_dir": output_dir, "bootstrap": bootstrap, "ufboot": ufboot, "cache": cache,
+             "key": cache_key("iqtree", params, digests[msa_file]), "cells": dimensions[msa_file][0] * dimensions[msa_file][1],
+             "dimensions": dimensions[msa_file], "cells_per_core": cells_per_core, "max_threads": max_threads} for msa_file in msa_files]
+    jobs.sort(key=lambda job: job["cells"], reverse=True)
+    if batch_cells > 0:
+        jobs = batch_jobs(jobs, batch_cells, max_batch_size, cells_per_core)
+        batches = [job for job in jobs if "msa_files" in job]
+        if batches:
+            print(f"Batched {sum(len(job['msa_files']) for job in batches)} small alignments into {len(batches)} IQ-TREE runs.")
+
+    if work_queue is None:
+        results = run_scheduled(jobs, cpu_cores, tree_job, tree_job_threads, desc="Computing trees", unit="file", max_jobs=num_processes)
+    else:
+        results = run_queued(jobs, work_queue, tree_job, tree_job_threads, desc="Computing trees", unit="file")
+
+    failed = 0
+    with open(os.path.join(output_dir, TIMINGS_NAME), "w") as timings, open_ledger(output_dir, resume) as ledger:
+        timings.write("family\ttaxa\tsites\tthreads\twall_time_s\tuser_time_s\tsys_time_s\tmax_rss_kb\tstatus\n")
+        for job, threads, job_results, wall_time in results:
+            for msa_file, status, usage in job_results:
+                taxa, sites = dimensions[msa_file]
+                # Alignments of a batch get a share of its wall time by alignment cells.
+                share = taxa * sites / job["cells"] if "msa_files" in job else 1.0
+                timings.write(f"{tree_prefix(msa_file)}\t{taxa}\t{sites}\t{threads}\t{wall_time * share:.3f}\t"
+                              f"{usage.get('user_time', 0):.3f}\t{usage.get('sys_time', 0):.3f}\t{usage.get('max_rss_kb', 0)}\t{status}\n")
+                timings.flush()
+                append_record(ledger, {"item": msa_file, "input": digests[msa_file], "params": params, "status": status,
+                                       "exit_code": usage.get("exit_code"), "outputs": [f"{tree_prefix(msa_file)}.treefile"]})
+                if status == "Success":
+                    manifest["items"][msa_file] = {"input": digests[msa_file], "outputs": [f"{tree_prefix(msa_file)}.treefile"]}
+                else:
+                    tqdm.write(f"Tree computation for {msa_file} failed: {status}")
+                    manifest["items"].pop(msa_file, None)
+                    failed += 1
+
+    if failed:
+        print(f"{failed} tree computation(s) failed, see {os.path.join(output_dir, TIMINGS_NAME)}")
+    save_manifest(output_dir, manifest)
+    remove_ledger(output_dir)
 
 
 def compute_bootstrap_support(tree: str) -> float:
     """
-    Computes the average bootstrap support for a given tree.
+    Computes the average bootstrap support for a given tree (0.0 for trees without supports).
     """
-    bootstrap_values = re.findall(r'\)(\d+):', tree)
-    bootstrap_values = [float(val) for val in bootstrap_values]
+    average_support = tree_stats(parse_newick(tree))[STATS_COLUMNS.index("mean_support")]
+    return 0.0 if np.isnan(average_support) else average_support
 
-    # Compute the average bootstrap support
-    if bootstrap_values:
-        average_support = sum(bootstrap_values) / len(bootstrap_values)
-    else:
-        average_support = 0.0
-    
-    return average_support
+
+def strip_supports(tree: str) -> str:
+    """
+    Removes internal node labels (support values) from a Newick tree, leaving the plain topology with branch lengths.
+    """
+    return re.sub(r'\)[^:,();]+', ')', tree)
 
 
-def merge_results(trees_path: str, output_file: str = "all_trees.txt", eliminate_trees:bool=False, support_threshold:float=70) -> None:
+def _tree_rows(trees_path: str, num_processes: int = None):
     """
-    Merges all .treefile files in the given directory into one file.
+    Parse all treefiles in trees_path and write their statistics to tree_stats.tsv there.
+
+    Returns:
+    - rows: list, (treefile, tree, stats) of every treefile (stats None for unparsable trees).
+    - table: dict, The statistics table as read back by read_stats_table.
     """
     trees_dir = Path(trees_path)
-    treefiles = sorted(trees_dir.glob("*.treefile"))
+    treefiles = sorted(str(path) for path in trees_dir.glob("*.treefile"))
+    rows = collect_tree_stats(treefiles, num_processes)
+    stats_path = str(trees_dir / TREE_STATS_NAME)
+    write_stats_table(rows, stats_path)
+    return rows, read_stats_table(stats_path)
+
+
+def _write_merged(rows: list, output_path: Path, passing: set = None, remove_supports: bool = False, compression: str = "none", compression_threads: int = 1):
+    """
+    Write the parsed trees (of treefiles in passing, if given) into one file, with the codec's suffix.
+    """
+    output_path = output_path.parent / with_codec(output_path.name, compression)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    written = 0
+    with open_compressed(str(output_path), "w", compression_threads) as f_out:
+        for treefile, tree, stats in rows:
+            if stats is None:
+                continue
+            if passing is not None and os.path.basename(treefile) not in passing:
+                continue
+            if remove_supports:
+                tree = strip_supports(tree)
+            f_out.write(tree + "\n")
+            written += 1
+    remove_variants(str(output_path))
+    print(f"Merged {written} of {len(rows)} .treefile(s) into {output_path.name}")
+
+
+def _passing_trees(table: dict, support_threshold: float) -> set:
+    return set(table["tree"][np.nan_to_num(table["mean_support"]) >= support_threshold])
 
-    output_path = trees_dir / output_file
+
+@timed
+def merge_results(trees_path: str, output_file: str = "all_trees.txt", eliminate_trees:bool=False, support_threshold:float=70, output_dir: str = None, remove_supports: bool = False, num_processes: int = None,
+                  compression: str = "none", compression_threads: int = 1) -> None:
+    """
+    Merges all .treefile files in the given directory into one file.
+    The merged file is written to output_dir (default: trees_path). With remove_supports,
+    support values are stripped, so trees computed with bootstrap yield plain ML topologies.
+    With a compression codec the merged file gets the codec's suffix (e.g. all_trees.txt.gz)
+    and is compressed on compression_threads threads.
+
+    Treefiles are parsed in parallel (num_processes) and per-tree statistics (support, tree length, taxa)
+    are written to tree_stats.tsv in trees_path. With eliminate_trees, trees whose mean support in
+    that table is below support_threshold are left out (trees without supports count as 0).
+    """
+    try:
+        rows, table = _tree_rows(trees_path, num_processes)
+        passing = _passing_trees(table, support_threshold) if eliminate_trees else None
+        _write_merged(rows, Path(output_dir or trees_path) / output_file, passing, remove_supports, compression, compression_threads)
+    except Exception as e:
+        print(f"Error while merging files: {e}")
+
+
+@timed
+def merge_single_pass(trees_path: str, output_dir: str, support_threshold: float = 70, num_processes: int = None,
+                      compression: str = "none", compression_threads: int = 1) -> None:
+    """
+    Merges the trees of a single pass (computed with bootstrap, in trees_path) into both tree sets with one
+    pass over the treefiles: all_trees.txt in output_dir with supports stripped, and all_trees_bootstrap.txt
+    in trees_path without trees whose mean support is below support_threshold (see merge_results).
+    """
     try:
-        with output_path.open("w") as f_out:
-            for treefile in treefiles:
-                with treefile.open("r") as f_in:
-                    first_line = f_in.readline().strip() # tree
-                    if first_line:
-                        if eliminate_trees:
-                            support = compute_bootstrap_support(first_line)
-                            if support < support_threshold:
-                                continue
-                        f_out.write(first_line + "\n")
-        print(f"Merged {len(treefiles)} .treefile(s) into {output_file}")
+        rows, table = _tree_rows(trees_path, num_processes)
+        _write_merged(rows, Path(output_dir) / "all_trees.txt", remove_supports=True, compression=compression, compression_threads=compression_threads)
+        _write_merged(rows, Path(trees_path) / "all_trees_bootstrap.txt", _passing_trees(table, support_threshold),
+                      compression=compression, compression_threads=compression_threads)
     except Exception as e:
         print(f"Error while merging files: {e}")
 
@@ -103,10 +535,28 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script for performing tree computations.")
     parser.add_argument("--basename", required=True, help="Name used for intermediate results saving.")
     parser.add_argument("--cpu_cores", required=True, type=int, help="Number of CPU cores to use during computations.")
-    parser.add_argument("--num_processes", required=True, type=int, help="Number of separate processes to run. CPU cores are uniformly distributed on processes.")
+    parser.add_argument("--num_processes", required=True, type=int, help="Maximum number of IQ-TREE processes running at once. CPU cores are assigned to processes according to alignment size.")
+    parser.add_argument("--cells_per_core", type=float, default=20_000, help="Alignment cells (taxa x sites) per IQ-TREE thread.")
+    parser.add_argument("--max_threads", type=int, default=16, help="Maximum number of threads of a single IQ-TREE process.")
     parser.add_argument("--bootstrap", required=True, type=int, help="Number of bootstrap replicates.")
     parser.add_argument("--support_threshold", required=True, type=float, help="Threshold for mean bootstrap support in Tree.")
+    parser.add_argument("--single_pass", action="store_true", help="Compute every tree once with bootstrap and derive both the plain and the bootstrapped tree sets from it.")
+    parser.add_argument("--resume", action="store_true", help="Skip trees completed by an interrupted run (per the completion ledger).")
+    parser.add_argument("--ufboot", action="store_true", help="Use ultrafast bootstrap (-B, at least 1000 replicates) instead of the standard bootstrap (-b).")
+    parser.add_argument("--trimmed", action="store_true", help="Compute trees from trimmed alignments (allignment/trim_alignments.py).")
+    parser.add_argument("--cache_dir", default=None, help="Directory of the result cache shared between runs (disabled if not given).")
+    parser.add_argument("--cache_size_gb", type=float, default=50.0, help="Size limit of the result cache in GB (least recently used results are evicted).")
+    parser.add_argument("--compression", choices=CODECS, default="none", help="Codec of the merged tree sets (all_trees*.txt).")
+    parser.add_argument("--compression_threads", type=int, default=1, help="Number of compression threads.")
+    parser.add_argument("--batch_cells", type=float, default=0, help="Alignments smaller than cells_per_core are computed together in IQ-TREE runs over batches of up to this many cells (0 - no batching).")
+    parser.add_argument("--max_batch_size", type=int, default=256, help="Maximum number of alignments in an IQ-TREE batch.")
+    parser.add_argument("--executor", choices=["local", "queue"], default="local", help="Run IQ-TREE on local cores or on workers of a work queue (common/work_queue.py).")
+    parser.add_argument("--queue_address", default=DEFAULT_ADDRESS, help="Address (host:port) the work queue listens on.")
+    parser.add_argument("--queue_authkey", default=os.environ.get("WORK_QUEUE_AUTHKEY"), help="Key shared with the queue workers (default: $WORK_QUEUE_AUTHKEY).")
     args = parser.parse_args()
+    if args.executor == "queue" and not args.queue_authkey:
+        parser.error("the queue executor requires --queue_authkey or $WORK_QUEUE_AUTHKEY")
+    track_stage("trees")
 
     CPU_CORES = args.cpu_cores
     NUM_PROCESSES = args.num_processes
@@ -114,8 +564,9 @@ if __name__ == "__main__":
     SUPPORT_THRESHOLD = args.support_threshold
     BASENAME = args.basename
 
-    ORTOLOGS_MSA_PATH = os.path.join("allignment/msa_results/ortologs", BASENAME)
-    PARALOGS_MSA_RESULTS = os.path.join("allignment/msa_results/paralogs", BASENAME)
+    MSA_RESULTS = "allignment/trimmed_results" if args.trimmed else "allignment/msa_results"
+    ORTOLOGS_MSA_PATH = os.path.join(MSA_RESULTS, "ortologs", BASENAME)
+    PARALOGS_MSA_RESULTS = os.path.join(MSA_RESULTS, "paralogs", BASENAME)
 
     ORTOLOGS_OUTPUT_DIR = os.path.join("trees/tree_results/", BASENAME, "ortologs")
     PARALOGS_OUTPUT_DIR = os.path.join("trees/tree_results/", BASENAME, "paralogs")
@@ -123,23 +574,33 @@ if __name__ == "__main__":
     ORTOLOGS_BOOTSTRAP_OUTPUT_DIR = os.path.join("trees/tree_results/", BASENAME, "ortologs_boot")
     PARALOGS_BOOTSTRAP_OUTPUT_DIR = os.path.join("trees/tree_results/", BASENAME, "paralogs_boot")
 
-    # Make ML Trees using ortological sequences without bootstrap.
-    make_trees(ORTOLOGS_MSA_PATH, ORTOLOGS_OUTPUT_DIR, CPU_CORES, bootstrap=0, num_processes=NUM_PROCESSES)
-    merge_results(ORTOLOGS_OUTPUT_DIR, output_file="all_trees.txt")
-
-    # Make ML Trees using ortological sequences with bootstrap (if greater than zero)
-    if BOOTSTRAP > 0:
-        make_trees(ORTOLOGS_MSA_PATH, ORTOLOGS_BOOTSTRAP_OUTPUT_DIR, CPU_CORES, BOOTSTRAP, NUM_PROCESSES)
-        merge_results(ORTOLOGS_BOOTSTRAP_OUTPUT_DIR, output_file="all_trees_bootstrap.txt", eliminate_trees=True, support_threshold=SUPPORT_THRESHOLD)
-
-    # Make ML Trees using PARALOGS sequences without bootstrap.
-    make_trees(PARALOGS_MSA_RESULTS, PARALOGS_OUTPUT_DIR, CPU_CORES, bootstrap=0, num_processes=NUM_PROCESSES)
-    merge_results(PARALOGS_OUTPUT_DIR, output_file="all_trees.txt")
+    TREE_OPTIONS = {"num_processes": NUM_PROCESSES, "cells_per_core": args.cells_per_core, "max_threads": args.max_threads, "ufboot": args.ufboot, "resume": args.resume,
+                    "batch_cells": args.batch_cells, "max_batch_size": args.max_batch_size,
+                    "cache": open_result_cache(args.cache_dir, args.cache_size_gb),
+                    "work_queue": open_work_queue(args.executor, args.queue_address, args.queue_authkey)}
+    MERGE_OPTIONS = {"num_processes": CPU_CORES, "compression": args.compression, "compression_threads": args.compression_threads}
+    if args.ufboot and 0 < BOOTSTRAP < 1000:
+        print(f"Ultrafast bootstrap requires at least 1000 replicates, using 1000 instead of {BOOTSTRAP}.")
+        BOOTSTRAP = 1000
 
-    # Make ML Trees using PARALOGS sequences with bootstrap (if greater than zero)
-    if BOOTSTRAP > 0:
-        make_trees(PARALOGS_MSA_RESULTS, PARALOGS_BOOTSTRAP_OUTPUT_DIR, CPU_CORES, BOOTSTRAP, NUM_PROCESSES)
-        merge_results(PARALOGS_BOOTSTRAP_OUTPUT_DIR, output_file="all_trees_bootstrap.txt", eliminate_trees=True, support_threshold=SUPPORT_THRESHOLD)
+    for msa_path, output_dir, bootstrap_output_dir in [
+        (ORTOLOGS_MSA_PATH, ORTOLOGS_OUTPUT_DIR, ORTOLOGS_BOOTSTRAP_OUTPUT_DIR),
+        (PARALOGS_MSA_RESULTS, PARALOGS_OUTPUT_DIR, PARALOGS_BOOTSTRAP_OUTPUT_DIR),
+    ]:
+        if BOOTSTRAP > 0 and args.single_pass:
+            # Single pass: one IQ-TREE run per family with bootstrap. The plain ML trees are the same trees with supports stripped.
+            make_trees(msa_path, bootstrap_output_dir, CPU_CORES, BOOTSTRAP, **TREE_OPTIONS)
+            merge_single_pass(bootstrap_output_dir, output_dir, SUPPORT_THRESHOLD, **MERGE_OPTIONS)
+            continue
 
+        # Make ML Trees without bootstrap.
+        make_trees(msa_path, output_dir, CPU_CORES, bootstrap=0, **TREE_OPTIONS)
+        merge_results(output_dir, output_file="all_trees.txt", **MERGE_OPTIONS)
 
+        # Make ML Trees with bootstrap (if greater than zero)
+        if BOOTSTRAP > 0:
+            make_trees(msa_path, bootstrap_output_dir, CPU_CORES, BOOTSTRAP, **TREE_OPTIONS)
+            merge_results(bootstrap_output_dir, output_file="all_trees_bootstrap.txt", eliminate_trees=True, support_threshold=SUPPORT_THRESHOLD, **MERGE_OPTIONS)
 
+    if TREE_OPTIONS["cache"] is not None and TREE_OPTIONS["work_queue"] is None:  # With the queue executor the cache is used by the workers
+        print(TREE_OPTIONS["cache"].summary())
@@ -0,0 +1,104 @@
+import os
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from common.telemetry import timed
+from common.compression import open_compressed
+from trees.newick import parse_newick, tip_labels
+
+MRP_MATRIX_NAME = "mrp_matrix.phy"
+CHUNK_SIZE = 256
+
+
+def tree_characters(tree, taxon_index: dict, num_taxa: int):
+    """
+    MRP characters of a parsed tree: one character per clade (internal node below the root).
+    Leaf labels may repeat (paralogs), so a taxon can have leaves inside and outside a clade.
+
+    Returns:
+    - (inside, outside): tuple, Bit-packed (clades x taxa) masks of taxa with a leaf inside / outside the clade.
+    """
+    num_nodes = len(tree.parent)
+    tips = np.flatnonzero(tree.is_tip)
+    counts = np.zeros((num_nodes, num_taxa), dtype=np.int32)
+    counts[tips, [taxon_index[label] for label in tree.labels]] = 1
+    # Nodes are in preorder, so visiting them backwards sees every child before its parent.
+    parent = tree.parent
+    for node in range(num_nodes - 1, 0, -1):
+        counts[parent[node]] += counts[node]
+
+    clades = np.flatnonzero(~tree.is_tip[1:]) + 1
+    inside = counts[clades] > 0
+    outside = (counts[0] - counts[clades]) > 0
+    # Only characters with at least two taxa coded 1 and two coded 0 are informative.
+    ones = (inside & ~outside).sum(axis=1)
+    zeros = (outside & ~inside).sum(axis=1)
+    informative = (ones >= 2) & (zeros >= 2)
+    return np.packbits(inside[informative], axis=1), np.packbits(outside[informative], axis=1)
+
+
+def _chunk_characters(lines: list, taxa: list):
+    taxon_index = {taxon: i for i, taxon in enumerate(taxa)}
+    num_bytes = (len(taxa) + 7) // 8
+    inside = [np.empty((0, num_bytes), dtype=np.uint8)]
+    outside = [np.empty((0, num_bytes), dtype=np.uint8)]
+    for line in lines:
+        tree_inside, tree_outside = tree_characters(parse_newick(line), taxon_index, len(taxa))
+        inside.append(tree_inside)
+        outside.append(tree_outside)
+    return np.vstack(inside), np.vstack(outside)
+
+
+def mrp_characters(lines: list, taxa: list, num_processes: int = None):
+    """
+    MRP characters of all trees, computed in parallel over chunks of trees.
+
+    Returns:
+    - (inside, outside): tuple, Bit-packed (characters x taxa) masks, see tree_characters.
+    """
+    chunks = [lines[i:i + CHUNK_SIZE] for i in range(0, len(lines), CHUNK_SIZE)]
+    if num_processes == 1 or len(chunks) <= 1:
+        results = list(map(_chunk_characters, chunks, repeat(taxa)))
+    else:
+        with ProcessPoolExecutor(max_workers=num_processes) as executor:
+            results = list(executor.map(_chunk_characters, chunks, repeat(taxa)))
+    num_bytes = (len(taxa) + 7) // 8
+    inside = np.vstack([np.empty((0, num_bytes), dtype=np.uint8)] + [chunk_inside for chunk_inside, _ in results])
+    outside = np.vstack([np.empty((0, num_bytes), dtype=np.uint8)] + [chunk_outside for _, chunk_outside in results])
+    return inside, outside
+
+
+def taxon_states(inside: np.ndarray, outside: np.ndarray, taxon: int) -> bytes:
+    """
+    Character states of one taxon: 1 - only inside the clade, 0 - only outside, ? - both or absent from the tree.
+    """
+    byte, shift = divmod(taxon, 8)
+    is_in = (inside[:, byte] >> (7 - shift)) & 1
+    is_out = (outside[:, byte] >> (7 - shift)) & 1
+    states = np.full(len(inside), ord("?"), dtype=np.uint8)
+    states[(is_in == 1) & (is_out == 0)] = ord("1")
+    states[(is_in == 0) & (is_out == 1)] = ord("0")
+    return states.tobytes()
+
+
+@timed
+def write_mrp_matrix(tree_file: str, matrix_file: str, num_processes: int = None):
+    """
+    Build the MRP matrix of the trees in tree_file and write it in relaxed sequential Phylip format
+    (taxon name and states separated by a space).
+
+    Returns:
+    - (num_taxa, num_characters): tuple, Dimensions of the matrix.
+    """
+    with open_compressed(tree_file, "r") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    taxa = sorted({label for line in lines for label in tip_labels(line)})
+    inside, outside = mrp_characters(lines, taxa, num_processes)
+
+    with open(matrix_file + ".tmp", "wb") as f:
+        f.write(f"{len(taxa)} {len(inside)}\n".encode())
+        for i, taxon in enumerate(taxa):
+            f.write(taxon.encode() + b" " + taxon_states(inside, outside, i) + b"\n")
+    os.replace(matrix_file + ".tmp", matrix_file)
+    return len(taxa), len(inside)
@@ -0,0 +1,176 @@
+import os
+import re
+from typing import NamedTuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from common.telemetry import timed
+
+STATS_COLUMNS = ["taxa", "internal_nodes", "mean_support", "median_support", "min_support", "tree_length"]
+
+# Splitting on the structural characters yields alternating [text, punctuation, text, ...]:
+# the text after "(" or "," is a tip, the text after ")" is the label of the closed internal node.
+_SPLIT = re.compile(r"([(),;])")
+_TIP_LABEL = re.compile(r"[(,]\s*([^(),:;\s][^(),:;]*)")
+
+
+class ParsedTree(NamedTuple):
+    """
+    Newick tree as flat arrays indexed by node (nodes in preorder, root = 0).
+    - parent: int32, Index of the parent node (-1 for the root).
+    - branch_length: float64, Length of the branch to the parent (NaN if missing).
+    - support: float64, Support value of internal nodes (NaN for tips and unlabeled nodes).
+    - is_tip: bool, Node is a tip.
+    - labels: list, Tip labels in node order of the tips.
+    """
+    parent: np.ndarray
+    branch_length: np.ndarray
+    support: np.ndarray
+    is_tip: np.ndarray
+    labels: list
+
+
+def _to_float(text: str) -> float:
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def _fill(values: dict, num_nodes: int) -> np.ndarray:
+    """
+    Array of num_nodes floats from a node -> number text map (NaN elsewhere), converted in bulk.
+    """
+    array = np.full(num_nodes, np.nan)
+    if values:
+        nodes = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+        try:
+            array[nodes] = np.array(list(values.values()), dtype=np.float64)
+        except ValueError:
+            array[nodes] = [_to_float(value) for value in values.values()]
+    return array
+
+
+@timed
+def parse_newick(newick: str) -> ParsedTree:
+    """
+    Parse a single Newick tree. Internal node labels are read as supports; for labels with several values
+    (e.g. "SH-aLRT/UFBoot") the last one is used. Supports may be decimal, and the root may carry one too.
+    """
+    parent = []
+    lengths = {}  # Node -> branch length text
+    supports = {}  # Internal node -> label text
+    tips = []
+    labels = []
+    current = -1
+    parts = _SPLIT.split(newick.strip())
+    for token, text in zip(parts[1::2], parts[2::2]):
+        if token == ")":
+            if text:
+                name, _, branch = text.partition(":")
+                if name:
+                    supports[current] = name.rpartition("/")[2]
+                if branch:
+                    lengths[current] = branch
+            current = parent[current]
+            continue
+        if token == "(":
+            parent.append(current)
+            current = len(parent) - 1
+        elif token == ";":
+            break
+        # Text after "(" or "," is a tip (empty between "((" or after "(,").
+        if text:
+            name, _, branch = text.strip().partition(":")
+            node = len(parent)
+            parent.append(current)
+            tips.append(node)
+            labels.append(name)
+            if branch:
+                lengths[node] = branch
+
+    num_nodes = len(parent)
+    is_tip = np.zeros(num_nodes, dtype=bool)
+    is_tip[tips] = True
+    return ParsedTree(np.array(parent, dtype=np.int32), _fill(lengths, num_nodes), _fill(supports, num_nodes), is_tip, labels)
+
+
+def tip_labels(newick: str) -> list:
+    """
+    Tip labels of a Newick tree, without building the tree.
+    """
+    return [label.strip() for label in _TIP_LABEL.findall(newick)]
+
+
+def tree_stats(tree: ParsedTree) -> tuple:
+    """
+    Summary statistics of a parsed tree, in the order of STATS_COLUMNS.
+    Support statistics are NaN for trees without supports.
+    """
+    supports = tree.support[~np.isnan(tree.support)]
+    if len(supports):
+        mean, median, minimum = supports.mean(), np.median(supports), supports.min()
+    else:
+        mean = median = minimum = np.nan
+    return (
+        int(tree.is_tip.sum()),
+        int(len(tree.is_tip) - tree.is_tip.sum()),
+        float(mean),
+        float(median),
+        float(minimum),
+        float(np.nansum(tree.branch_length)),
+    )
+
+
+def _treefile_stats(paths: list) -> list:
+    rows = []
+    for path in paths:
+        with open(path, "r") as f:
+            newick = f.readline().strip()
+        rows.append((path, newick, tree_stats(parse_newick(newick)) if newick else None))
+    return rows
+
+
+@timed
+def collect_tree_stats(treefiles: list, num_processes: int = None, chunk_size: int = 256) -> list:
+    """
+    Read the first tree of every treefile and compute its statistics, in parallel over chunks of files.
+
+    Returns:
+    - rows: list, (path, newick, stats) per treefile in input order; stats is None for empty treefiles.
+    """
+    chunks = [treefiles[i:i + chunk_size] for i in range(0, len(treefiles), chunk_size)]
+    if num_processes == 1 or len(chunks) <= 1:
+        return [row for chunk in chunks for row in _treefile_stats(chunk)]
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        return [row for rows in executor.map(_treefile_stats, chunks) for row in rows]
+
+
+def write_stats_table(rows: list, path: str):
+    """
+    Write the per-tree statistics table (one line per treefile, tab-separated).
+    """
+    with open(path + ".tmp", "w") as f:
+        f.write("tree\t" + "\t".join(STATS_COLUMNS) + "\n")
+        for treefile, _, stats in rows:
+            if stats is not None:
+                taxa, internal, mean, median, minimum, tree_length = stats
+                f.write(f"{os.path.basename(treefile)}\t{taxa}\t{internal}\t{mean:.4f}\t{median:.4f}\t{minimum:.4f}\t{tree_length:.6g}\n")
+    os.replace(path + ".tmp", path)
+
+
+def read_stats_table(path: str) -> dict:
+    """
+    Read a per-tree statistics table.
+
+    Returns:
+    - table: dict, Column name -> NumPy array ("tree" -> array of treefile names).
+    """
+    with open(path, "r") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in f]
+    columns = list(zip(*rows)) if rows else [()] * len(header)
+    table = {"tree": np.array(columns[0], dtype=object)}
+    for name, values in zip(header[1:], columns[1:]):
+        table[name] = np.array(values, dtype=np.float64)
+    return table